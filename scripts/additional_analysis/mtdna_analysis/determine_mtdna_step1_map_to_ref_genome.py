@@ -4,8 +4,10 @@ import ref_genome_processing.common_ref_genome_processing_helpers as common_rgp
 
 from ref_genome_processing.convert_mapped_sam2bam import execute_convert_sam_to_bam
 
-def execute_bwa_map_mtDNA_to_refgenome(input_file_path:str, ref_genome_path:str, output_file_path:str, threads:int = THREADS_DEFAULT):
-    
+def execute_bwa_map_mtDNA_to_refgenome(input_file_path:str, ref_genome_path:str, output_file_path:str, threads: int = None):
+    if threads is None:
+        threads = get_task_threads()
+
     print_info(f"Mapping {input_file_path} to reference genome ...")
 
     if not os.path.exists(input_file_path):
@@ -18,11 +20,12 @@ def execute_bwa_map_mtDNA_to_refgenome(input_file_path:str, ref_genome_path:str,
         print_info(f"Output file {output_file_path} already exists! Skipping!")
         return
     
-    command_bwa = f"{PROGRAM_PATH_BWA} {PROGRAM_PATH_BWA_MEM} -M -T 50 -t {str(threads)} {ref_genome_path} {input_file_path} > {output_file_path}"
-    print_debug(f"Executing command: {command_bwa}")
-
     try:
-        subprocess.run(command_bwa, shell=True, check=True)
+        with atomic_output(output_file_path) as temp_output_file_path:
+            command_bwa = f"{PROGRAM_PATH_BWA} {PROGRAM_PATH_BWA_MEM} -M -T 50 -t {str(threads)} {ref_genome_path} {input_file_path} > {temp_output_file_path}"
+            print_debug(f"Executing command: {command_bwa}")
+
+            run_command(command_bwa)
         print_success(f"Mapping {input_file_path} to reference genome complete")
     except Exception as e:
         print_error(f"Failed to run bwa for {input_file_path}: {e}")
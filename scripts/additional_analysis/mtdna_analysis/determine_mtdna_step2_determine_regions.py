@@ -3,7 +3,9 @@ from common_aDNA_scripts import *
 import ref_genome_processing.common_ref_genome_processing_helpers as common_rgp
 
 
-def execute_samtools_get_read_regions(bam_file: str, output_file: str, threads: int=THREADS_DEFAULT):
+def execute_samtools_get_read_regions(bam_file: str, output_file: str, threads: int = None):
+    if threads is None:
+        threads = get_task_threads()
 
     if not os.path.exists(bam_file):
         raise Exception(f"BAM file {bam_file} does not exist.")
@@ -14,15 +16,16 @@ def execute_samtools_get_read_regions(bam_file: str, output_file: str, threads:
     
     # Exclude secondary alignments (SAM flag 0x100) to ensure only primary alignments 
     # are passed to bedtools for BED conversion
-    command = (
-        f"{PROGRAM_PATH_SAMTOOLS} {PROGRAM_PATH_SAMTOOLS_VIEW} -h -@ {threads} -F 0x100 {bam_file} | "
-        f"{PROGRAM_PATH_BEDTOOLS} {PROGRAM_PATH_BAMTOBED} -i > {output_file}"
-    )
-    print_debug(f"Executing command: {command}")
-    
     try:
-      # Execute the command
-        subprocess.run(command, shell=True, check=True)
+        with atomic_output(output_file) as temp_output_file:
+            command = (
+                f"{PROGRAM_PATH_SAMTOOLS} {PROGRAM_PATH_SAMTOOLS_VIEW} -h -@ {threads} -F 0x100 {bam_file} | "
+                f"{PROGRAM_PATH_BEDTOOLS} {PROGRAM_PATH_BAMTOBED} -i > {temp_output_file}"
+            )
+            print_debug(f"Executing command: {command}")
+
+            # Execute the command
+            run_command(command)
         print_success(f"Regions for {bam_file} have been written to {output_file}")
     except Exception as e:
         print_error(f"Failed to extract regions for {bam_file}: {e}")
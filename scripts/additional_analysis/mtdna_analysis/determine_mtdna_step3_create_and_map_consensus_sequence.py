@@ -1,7 +1,6 @@
 import os
-import subprocess
 
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool
 from common_aDNA_scripts import *
 import ref_genome_processing.common_ref_genome_processing_helpers as common_rgp
 
@@ -31,9 +30,10 @@ def execute_angsd_create_and_map_consensus_sequence(sorted_bam_file: str, output
     print_info(f"[PID {pid}] Creating consensus sequence of {sorted_bam_file}...")
 
     try:
+        # angsd writes to a temporary prefix, the consensus sequence is renamed once complete
         command_angsd = [
             PROGRAM_PATH_ANGSD, 
-            "-out", out_file_path, 
+            "-out", get_temp_file_path(out_file_path), 
             "-i", sorted_bam_file, 
             "-doFasta", "2", 
             "-doCounts", "1"
@@ -44,7 +44,8 @@ def execute_angsd_create_and_map_consensus_sequence(sorted_bam_file: str, output
         ]
         print_debug(f"[PID {pid}] Executing command: {' '.join(command_angsd)}")
 
-        subprocess.run(command_angsd, check=True, capture_output=True, text=True) # Added capture_output and text
+        with atomic_output(out_file_path + FILE_ENDING_FA_GZ, out_file_path + ".arg"):
+            run_command(command_angsd)
         print_success(f"[PID {pid}] Consensus sequence of {sorted_bam_file} created successfully.")
 
         # Index the newly created gzipped consensus sequence using Samtools faidx.
@@ -57,7 +58,7 @@ def execute_angsd_create_and_map_consensus_sequence(sorted_bam_file: str, output
                 ]
             print_debug(f"[PID {pid}] Executing command: {' '.join(command_samtools)}")
 
-            subprocess.run(command_samtools, check=True, capture_output=True, text=True) # Added capture_output and text
+            run_command(command_samtools)
             print_success(f"[PID {pid}] Consensus sequence {out_file_path + FILE_ENDING_FA_GZ} indexed successfully.")
         except Exception as e:
             print_error(f"[PID {pid}] Failed to index consensus sequence {out_file_path}: {e}")
@@ -89,16 +90,16 @@ def create_consensus_sequence_for_species(species: str, ref_genome_id: str):
     output_folder_consensus_seq = get_folder_path_species_processed_refgenome_mtdna_consensus_sequences(species, ref_genome_id)
 
     # Determine the number of processes to use for parallel execution.
-    # It takes the minimum of a predefined default (THREADS_DEFAULT) and the
-    # actual number of CPU cores available on the system, ensuring efficient
-    # resource utilization without overloading the system.
-    num_processes = min(THREADS_DEFAULT, cpu_count())
+    # It takes the minimum of the threads assigned to this task and the
+    # number of files, so running tasks together never use more threads
+    # than the configured thread budget.
+    num_processes = get_pool_size(len(list_of_mapped_aDNA_files))
     print_debug(f"Using {num_processes} processes for parallel execution.")
 
     # Initialize a multiprocessing Pool. This creates a pool of worker processes
     # that can execute tasks concurrently. The 'processes' argument specifies
     # the maximum number of worker processes to use.
-    with Pool(processes=num_processes) as pool:
+    with Pool(processes=num_processes, initializer=set_task_threads, initargs=(get_threads_per_worker(num_processes),)) as pool:
         # Prepare the arguments for each call to the _process_single_mapped_aDNA_file helper function.
         # Each tuple (mapped_aDNA_read_file_path, species, ref_genome_id) represents
         # one set of arguments for a single task.
@@ -139,7 +140,7 @@ def map_consensus_sequence_for_species(species: str, ref_genome_tuple: tuple):
         read_name = os.path.splitext(os.path.basename(read_file_path))[0]
         output_file_path = os.path.join(output_folder, f"{read_name}_{ref_genome_id}{FILE_ENDING_SAM}")
 
-        execute_bwa_map_aDNA_to_refgenome(read_file_path, ref_genome_path, output_file_path, THREADS_DEFAULT)
+        execute_bwa_map_aDNA_to_refgenome(read_file_path, ref_genome_path, output_file_path)
 
     print_info(f"Mapping aDNA consensus sequence to reference genome for species {species} complete")
 
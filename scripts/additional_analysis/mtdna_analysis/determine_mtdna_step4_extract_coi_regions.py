@@ -1,5 +1,4 @@
 import os
-import subprocess
 from common_aDNA_scripts import *
 import ref_genome_processing.common_ref_genome_processing_helpers as common_rgp
 
@@ -54,13 +53,15 @@ def execute_samtools_extract_region_by_bed_file(fasta_file_path: str, mtdna_regi
         print_error(f"Failed to get mtDNA region from BED file {mtdna_region_bed_file_path}: {e}")
         return
 
-    command = f"{PROGRAM_PATH_SAMTOOLS} {PROGRAM_PATH_SAMTOOLS_FAIDX} {fasta_file_path} {mtdna_region} -i  > {mtdna_fasta}"
-    print_debug(f"Executing command: {command}")
-
      # Filter the BAM file for reads that map to the mtDNA region
     try:
         print_info(f"Extracting mtDNA {mtdna_region} region from {fasta_file_path} to {mtdna_fasta}...")
-        subprocess.run(command, shell=True, check=True)
+
+        with atomic_output(mtdna_fasta) as temp_mtdna_fasta:
+            command = f"{PROGRAM_PATH_SAMTOOLS} {PROGRAM_PATH_SAMTOOLS_FAIDX} {fasta_file_path} {mtdna_region} -i  > {temp_mtdna_fasta}"
+            print_debug(f"Executing command: {command}")
+
+            run_command(command)
         print_success(f"Extracted mtDNA region {mtdna_region} from {fasta_file_path} to {mtdna_fasta}")
     except Exception as e:
         print_error(f"Failed to extract mtDNA region {mtdna_region} from {fasta_file_path}: {e}")
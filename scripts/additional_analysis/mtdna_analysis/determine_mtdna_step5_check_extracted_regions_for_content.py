@@ -6,6 +6,7 @@ from common_aDNA_scripts import *
 import ref_genome_processing.common_ref_genome_processing_helpers as common_rgp
 
 
+@track_resource_usage
 def check_extracted_region_for_species(species):
 
     print_info(f"Checking extracted region for species {species} ...")
@@ -75,7 +76,7 @@ def check_extracted_region_for_species(species):
                 print_info(f"Non-N percentage: {non_n_percentage:.2f}%")
 
         # Write results to a TSV file
-        with open(output_file, "w", newline="") as tsvfile:
+        with atomic_output(output_file) as temp_output_file, open(temp_output_file, "w", newline="") as tsvfile:
             writer = csv.writer(tsvfile, delimiter="\t")
             writer.writerow(["Filename", "Total Length", "Non-N Count", "Non-N Percentage"])
             writer.writerows(results)
@@ -1,10 +1,11 @@
 from common_aDNA_scripts import *
+from common.common_lazy_loading import LazyStepModule
 
-import additional_analysis.mtdna_analysis.determine_mtdna_step1_map_to_ref_genome as determine_mtdna_step1_map_to_ref_genome
-import additional_analysis.mtdna_analysis.determine_mtdna_step2_determine_regions as determine_mtdna_step2_determine_regions
-import additional_analysis.mtdna_analysis.determine_mtdna_step4_extract_coi_regions as determine_mtdna_step4_extract_coi_regions
-import additional_analysis.mtdna_analysis.determine_mtdna_step3_create_and_map_consensus_sequence as determine_mtdna_step3_create_and_map_consensus_sequence
-import additional_analysis.mtdna_analysis.determine_mtdna_step5_check_extracted_regions_for_content as determine_mtdna_step5_check_extracted_regions_for_content
+determine_mtdna_step1_map_to_ref_genome = LazyStepModule("additional_analysis.mtdna_analysis.determine_mtdna_step1_map_to_ref_genome")
+determine_mtdna_step2_determine_regions = LazyStepModule("additional_analysis.mtdna_analysis.determine_mtdna_step2_determine_regions")
+determine_mtdna_step4_extract_coi_regions = LazyStepModule("additional_analysis.mtdna_analysis.determine_mtdna_step4_extract_coi_regions")
+determine_mtdna_step3_create_and_map_consensus_sequence = LazyStepModule("additional_analysis.mtdna_analysis.determine_mtdna_step3_create_and_map_consensus_sequence")
+determine_mtdna_step5_check_extracted_regions_for_content = LazyStepModule("additional_analysis.mtdna_analysis.determine_mtdna_step5_check_extracted_regions_for_content")
 
 def pipeline_mtdna_analysis():
 
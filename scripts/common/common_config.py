@@ -37,15 +37,15 @@ try:
         common_logging.print_info(f"Log level set to {log_level_str}")
 
     # --- Add File Handler ---
+    # the log folder and file are only created when the first record is written
     log_dir = os.path.join(config['path_adna_project'], common_constants.FOLDER_LOGS)
-    os.makedirs(log_dir, exist_ok=True)
 
     timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
     log_filename = os.path.join(log_dir, f'{timestamp}_pipeline.log')
 
     common_logging.print_info(f"Log file: {log_filename}")
 
-    file_handler = logging.FileHandler(log_filename)
+    file_handler = common_logging.LazyFileHandler(log_filename)
     file_handler.setFormatter(logging.Formatter(common_logging.LOG_FORMAT, datefmt=common_logging.LOG_DATE_FORMAT))
     
     logging.getLogger().addHandler(file_handler)
@@ -68,7 +68,13 @@ def get_config_value(*keys, default=None):
 
 def is_setting_enabled(*keys):
     # Navigate to the path and get the value of the 'enabled' key, defaulting to True if not found
-    return get_config_value(*keys, default={}).get('enabled', True)
+    value = get_config_value(*keys, default={})
+
+    # a setting can also be disabled directly, e.g. "qc: false"
+    if isinstance(value, bool):
+        return value
+
+    return value.get('enabled', True) if isinstance(value, dict) else True
 
 def get_processing_settings(process_key: Enum, species: str = None):
   
@@ -118,9 +124,9 @@ PROGRAM_PATH_SAMTOOLS_VIEW =  "view"
 PROGRAM_PATH_SAMTOOLS_SORT = "sort"
 PROGRAM_PATH_SAMTOOLS_INDEX = "index"
 PROGRAM_PATH_SAMTOOLS_DEPTH = "depth"
+PROGRAM_PATH_SAMTOOLS_FASTQ = "fastq"
+PROGRAM_PATH_SAMTOOLS_IDXSTATS = "idxstats"
 PROGRAM_PATH_ANGSD = get_config_value(ConfigSettings.TOOLS.value, 'angsd', default='angsd')
-PROGRAM_PATH_SEQKIT = get_config_value(ConfigSettings.TOOLS.value, 'seqkit', default='seqkit')
-PROGRAM_PATH_SEQKIT_STATS = "stats"
 PROGRAM_PATH_CENTRIFUGE = get_config_value(ConfigSettings.TOOLS.value, 'centrifuge', default='centrifuge')
 PROGRAM_PATH_KRAKEN = get_config_value(ConfigSettings.TOOLS.value, 'kraken', default='kraken2')
 PROGRAM_PATH_MAPDAMAGE = get_config_value(ConfigSettings.TOOLS.value, 'mapdamage', default='mapDamage')
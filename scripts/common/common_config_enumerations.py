@@ -6,6 +6,8 @@ class ConfigSettings(Enum):
     PROCESSING = 'processing'
     SPECIES = 'species'
     TOOLS = 'tools'
+    SCHEDULER = 'scheduler'
+    PIPELINE = 'pipeline'
 
 # Define Enums for pipeline stages
 class PipelineStages(Enum):
@@ -38,6 +40,7 @@ class ReferenceGenomeProcessingSteps(Enum):
     PREPARE_REFERENCE_GENOME = 'prepare_reference_genome' # Corrected name
     MAP_READS_TO_REFERENCE_GENOME = 'map_reads_to_reference_genome' # Corrected name
     CONVERT_SAM_TO_BAM = 'convert_sam_to_bam'
+    ANALYZE_DAMAGE = 'analyze_damage'
     DETERMINE_ENDOGENOUS_READS = 'determine_endogenous_reads'
     DETERMINE_COVERAGE_DEPTH_AND_BREADTH = 'determine_coverage_depth_and_breadth'
     EXTRACT_SPECIAL_SEQUENCES = 'extract_special_sequences'
@@ -61,14 +64,56 @@ class AdapterRemovalSettings(Enum):
     ADAPTERS = 'adapters'
     ADAPTERS_R1 = 'r1'
     ADAPTERS_R2 = 'r2'
+    FUSED = 'fused'
+
+class MappingSettings(Enum):
+    STREAMING = 'streaming'
+    SORT_MEMORY_PER_THREAD = 'sort_memory_per_thread'
+    SORT_TEMP_DIR = 'sort_temp_dir'
+
+class EndogenousReadsSettings(Enum):
+    COUNTING_MODE = 'counting_mode'
+    MIN_MAPPING_QUALITY = 'min_mapping_quality'
+    EXCLUDE_SECONDARY_SUPPLEMENTARY = 'exclude_secondary_supplementary'
+
+class CoverageSettings(Enum):
+    SHARD_SIZE = 'shard_size'
+    DEPTH_STORE = 'depth_store'
+    BIN_SIZE = 'bin_size'
 
 class ContaminationCheckSettings(Enum):
     CENTRIFUGE_DB = 'centrifuge_db'    
+    CENTRIFUGE_BATCH = 'centrifuge_batch'
     KRAKEN_DB = 'kraken_db'
+    KRAKEN_PER_READ_OUTPUT = 'kraken_per_read_output'
+    KRAKEN_MEMORY_MAPPING = 'kraken_memory_mapping'
+    KRAKEN_BATCH = 'kraken_batch'
+    UNMAPPED_READS_ONLY = 'unmapped_reads_only'
+    UNMAPPED_READS_REFERENCE_GENOME = 'unmapped_reads_reference_genome'
 
 class QualityControlSettings(Enum):
     THREADS = 'threads'
 
+class SchedulerSettings(Enum):
+    ENABLED = 'enabled'
+    MAX_PARALLEL_TASKS = 'max_parallel_tasks'
+    THREAD_BUDGET = 'thread_budget'
+    MEMORY_BUDGET_GB = 'memory_budget_gb'
+    MEMORY_ESTIMATES_GB = 'memory_estimates_gb'
+    DEFAULT_TASK_MEMORY_GB = 'default_task_memory_gb'
+    MAX_OOM_RETRIES = 'max_oom_retries'
+    MANIFEST = 'manifest'
+    FINGERPRINT = 'fingerprint'
+    BATCH = 'batch'
+
+class BatchSettings(Enum):
+    SUBMIT_COMMAND = 'submit_command'
+    OPTIONS = 'options'
+    POLL_INTERVAL = 'poll_interval'
+    TIMEOUT_HOURS = 'timeout_hours'
+    MAX_JOBS = 'max_jobs'
+    TASKS = 'tasks'
+
 # You might also want a mapping from stage key strings to their step Enums
 STAGE_STEP_ENUM_MAP = {
     PipelineStages.RAW_READS_PROCESSING.value: RawReadsProcessingSteps,
@@ -46,6 +46,7 @@ FOLDER_READ_LENGTH_DISTRIBUTION = "read_length_distribution"
 FOLDER_CONTAMINATION = "contamination"
 FOLDER_CENTRIFUGE = "centrifuge"
 FOLDER_KRAKEN = "kraken"
+FOLDER_UNMAPPED_READS = "unmapped_reads"
 FOLDER_ECMSD = "ecmsd"
 FOLDER_DAMAGE_ANALYSIS = "damage_analysis"
 
@@ -53,10 +54,21 @@ FOLDER_REGIONS = "regions"
 
 # main folders
 FOLDER_LOGS = "logs"
+FOLDER_BATCH_JOBS = "batch_jobs"
+FOLDER_COMMAND_LOGS = "commands"
 FOLDER_RESOURCES = "resources"
 
 # files
 FILE_NAME_RAW_READS_LIST = "reads_list.csv"
+FILE_NAME_TASK_MEMORY_USAGE = "task_memory_usage.json"
+FILE_NAME_PIPELINE_MANIFEST = "pipeline_manifest.sqlite"
+FILE_NAME_RESULT_STORE = "result_store.sqlite"
+FILE_ENDING_RUN_METRICS_JSONL = "_metrics.jsonl"
+FILE_ENDING_BATCH_JOB_SCRIPT = ".sh"
+FILE_ENDING_BATCH_JOB_LOG = ".log"
+FILE_ENDING_BATCH_JOB_DONE = ".done"
+FILE_NAME_COMMAND_LOG = "pipeline"
+FILE_ENDING_COMMAND_LOG = "_commands.log"
 
 # files
 FILE_PATTERN_R1_FASTQ_GZ = "*_R1*.fastq.gz"
@@ -82,6 +94,7 @@ FILE_ENDING_FASTQC_HTML = "_fastqc.html"
 FILE_ENDING_SAM = ".sam"
 FILE_ENDING_BAM = ".bam"
 FILE_ENDING_BAI = ".bai"
+FILE_ENDINGS_BWA_INDEX = [".amb", ".ann", ".bwt", ".pac", ".sa"]
 FILE_ENDING_SORTED_BAM = "_sorted.bam"
 FILE_ENDING_SORTED_BAI = "_sorted.bai"
 FILE_ENDING_CSV = ".csv"
@@ -91,19 +104,25 @@ FILE_ENDING_TXT = ".txt"
 FILE_ENDING_PNG = ".png"
 FILE_ENDING_HTML = ".html"
 FILE_ENDING_SAMTOOLS_DEPTH_TSV = f"_samtools_depth{FILE_ENDING_TSV}"
+FILE_ENDING_DEPTH_STORE_NPY = "_depth.npy"
+FILE_ENDING_DEPTH_STORE_INDEX_JSON = "_depth_index.json"
 FILE_ENDING_EXTENDED_COVERAGE_ANALYSIS_CSV = f"_extended_coverage_analysis{FILE_ENDING_CSV}"
 FILE_ENDING_COMBINED_COVERAGE_ANALYSIS_CSV = f"_combined_coverage_analysis{FILE_ENDING_CSV}"
 FILE_ENDING_COMBINED_COVERAGE_ANALYSIS_DETAILED_CSV = f"_combined_coverage_analysis_detailed{FILE_ENDING_CSV}"
+FILE_ENDING_BINNED_COVERAGE_ANALYSIS_CSV = f"_binned_coverage_analysis{FILE_ENDING_CSV}"
+FILE_ENDING_COMBINED_COVERAGE_ANALYSIS_BINNED_CSV = f"_combined_coverage_analysis_binned{FILE_ENDING_CSV}"
 FILE_ENDING_READS_PROCESSING_RESULT_TSV = f"_reads_processing_result{FILE_ENDING_TSV}"
 FILE_ENDING_READ_LENGTH_DISTRIBUTION_TSV = f"_read_length_distribution{FILE_ENDING_TSV}"
 FILE_ENDING_CENTRIFUGE_OUTPUT_TXT = f"_centrifuge_output{FILE_ENDING_TXT}"
 FILE_ENDING_CENTRIFUGE_REPORT_TSV = f"_centrifuge_report{FILE_ENDING_TSV}"
 FILE_ENDING_CENTRIFUGE_TAXON_COUNTS_TXT = f"_centrifuge_taxon_counts{FILE_ENDING_TXT}"
 FILE_ENDING_KRAKEN_REPORT_TSV = f"_kraken_report{FILE_ENDING_TSV}"
+FILE_ENDING_KRAKEN_SUMMARY_REPORT_TSV = f"_kraken_summary_report{FILE_ENDING_TSV}"
 FILE_ENDING_KRAKEN_TOP5_ANALYSIS_TSV = f"_kraken2_top5_analysis{FILE_ENDING_TSV}"
 FILE_ENDING_KRAKEN_ALL_READS_COMBINED_ANALYSIS_CSV = f"_kraken2_all_reads_combined_analysis{FILE_ENDING_CSV}"
 FILE_ENDING_KRAKEN_BY_INDIVIDUAL_COMBINED_ANALYSIS_CSV = f"_kraken2_by_individual_combined_analysis{FILE_ENDING_CSV}"
 FILE_ENDING_KRAKEN_BY_PROTOCOL_COMBINED_ANALYSIS_CSV = f"_kraken2_by_protocol_combined_analysis{FILE_ENDING_CSV}"
+FILE_ENDING_UNMAPPED_READS_CLASSIFICATION_CSV = f"_unmapped_reads_classification{FILE_ENDING_CSV}"
 
 
 FILE_ENDING_ENDOGENOUS_READS_CSV = f"_endogenous_reads{FILE_ENDING_CSV}"
@@ -0,0 +1,377 @@
+import os
+import sys
+import json
+import glob
+import shlex
+import time
+import shutil
+import signal
+import resource
+import subprocess
+import multiprocessing
+from typing import Optional
+
+import common.common_logging as common_logging
+from common.common_constants import *
+from common.common_config import get_config_value
+from common.common_config_enumerations import ConfigSettings, SchedulerSettings, BatchSettings
+from common.common_folder_functions import get_folder_path_logs
+from common.common_resources import ENV_TASK_THREADS, set_task_threads, get_task_threads
+from common.common_helper_functions import CommandKilledError, EXIT_CODE_KILLED, was_command_killed
+from common.common_metrics import METRICS_KIND_TASK, set_task_name, measure_resource_usage, get_file_name_for_task
+
+# seconds between two checks for finished batch jobs
+DEFAULT_BATCH_POLL_INTERVAL = 30
+
+# hours after its submission a batch job without marker is given up and cancelled
+DEFAULT_BATCH_TIMEOUT_HOURS = 168
+
+# seconds a job that ended is given to write its marker, e.g. until it is visible on a network file system
+BATCH_MARKER_GRACE_PERIOD = 60
+
+# Slurm states of jobs that ended. Other states (PENDING, RUNNING, COMPLETING, ...) are still active
+BATCH_JOB_STATES_ENDED = ['COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE']
+
+# jobs that ended in these states without marker are reported as killed, so the scheduler retries them
+BATCH_JOB_STATES_KILLED = ['OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL']
+
+# entry point called by the batch jobs
+FILE_PATH_PIPELINE_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pipeline_aDNA.py")
+
+def get_peak_memory_mb() -> int:
+    # peak memory of the current process and the tools it ran (ru_maxrss is in KB)
+    peak_memory_kb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak_memory_kb // 1024
+
+def get_signal_exit_code(exit_code: int) -> int:
+    # the shell reports a killed process as 128 + signal, like multiprocessing use the negative signal
+    return -(exit_code - 128) if exit_code > 128 else exit_code
+
+def execute_task(task, threads: int):
+    """
+    Runs the function of the task in the current process with the given number of threads.
+    Used by all executors, so a task behaves the same locally and in a batch job.
+    """
+    set_task_threads(threads)
+    set_task_name(task.name)
+    common_logging.print_info(f"[PID {os.getpid()}] Starting task {task.name} with {threads} threads")
+
+    input_files = [path for pattern in task.inputs for path in glob.glob(pattern)]
+    with measure_resource_usage(task.name, METRICS_KIND_TASK, input_files) as output_files:
+        task.function(*task.args)
+        output_files.extend(path for pattern in task.outputs for path in glob.glob(pattern))
+
+#####################
+# Local executor
+#####################
+
+def _execute_task_in_process(task, threads: int, usage_writer):
+    # runs inside the forked process. Exceptions lead to a non-zero exit code
+    try:
+        execute_task(task, threads)
+    except CommandKilledError:
+        # reported below, the error report of the command was already printed
+        pass
+    finally:
+        # report the peak memory of the task and the tools it ran
+        usage_writer.send(get_peak_memory_mb())
+        usage_writer.close()
+
+    # the OOM killer usually kills the tool and not the task, report it like a killed task so it is retried
+    if was_command_killed():
+        sys.exit(EXIT_CODE_KILLED)
+
+def read_peak_memory(usage_reader) -> Optional[int]:
+    # a killed task did not report its memory usage
+    try:
+        return usage_reader.recv() if usage_reader.poll() else None
+    except EOFError:
+        return None
+    finally:
+        usage_reader.close()
+
+class LocalTaskExecution:
+    """
+    A task running in a forked process on this machine.
+    """
+
+    def __init__(self, process, usage_reader):
+        self.process = process
+        self.usage_reader = usage_reader
+        self.peak_memory_mb = None
+
+    @property
+    def sentinel(self):
+        # becomes ready when the process ends, used to wait for several tasks at once
+        return self.process.sentinel
+
+    def poll(self) -> Optional[int]:
+        """
+        Returns the exit code of the task, or None if it is still running.
+        A negative exit code is the signal the process was killed with.
+        """
+        if self.process.is_alive():
+            return None
+
+        self.process.join()
+        self.peak_memory_mb = read_peak_memory(self.usage_reader)
+        return get_signal_exit_code(self.process.exitcode)
+
+class LocalExecutor:
+    """
+    Runs each task in its own forked process. The scheduler limits the number of
+    processes running at the same time, so together they act as a process pool.
+    """
+    is_local = True
+
+    def __init__(self):
+        self.context = multiprocessing.get_context('fork')
+
+    def submit(self, task, threads: int, memory_mb: int = 0) -> LocalTaskExecution:
+        usage_reader, usage_writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=_execute_task_in_process, args=(task, threads, usage_writer), name=task.name)
+        process.start()
+        usage_writer.close()
+
+        return LocalTaskExecution(process, usage_reader)
+
+#####################
+# Batch executor
+#####################
+
+def get_folder_path_batch_jobs() -> str:
+    folder_path = os.path.join(get_folder_path_logs(), FOLDER_BATCH_JOBS)
+    os.makedirs(folder_path, exist_ok=True)
+    return folder_path
+
+def get_batch_job_file_prefix(task_name: str) -> str:
+    return os.path.join(get_folder_path_batch_jobs(), get_file_name_for_task(task_name))
+
+def get_batch_job_marker_path(task_name: str) -> str:
+    return get_batch_job_file_prefix(task_name) + FILE_ENDING_BATCH_JOB_DONE
+
+def write_batch_job_marker(task_name: str, exit_code: int, peak_memory_mb: Optional[int] = None):
+    marker_path = get_batch_job_marker_path(task_name)
+
+    # written under a temporary name, so the scheduler never reads a partial marker
+    temp_marker_path = marker_path + ".tmp"
+    with open(temp_marker_path, 'w') as f:
+        json.dump({'exit_code': exit_code, 'peak_memory_mb': peak_memory_mb}, f)
+    os.replace(temp_marker_path, marker_path)
+
+def run_batch_task(task) -> int:
+    """
+    Runs a task inside a batch job and writes the marker the scheduler waits for.
+    The threads of the task are given by the job script. Returns the exit code.
+    """
+    exit_code = 1
+    try:
+        execute_task(task, get_task_threads())
+        exit_code = 0
+    except Exception as e:
+        common_logging.print_error(f"Task {task.name} failed: {e}")
+    finally:
+        # a killed tool is reported like a killed job, so the scheduler retries the task
+        if was_command_killed():
+            exit_code = EXIT_CODE_KILLED
+        write_batch_job_marker(task.name, exit_code, get_peak_memory_mb())
+
+    return exit_code
+
+def get_batch_job_state(job_id: str) -> Optional[str]:
+    """
+    Slurm state of a job, e.g. RUNNING or OUT_OF_MEMORY, from sacct or, without accounting, from squeue.
+    Returns None if the state is unknown, e.g. without Slurm or before the job shows up in the accounting.
+    """
+    commands = [
+        ["sacct", "-n", "-X", "-P", "-j", job_id, "--format=State"],
+        ["squeue", "-h", "-j", job_id, "-o", "%T"],
+    ]
+
+    for command in commands:
+        if shutil.which(command[0]) is None:
+            continue
+
+        try:
+            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=60)
+        except Exception as e:
+            common_logging.print_debug(f"Could not determine the state of batch job {job_id} with {command[0]}: {e}")
+            continue
+
+        # e.g. "CANCELLED by 1234"
+        states = result.stdout.split()
+        if result.returncode == 0 and states:
+            return states[0].rstrip("+")
+
+    return None
+
+def cancel_batch_job(job_id: str):
+    if shutil.which("scancel") is None:
+        return
+
+    subprocess.run(["scancel", job_id], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+class BatchTaskExecution:
+    """
+    A task submitted as batch job. It is finished when the job wrote its marker file.
+    A job that ended without marker, e.g. killed by Slurm for its memory or time limit, is
+    detected through its job state. A job without marker after the timeout is cancelled.
+    """
+
+    def __init__(self, job_id: Optional[str], marker_path: str, timeout_hours: float = DEFAULT_BATCH_TIMEOUT_HOURS):
+        self.job_id = job_id
+        self.marker_path = marker_path
+        self.peak_memory_mb = None
+        self.submitted_at = time.time()
+        self.timeout_hours = timeout_hours
+        # time the job was first seen as ended without marker
+        self.ended_at = None
+
+    @property
+    def sentinel(self):
+        # batch jobs can not be waited for, they are polled
+        return None
+
+    def poll(self) -> Optional[int]:
+        if not os.path.exists(self.marker_path):
+            return self.poll_job_state()
+
+        try:
+            with open(self.marker_path, 'r') as f:
+                marker = json.load(f)
+        except Exception as e:
+            common_logging.print_error(f"Could not read marker {self.marker_path} of batch job {self.job_id}: {e}")
+            return 1
+
+        self.peak_memory_mb = marker.get('peak_memory_mb')
+        exit_code = int(marker.get('exit_code', 1))
+
+        return get_signal_exit_code(exit_code)
+
+    def poll_job_state(self) -> Optional[int]:
+        # exit code of a job that ended or timed out without marker, None while it is active
+        if self.timeout_hours and time.time() - self.submitted_at > self.timeout_hours * 3600:
+            common_logging.print_error(f"Batch job {self.job_id} did not finish within {self.timeout_hours} hours. Cancelling it.")
+            if self.job_id:
+                cancel_batch_job(self.job_id)
+            return 1
+
+        state = get_batch_job_state(self.job_id) if self.job_id else None
+
+        if state not in BATCH_JOB_STATES_ENDED:
+            return None
+
+        # the marker of a job that just ended may not be visible yet
+        if self.ended_at is None:
+            self.ended_at = time.time()
+        if time.time() - self.ended_at < BATCH_MARKER_GRACE_PERIOD:
+            return None
+
+        common_logging.print_error(f"Batch job {self.job_id} ended with state {state} without writing its marker {self.marker_path}")
+
+        return -signal.SIGKILL if state in BATCH_JOB_STATES_KILLED else 1
+
+class BatchExecutor:
+    """
+    Submits each task as job through an sbatch compatible command. The job runs
+    pipeline_aDNA.py --run-task <task name>, which writes a marker file once the task is finished.
+    """
+    is_local = False
+
+    def __init__(self, submit_command: str = "sbatch", options: Optional[list] = None, poll_interval: int = DEFAULT_BATCH_POLL_INTERVAL,
+                 timeout_hours: float = DEFAULT_BATCH_TIMEOUT_HOURS):
+        self.submit_command = shlex.split(submit_command)
+        self.options = options or []
+        self.poll_interval = poll_interval
+        self.timeout_hours = timeout_hours
+
+    def write_job_script(self, task, threads: int) -> str:
+        file_prefix = get_batch_job_file_prefix(task.name)
+        marker_path = get_batch_job_marker_path(task.name)
+        job_script_path = file_prefix + FILE_ENDING_BATCH_JOB_SCRIPT
+
+        # the shell writes the marker if python was killed before it could
+        job_script = "\n".join([
+            "#!/bin/bash",
+            f"cd {shlex.quote(os.getcwd())}",
+            f"export {ENV_TASK_THREADS}={threads}",
+            f"{shlex.quote(sys.executable)} {shlex.quote(FILE_PATH_PIPELINE_SCRIPT)} --run-task {shlex.quote(task.name)}",
+            "exit_code=$?",
+            f"if [ ! -f {shlex.quote(marker_path)} ]; then",
+            f"    echo \"{{\\\"exit_code\\\": $exit_code}}\" > {shlex.quote(marker_path)}",
+            "fi",
+            "exit $exit_code",
+            "",
+        ])
+
+        with open(job_script_path, 'w') as f:
+            f.write(job_script)
+        os.chmod(job_script_path, 0o755)
+
+        return job_script_path
+
+    def submit(self, task, threads: int, memory_mb: int = 0) -> BatchTaskExecution:
+        marker_path = get_batch_job_marker_path(task.name)
+
+        # a marker of an earlier run would finish the task immediately
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+
+        job_script_path = self.write_job_script(task, threads)
+
+        command = self.submit_command + [
+            f"--job-name={task.step}",
+            f"--cpus-per-task={threads}",
+            f"--output={get_batch_job_file_prefix(task.name)}{FILE_ENDING_BATCH_JOB_LOG}",
+        ]
+        if memory_mb:
+            command.append(f"--mem={memory_mb}M")
+        command += self.options + [job_script_path]
+
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+        if result.returncode != 0:
+            raise RuntimeError(f"Submitting task {task.name} failed: {result.stderr.strip()}")
+
+        # sbatch prints "Submitted batch job <id>"
+        job_id = result.stdout.strip().split()[-1] if result.stdout.strip() else None
+        common_logging.print_info(f"Submitted task {task.name} as batch job {job_id}")
+
+        return BatchTaskExecution(job_id, marker_path, self.timeout_hours)
+
+#####################
+# Executor selection
+#####################
+
+def get_batch_settings() -> dict:
+    batch_settings = get_config_value(ConfigSettings.SCHEDULER.value, SchedulerSettings.BATCH.value, default={})
+    return batch_settings if isinstance(batch_settings, dict) else {}
+
+def get_batch_executor() -> BatchExecutor:
+    batch_settings = get_batch_settings()
+
+    poll_interval = batch_settings.get(BatchSettings.POLL_INTERVAL.value, DEFAULT_BATCH_POLL_INTERVAL)
+    if not isinstance(poll_interval, (int, float)) or poll_interval <= 0:
+        poll_interval = DEFAULT_BATCH_POLL_INTERVAL
+
+    timeout_hours = batch_settings.get(BatchSettings.TIMEOUT_HOURS.value, DEFAULT_BATCH_TIMEOUT_HOURS)
+    if not isinstance(timeout_hours, (int, float)) or timeout_hours < 0:
+        timeout_hours = DEFAULT_BATCH_TIMEOUT_HOURS
+
+    return BatchExecutor(
+        submit_command=batch_settings.get(BatchSettings.SUBMIT_COMMAND.value, "sbatch"),
+        options=batch_settings.get(BatchSettings.OPTIONS.value, []),
+        poll_interval=poll_interval,
+        timeout_hours=timeout_hours)
+
+def get_max_batch_jobs() -> Optional[int]:
+    # number of batch jobs submitted at the same time. None means no limit
+    max_jobs = get_batch_settings().get(BatchSettings.MAX_JOBS.value)
+    return max_jobs if isinstance(max_jobs, int) and max_jobs > 0 else None
+
+def get_batch_task_keys() -> list:
+    # tools (e.g. bwa_mem, kraken) or steps whose tasks are sent to the batch system
+    batch_task_keys = get_batch_settings().get(BatchSettings.TASKS.value, [])
+    return batch_task_keys if isinstance(batch_task_keys, list) else []
@@ -185,6 +185,16 @@ def get_folder_path_species_processed_qc_kraken(species: str) -> str:
     check_folder_exists_or_create(path)
     return path
 
+def get_folder_path_species_processed_qc_centrifuge_unmapped_reads(species: str) -> str:
+    path = os.path.join(get_folder_path_species_processed_qc_centrifuge(species), FOLDER_UNMAPPED_READS)
+    check_folder_exists_or_create(path)
+    return path
+
+def get_folder_path_species_processed_qc_kraken_unmapped_reads(species: str) -> str:
+    path = os.path.join(get_folder_path_species_processed_qc_kraken(species), FOLDER_UNMAPPED_READS)
+    check_folder_exists_or_create(path)
+    return path
+
 def get_folder_path_species_processed_prepared_for_ref_genome(species: str) -> str:
     path = os.path.join(get_folder_path_species_processed(species), FOLDER_PREPARED_FOR_REF_GENOME)
     check_folder_exists_or_create(path)
@@ -255,6 +265,11 @@ def get_folder_path_species_results_qc_centrifuge(species: str) -> str:
     check_folder_exists_or_create(path)
     return path
 
+def get_folder_path_species_results_qc_centrifuge_unmapped_reads(species: str) -> str:
+    path = os.path.join(get_folder_path_species_results_qc_centrifuge(species), FOLDER_UNMAPPED_READS)
+    check_folder_exists_or_create(path)
+    return path
+
 def get_folder_path_species_results_qc_ecmsd(species: str) -> str:
     path = os.path.join(get_folder_path_species_results_qc(species), FOLDER_ECMSD)
     check_folder_exists_or_create(path)
@@ -265,6 +280,11 @@ def get_folder_path_species_results_qc_kraken(species: str) -> str:
     check_folder_exists_or_create(path)
     return path
 
+def get_folder_path_species_results_qc_kraken_unmapped_reads(species: str) -> str:
+    path = os.path.join(get_folder_path_species_results_qc_kraken(species), FOLDER_UNMAPPED_READS)
+    check_folder_exists_or_create(path)
+    return path
+
 def get_folder_path_species_results_qc_fastqc(species: str) -> str:
     path = os.path.join(get_folder_path_species_results_qc(species), FOLDER_FASTQC)
     check_folder_exists_or_create(path)
@@ -1,12 +1,30 @@
 import os
+import signal
 import subprocess
 import glob
-from typing import Optional
+import threading
+from collections import deque
+from datetime import datetime
+from contextlib import contextmanager
+from typing import Callable, Optional
 
 from common.common_constants import *
 from common.common_logging import *
 from common.common_config import *
 from common.common_folder_functions import *
+from common.common_metrics import run_process_with_metrics, run_piped_processes_with_metrics, get_file_path_command_log
+
+# number of output lines of a command kept for error reports
+COMMAND_OUTPUT_TAIL_LINES = 50
+
+# buffer size of the pipes of commands whose input and output are passed through python
+STREAMING_BUFFER_SIZE = 1024 * 1024
+
+# a shell reports a child killed by a signal as 128 + signal
+EXIT_CODE_KILLED = 128 + signal.SIGKILL
+
+# set when a command of this process was killed, even if the step handled the error
+_command_killed = False
 
 #####################
 # Helpers
@@ -62,7 +80,7 @@ def call_r_script(script_path: str, *args):
 
     command = ["Rscript", script_path] + list(args)
 
-    run_command(command, description=f"R script: {script_path}")
+    run_command(command, description=f"R script: {script_path}", capture_output=False)
 
     # print_debug(f"Executing command: {' '.join(command)}")
 
@@ -188,54 +206,293 @@ def get_raw_paired_reads_list_of_species(species: str) -> list:
 
     return file_paths
 
-def run_command(command: list, description: str = "", cwd: Optional[str] = None, throw_error: bool = False) -> str:
+#####################
+# Atomic output
+#####################
+
+def get_temp_file_path(file_path: str) -> str:
     """
-    Run a shell command and return its stdout output.
+    Temporary path an output is written to before it is renamed to its final path.
+    The file stays in the same folder, so the rename is atomic, and keeps its file ending,
+    as some tools (e.g. fastp, samtools) derive the output format from it.
+    The leading dot hides it from the glob patterns used to find the outputs of a step.
+    """
+    folder_path, file_name = os.path.split(file_path)
+    return os.path.join(folder_path, f".tmp.{file_name}")
+
+def remove_file_if_exists(file_path: str):
+    try:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    except Exception as e:
+        print_warning(f"Failed to remove file {file_path}: {e}")
+
+@contextmanager
+def atomic_output(*file_paths: str):
+    """
+    Write one or more output files atomically.
+    The temporary paths are yielded (a single path if one file is given). If the block
+    completes, each existing temporary file is renamed to its final path. If it fails,
+    the temporary files are removed, so a killed or failed step never leaves a partial output.
+
+    The files are renamed in reverse order, so the first file appears last. Steps that skip
+    based on the existence of their first output therefore never see an incomplete set.
+
+    Usage:
+        with atomic_output(output_file_path) as temp_file_path:
+            run_command(f"... > {temp_file_path}")
+    """
+    temp_file_paths = [get_temp_file_path(file_path) for file_path in file_paths]
+
+    # leftovers of a previous run that was killed
+    for temp_file_path in temp_file_paths:
+        remove_file_if_exists(temp_file_path)
+
+    try:
+        yield temp_file_paths[0] if len(temp_file_paths) == 1 else temp_file_paths
+    except BaseException:
+        for temp_file_path in temp_file_paths:
+            remove_file_if_exists(temp_file_path)
+        raise
+
+    for temp_file_path, file_path in reversed(list(zip(temp_file_paths, file_paths))):
+        if os.path.exists(temp_file_path):
+            os.replace(temp_file_path, file_path)
+
+class CommandOutputLog:
+    """
+    Writes the output lines of commands to the command log of the task and to the pipeline log.
+    Only the last lines of each stream are kept for error reports, stdout is kept completely if captured.
+    """
+
+    def __init__(self, command_program: str, capture_stdout: bool = False):
+        self.command_program = command_program
+        self.file_path = get_file_path_command_log()
+        self.stdout_lines = [] if capture_stdout else None
+        self.stdout_tail = deque(maxlen=COMMAND_OUTPUT_TAIL_LINES)
+        self.stderr_tail = deque(maxlen=COMMAND_OUTPUT_TAIL_LINES)
+        self.lock = threading.Lock()
+        self.file = None
+
+    def __enter__(self):
+        # line buffered, so the log can be followed while the command runs
+        self.file = open(self.file_path, 'a', buffering=1)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+
+    def write(self, text: str):
+        with self.lock:
+            self.file.write(f"{text}\n")
+
+    def log_line(self, line: str, tail: deque, program: str, stream_name: str):
+        line = line.rstrip("\n")
+        tail.append(line)
+        self.write(f"[{program} {stream_name}] {line}")
+        print_info(f"[{program}] {line}")
+
+    def handle_stdout_line(self, line: str):
+        if self.stdout_lines is not None:
+            self.stdout_lines.append(line)
+        self.log_line(line, self.stdout_tail, self.command_program, "stdout")
+
+    def get_stderr_handler(self, program: Optional[str] = None):
+        return lambda line: self.log_line(line, self.stderr_tail, program or self.command_program, "stderr")
+
+    @property
+    def stdout(self) -> str:
+        return "".join(self.stdout_lines) if self.stdout_lines is not None else "\n".join(self.stdout_tail)
+
+    @property
+    def stderr(self) -> str:
+        return "\n".join(self.stderr_tail)
+
+    def print_error_report(self, reason: str):
+        print_error(f"[{self.command_program}] Command failed with {reason}. Full output: {self.file_path}")
+
+        for line in self.stderr_tail:
+            print_error(f"[{self.command_program}] {line}")
+
+class CommandKilledError(subprocess.CalledProcessError):
+    """
+    A command killed with SIGKILL, usually by the OOM killer. The scheduler retries its task with more memory.
+    """
+
+def was_command_killed() -> bool:
+    return _command_killed
+
+def get_command_error(exit_code: int, command, output: str, stderr: str, shell: bool = False) -> subprocess.CalledProcessError:
+    """
+    The error of a failed command. A killed command is remembered, so the task is reported as killed
+    even if its step catches the error and returns.
+    """
+    global _command_killed
+
+    if exit_code == -signal.SIGKILL or (shell and exit_code == EXIT_CODE_KILLED):
+        _command_killed = True
+        return CommandKilledError(exit_code, command, output=output, stderr=stderr)
+
+    return subprocess.CalledProcessError(exit_code, command, output=output, stderr=stderr)
+
+def get_command_program(command_text: str) -> str:
+    return os.path.basename(command_text.split()[0]) if command_text.strip() else "Unknown"
+
+def run_command(command: list | str, description: str = "", cwd: Optional[str] = None, throw_error: bool = False, shell: Optional[bool] = None, capture_output: bool = False) -> str:
+    """
+    Run a command and return its stdout output, if captured.
+    stdout and stderr are streamed line by line to the command log of the task and to the pipeline log,
+    so the output of long running tools is visible while they run. Only the last lines are kept for error reports.
+    Wall time, CPU time, peak memory and I/O of the command are written to the metrics file of the run.
 
     Parameters:
-        command (list): The command and arguments to execute.
+        command (list | str): The command and arguments to execute, or a shell command string
+                              (e.g. with pipes or redirections).
         description (str): Optional description for logging.
         cwd (str, optional): Working directory to execute the command in.
+        throw_error (bool): Raise an error if the command wrote to stderr.
+        shell (bool, optional): Run the command through the shell. Defaults to True for strings.
+        capture_output (bool): Keep stdout in memory and return it. Only for commands whose output
+                               is parsed, otherwise only the last lines are kept, so the memory is bounded.
 
     Returns:
-        str: Captured stdout output.
+        str: Captured stdout output, or an empty string if capture_output is False.
 
     Raises:
-        subprocess.CalledProcessError: If the command fails.
+        subprocess.CalledProcessError: If the command fails. stdout and stderr of the error contain
+                                       the last lines of the output. CommandKilledError if it was killed.
     """
     print_debug("Entering run_command function")
 
-    command_program = command[0] if command else "Unknown"
+    if shell is None:
+        shell = isinstance(command, str)
 
-    print_info(f"Running: {description or ' '.join(command)}")
+    command_text = command if isinstance(command, str) else ' '.join(command)
+    command_program = get_command_program(command_text)
+
+    print_info(f"Running: {description or command_text}")
     
     if cwd:
         print_debug(f"Working directory: {cwd}")
 
-    result = subprocess.run(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        check=True,
-        cwd=cwd
-    )
+    with CommandOutputLog(command_program, capture_stdout=capture_output) as output_log:
 
-    if result.stdout:
-        for line in result.stdout.splitlines():
-            print_info(f"[{command_program}] {line.strip()}")
+        output_log.write(f"# {datetime.now().isoformat(timespec='seconds')} Running: {command_text}")
 
-    if result.stderr and throw_error:
-        print_error(f"[{command_program}] Command failed with error:")
-        
-        for line in result.stderr.splitlines():
-            print_error(f"[{command_program}] {line.strip()}")
-        
-        raise subprocess.CalledProcessError(result.returncode, command, output=result.stdout, stderr=result.stderr)
+        returncode, _, _ = run_process_with_metrics(
+            command,
+            description or command_text,
+            stdout_handler=output_log.handle_stdout_line,
+            stderr_handler=output_log.get_stderr_handler(),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            cwd=cwd,
+            shell=shell
+        )
 
-    if result.stderr:
-        for line in result.stdout.splitlines():
-            print_warning(f"[{command_program}] {line.strip()}")
+        output_log.write(f"# Exit code: {returncode}")
+
+    if returncode != 0 or (output_log.stderr_tail and throw_error):
+        output_log.print_error_report(f"exit code {returncode}" if returncode != 0 else "output on stderr")
+        raise get_command_error(returncode, command, output_log.stdout, output_log.stderr, shell=shell)
+
+    print_info(f"{command_program} completed successfully")
+    return output_log.stdout.strip() if capture_output else ""
+
+def run_piped_commands(commands: list[list], description: str = "", cwd: Optional[str] = None) -> str:
+    """
+    Run commands connected by pipes, like "command1 | command2 | command3" in the shell, but without
+    a shell. The data passed between the commands never touches the disk.
+    Like with "set -o pipefail", the pipe fails if any of the commands fails.
+
+    Parameters:
+        commands (list): The commands, each as list of the program and its arguments.
+        description (str): Optional description for logging.
+        cwd (str, optional): Working directory to execute the commands in.
+
+    Returns:
+        str: The last lines of the stdout output of the last command.
+
+    Raises:
+        subprocess.CalledProcessError: If one of the commands fails.
+    """
+    command_texts = [' '.join(command) for command in commands]
+    pipe_text = ' | '.join(command_texts)
+    command_programs = [get_command_program(command_text) for command_text in command_texts]
+
+    print_info(f"Running: {description or pipe_text}")
+
+    with CommandOutputLog(command_programs[-1]) as output_log:
+
+        output_log.write(f"# {datetime.now().isoformat(timespec='seconds')} Running: {pipe_text}")
+
+        exit_codes = run_piped_processes_with_metrics(
+            commands,
+            description or pipe_text,
+            stdout_handler=output_log.handle_stdout_line,
+            stderr_handlers=[output_log.get_stderr_handler(f"{program} #{index + 1}") for index, program in enumerate(command_programs)],
+            cwd=cwd
+        )
+
+        output_log.write(f"# Exit codes: {exit_codes}")
+
+    failed_commands = [(command, exit_code) for command, exit_code in zip(commands, exit_codes) if exit_code != 0]
+
+    if failed_commands:
+        # the first failing command is the cause, the following ones usually fail because their input ended
+        command, exit_code = failed_commands[0]
+        output_log.print_error_report(f"exit code {exit_code} of {get_command_program(' '.join(command))}")
+        raise get_command_error(exit_code, command, output_log.stdout, output_log.stderr)
+
+    print_info(f"{' | '.join(command_programs)} completed successfully")
+    return output_log.stdout.strip()
+
+def run_streaming_command(command: list, stdin_writer: Callable, stdout_handler: Callable, description: str = "", cwd: Optional[str] = None):
+    """
+    Run a command whose input is written and whose output is read by python while it runs,
+    e.g. to pass the reads of several files to one process and split its output again.
+    stdin and stdout are binary, stderr is streamed to the command log like with run_command.
+
+    Parameters:
+        command (list): The program and its arguments.
+        stdin_writer (Callable): Called with the stdin of the command (binary), stdin is closed when it returns.
+        stdout_handler (Callable): Called for each line of the stdout of the command (bytes).
+        description (str): Optional description for logging.
+        cwd (str, optional): Working directory to execute the command in.
+
+    Raises:
+        subprocess.CalledProcessError: If the command fails.
+    """
+    command_text = ' '.join(command)
+    command_program = get_command_program(command_text)
+
+    print_info(f"Running: {description or command_text}")
+
+    with CommandOutputLog(command_program) as output_log:
+
+        output_log.write(f"# {datetime.now().isoformat(timespec='seconds')} Running: {command_text}")
+
+        stderr_handler = output_log.get_stderr_handler()
+
+        returncode, _, _ = run_process_with_metrics(
+            command,
+            description or command_text,
+            stdout_handler=stdout_handler,
+            stderr_handler=lambda line: stderr_handler(line.decode(errors='replace')),
+            stdin_writer=stdin_writer,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            # large buffers, the reads pass through the pipes
+            bufsize=STREAMING_BUFFER_SIZE,
+            cwd=cwd
+        )
+
+        output_log.write(f"# Exit code: {returncode}")
+
+    if returncode != 0:
+        output_log.print_error_report(f"exit code {returncode}")
+        raise get_command_error(returncode, command, "", output_log.stderr)
 
     print_info(f"{command_program} completed successfully")
-    return result.stdout.strip()
@@ -0,0 +1,38 @@
+import importlib
+
+class LazyStepFunction:
+    """
+    Function of a step module that is imported on its first call.
+    __module__ and __name__ are the ones of the real function, so task names and
+    the parameters recorded in the pipeline manifest do not change.
+    """
+
+    def __init__(self, module_name: str, function_name: str):
+        self.__module__ = module_name
+        self.__name__ = function_name
+        self.__qualname__ = function_name
+
+    def __call__(self, *args, **kwargs):
+        function = getattr(importlib.import_module(self.__module__), self.__name__)
+        return function(*args, **kwargs)
+
+    def __repr__(self) -> str:
+        return f"<step function {self.__module__}.{self.__name__}>"
+
+class LazyStepModule:
+    """
+    Placeholder for a step module. Accessing a function returns a LazyStepFunction,
+    so the pipeline can be set up (e.g. to build the task graph or show the status)
+    without importing the step modules and their dependencies (pandas, pysam, Biopython).
+    """
+
+    def __init__(self, module_name: str):
+        self.module_name = module_name
+
+    def __getattr__(self, name: str) -> LazyStepFunction:
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return LazyStepFunction(self.module_name, name)
+
+    def __repr__(self) -> str:
+        return f"<lazy step module {self.module_name}>"
@@ -1,3 +1,4 @@
+import os
 import logging
 
 #####################
@@ -15,6 +16,18 @@ logging.basicConfig(  # Basic config ASAP (for fallback)
     handlers=[logging.StreamHandler()]  # Only console for now
 )
 
+class LazyFileHandler(logging.FileHandler):
+    """
+    File handler that creates the log file, and its folder, only when the first record is written.
+    """
+
+    def __init__(self, filename: str):
+        super().__init__(filename, delay=True)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
 def print_command(subprocess_command: list):  # 🚀 Used for subprocess command execution
     command = ' '.join(subprocess_command)
     logging.info(f"🚀  {command}")
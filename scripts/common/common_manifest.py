@@ -0,0 +1,200 @@
+import os
+import glob
+import json
+import hashlib
+import sqlite3
+import subprocess
+from datetime import datetime
+from typing import Optional
+
+from common.common_constants import *
+from common.common_logging import *
+from common.common_config import *
+from common.common_config_enumerations import ConfigSettings, SchedulerSettings
+
+# how input and output files are compared between runs
+FINGERPRINT_MODE_MTIME = 'mtime'  # file size and modification time
+FINGERPRINT_MODE_HASH = 'hash'    # sha256 of the file content
+
+# program used to determine the version of the tool of a task
+TOOL_PROGRAM_PATHS = {
+    'fastp': PROGRAM_PATH_FASTP,
+    'fastqc': PROGRAM_PATH_FASTQC,
+    'multiqc': PROGRAM_PATH_MULTIQC,
+    'kraken': PROGRAM_PATH_KRAKEN,
+    'centrifuge': PROGRAM_PATH_CENTRIFUGE,
+    'bwa_index': PROGRAM_PATH_BWA,
+    'bwa_mem': PROGRAM_PATH_BWA,
+    'mapdamage': PROGRAM_PATH_MAPDAMAGE,
+}
+
+# seconds to wait for a write lock of another process on the manifest database
+DATABASE_LOCK_TIMEOUT = 60
+
+_tool_versions = {}
+
+def get_file_path_pipeline_manifest() -> str:
+    return os.path.join(PATH_ADNA_PROJECT, FILE_NAME_PIPELINE_MANIFEST)
+
+def is_manifest_enabled() -> bool:
+    return bool(get_config_value(ConfigSettings.SCHEDULER.value, SchedulerSettings.MANIFEST.value, default=True))
+
+def get_fingerprint_mode() -> str:
+    fingerprint_mode = get_config_value(ConfigSettings.SCHEDULER.value, SchedulerSettings.FINGERPRINT.value, default=FINGERPRINT_MODE_MTIME)
+
+    if fingerprint_mode not in (FINGERPRINT_MODE_MTIME, FINGERPRINT_MODE_HASH):
+        print_warning(f"Unknown fingerprint mode {fingerprint_mode}. Using {FINGERPRINT_MODE_MTIME}.")
+        return FINGERPRINT_MODE_MTIME
+
+    return fingerprint_mode
+
+def get_file_hash(file_path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def get_files_fingerprint(paths: list, fingerprint_mode: str = FINGERPRINT_MODE_MTIME) -> str:
+    """
+    Fingerprint of a list of file paths or glob patterns as JSON string.
+    Missing files are part of the fingerprint, so creating or deleting a file changes it.
+    """
+    fingerprint = {}
+
+    for path in paths:
+        matching_files = sorted(glob.glob(path))
+
+        if not matching_files:
+            fingerprint[path] = None
+            continue
+
+        for file_path in matching_files:
+            if not os.path.isfile(file_path):
+                continue
+
+            stat = os.stat(file_path)
+            if fingerprint_mode == FINGERPRINT_MODE_HASH:
+                fingerprint[file_path] = get_file_hash(file_path)
+            else:
+                fingerprint[file_path] = f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    return json.dumps(fingerprint, sort_keys=True)
+
+def get_tool_version(tool: Optional[str]) -> Optional[str]:
+    """
+    Version string of the tool of a task, e.g. "fastp 0.23.4". The result is cached per tool.
+    """
+    if tool not in TOOL_PROGRAM_PATHS:
+        return None
+
+    if tool in _tool_versions:
+        return _tool_versions[tool]
+
+    version = None
+    try:
+        result = subprocess.run([TOOL_PROGRAM_PATHS[tool], "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=60)
+        lines = [line.strip() for line in result.stdout.splitlines() if line.strip()]
+
+        # bwa has no --version option but prints its version in the usage
+        version_lines = [line for line in lines if line.lower().startswith("version")]
+        version = (version_lines or lines or [None])[0]
+    except Exception as e:
+        print_warning(f"Could not determine version of {tool}: {e}")
+
+    _tool_versions[tool] = version
+    return version
+
+def get_task_parameters(task) -> str:
+    # the arguments of the step function and the task parameters define what the task computes
+    parameters = {
+        'function': f"{task.function.__module__}.{task.function.__name__}",
+        'args': [repr(arg) for arg in task.args],
+        'parameters': task.parameters,
+    }
+    return json.dumps(parameters, sort_keys=True, default=str)
+
+class PipelineManifest:
+    """
+    Persistent record of the task runs of the pipeline, stored in a SQLite database.
+    For each task, the fingerprints of its inputs and outputs, its parameters and the
+    version of its tool are stored, so a later run can decide if the task is up to date.
+    The database also caches the statistics of scanned fastq files.
+    """
+
+    def __init__(self, database_path: str):
+        self.database_path = database_path
+        # the pool workers of the analyses write to the same database, so wait for locks
+        self.connection = sqlite3.connect(database_path, timeout=DATABASE_LOCK_TIMEOUT)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS task_runs (
+                task_name TEXT PRIMARY KEY,
+                stage TEXT,
+                step TEXT,
+                species TEXT,
+                sample TEXT,
+                reference_genome TEXT,
+                state TEXT,
+                input_fingerprint TEXT,
+                parameters TEXT,
+                tool_version TEXT,
+                output_fingerprint TEXT,
+                started_at TEXT,
+                finished_at TEXT,
+                duration REAL
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS fastq_stats (
+                file_path TEXT PRIMARY KEY,
+                fingerprint TEXT,
+                read_count INTEGER,
+                total_bases INTEGER,
+                gc_bases INTEGER,
+                quality_sum INTEGER,
+                length_histogram TEXT,
+                scanned_at TEXT
+            )
+        """)
+        self.connection.commit()
+
+    def get_task_record(self, task_name: str) -> Optional[sqlite3.Row]:
+        return self.connection.execute("SELECT * FROM task_runs WHERE task_name = ?", (task_name,)).fetchone()
+
+    def get_task_records(self) -> list[sqlite3.Row]:
+        return self.connection.execute("SELECT * FROM task_runs ORDER BY stage, step, task_name").fetchall()
+
+    def record_task(self, task, state: str, input_fingerprint: str, parameters: str, tool_version: Optional[str],
+                    output_fingerprint: Optional[str], started_at: datetime, duration: float):
+        self.connection.execute("""
+            INSERT OR REPLACE INTO task_runs (
+                task_name, stage, step, species, sample, reference_genome, state,
+                input_fingerprint, parameters, tool_version, output_fingerprint,
+                started_at, finished_at, duration
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            task.name, task.stage, task.step, task.species, task.sample, task.reference_genome, state,
+            input_fingerprint, parameters, tool_version, output_fingerprint,
+            started_at.isoformat(timespec='seconds'), datetime.now().isoformat(timespec='seconds'), duration
+        ))
+        self.connection.commit()
+
+    def get_fastq_stats(self, file_path: str, fingerprint: str) -> Optional[sqlite3.Row]:
+        # only statistics of the same file content are returned
+        return self.connection.execute("SELECT * FROM fastq_stats WHERE file_path = ? AND fingerprint = ?", (file_path, fingerprint)).fetchone()
+
+    def record_fastq_stats(self, file_path: str, fingerprint: str, read_count: int, total_bases: int, gc_bases: int,
+                           quality_sum: int, length_histogram: str):
+        self.connection.execute("""
+            INSERT OR REPLACE INTO fastq_stats (
+                file_path, fingerprint, read_count, total_bases, gc_bases, quality_sum, length_histogram, scanned_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            file_path, fingerprint, read_count, total_bases, gc_bases, quality_sum, length_histogram,
+            datetime.now().isoformat(timespec='seconds')
+        ))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
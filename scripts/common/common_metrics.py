@@ -0,0 +1,295 @@
+import os
+import re
+import json
+import hashlib
+import time
+import resource
+import functools
+import threading
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Optional
+
+from common.common_constants import *
+from common.common_logging import *
+import common.common_config as common_config
+from common.common_folder_functions import get_folder_path_logs
+
+# environment variable holding the name of the current scheduler task.
+# it is set in the task process, so all metrics of the task can be grouped.
+ENV_TASK_NAME = 'ADNA_TASK_NAME'
+
+# kind of a metrics record
+METRICS_KIND_TASK = 'task'          # a scheduler task, including everything it ran
+METRICS_KIND_COMMAND = 'command'    # an external program
+METRICS_KIND_FUNCTION = 'function'  # a python analysis function, including its pool workers
+
+def get_file_path_run_metrics() -> str:
+    # one metrics file per run, next to the log file of the run
+    return os.path.join(get_folder_path_logs(), f"{common_config.timestamp}{FILE_ENDING_RUN_METRICS_JSONL}")
+
+def get_file_name_for_task(task_name: str) -> str:
+    # task names contain characters like [ and , so a readable part and a hash are used
+    readable_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', task_name).strip('_')[:100]
+    name_hash = hashlib.sha1(task_name.encode()).hexdigest()[:8]
+    return f"{readable_name}_{name_hash}"
+
+def get_file_path_command_log() -> str:
+    """
+    Log file for the output of the external commands. Each scheduler task gets its own file,
+    commands run outside of a task share one file per run.
+    """
+    folder_path = os.path.join(get_folder_path_logs(), FOLDER_COMMAND_LOGS)
+    os.makedirs(folder_path, exist_ok=True)
+
+    task_name = get_task_name()
+    file_name = get_file_name_for_task(task_name) if task_name else FILE_NAME_COMMAND_LOG
+
+    return os.path.join(folder_path, f"{common_config.timestamp}_{file_name}{FILE_ENDING_COMMAND_LOG}")
+
+def set_task_name(task_name: str):
+    os.environ[ENV_TASK_NAME] = task_name
+
+def get_task_name() -> Optional[str]:
+    return os.environ.get(ENV_TASK_NAME)
+
+def get_file_arguments(arguments) -> list:
+    """
+    Returns the arguments that are paths of existing files.
+    Used to determine the input and output bytes of commands and functions.
+    """
+    return [argument for argument in arguments if isinstance(argument, str) and os.path.isfile(argument)]
+
+def get_files_size(file_paths: list) -> int:
+    size = 0
+    for file_path in file_paths:
+        try:
+            size += os.path.getsize(file_path)
+        except OSError:
+            pass
+    return size
+
+def write_metrics(kind: str, name: str, wall_time: float, user_time: float, system_time: float, max_rss_kb: int,
+                  block_input: int, block_output: int, input_bytes: int, output_bytes: int, exit_code: Optional[int]):
+    record = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'pid': os.getpid(),
+        'task': get_task_name(),
+        'kind': kind,
+        'name': name,
+        'wall_time_s': round(wall_time, 3),
+        'user_time_s': round(user_time, 3),
+        'system_time_s': round(system_time, 3),
+        'max_rss_mb': round(max_rss_kb / 1024, 1),       # ru_maxrss is in KB
+        'block_read_bytes': block_input * 512,            # ru_inblock/ru_oublock count 512 byte blocks
+        'block_write_bytes': block_output * 512,
+        'input_bytes': input_bytes,
+        'output_bytes': output_bytes,
+        'exit_code': exit_code,
+    }
+
+    try:
+        # records are short, so appends from parallel processes do not interleave
+        with open(get_file_path_run_metrics(), 'a') as f:
+            f.write(json.dumps(record) + "\n")
+    except Exception as e:
+        print_warning(f"Could not write metrics for {name}: {e}")
+
+def communicate_and_wait(process: subprocess.Popen, stdout_handler: Optional[Callable] = None, stderr_handler: Optional[Callable] = None, stdin_writer: Optional[Callable] = None) -> tuple[str, str, resource.struct_rusage]:
+    """
+    Reads stdout and stderr of the process like Popen.communicate, but reaps it with
+    os.wait4 to get the resource usage of the process and all processes it waited for.
+    If a handler is given for a stream, it is called for each line as soon as it is written
+    and the stream is not kept in memory (None is returned for it).
+    If a stdin writer is given, it is called with stdin of the process while the output is read,
+    stdin is closed when it returns. An exception of the writer is raised after the process ended.
+    """
+    output = {}
+    stdin_errors = []
+
+    def write_stream(stream, writer):
+        try:
+            writer(stream)
+        except BrokenPipeError:
+            # the process exited before it read all input, its exit code tells why
+            pass
+        except Exception as e:
+            stdin_errors.append(e)
+        finally:
+            try:
+                stream.close()
+            except BrokenPipeError:
+                pass
+
+    def read_stream(stream_name, stream, line_handler):
+        if stream is None:
+            output[stream_name] = None
+            return
+
+        if line_handler is None:
+            output[stream_name] = stream.read()
+        else:
+            for line in stream:
+                line_handler(line)
+            output[stream_name] = None
+
+        stream.close()
+
+    readers = [
+        threading.Thread(target=read_stream, args=('stdout', process.stdout, stdout_handler)),
+        threading.Thread(target=read_stream, args=('stderr', process.stderr, stderr_handler)),
+    ]
+    if stdin_writer is not None:
+        readers.append(threading.Thread(target=write_stream, args=(process.stdin, stdin_writer)))
+
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    # e.g. an unreadable input file, the process only saw part of its input
+    if stdin_errors:
+        raise stdin_errors[0]
+
+    return output.get('stdout'), output.get('stderr'), rusage
+
+def run_process_with_metrics(command, name: str, stdout_handler: Optional[Callable] = None, stderr_handler: Optional[Callable] = None, stdin_writer: Optional[Callable] = None, **popen_kwargs) -> tuple[int, str, str]:
+    """
+    Runs the command and records its wall time, CPU time, peak memory and I/O.
+    Returns the exit code, stdout and stderr. Streams with a line handler are not returned.
+    """
+    arguments = command.split() if isinstance(command, str) else command
+    input_files = get_file_arguments(arguments)
+    input_bytes = get_files_size(input_files)
+
+    start_time = time.monotonic()
+    process = subprocess.Popen(command, **popen_kwargs)
+    stdout, stderr, rusage = communicate_and_wait(process, stdout_handler, stderr_handler, stdin_writer)
+    wall_time = time.monotonic() - start_time
+
+    # files which did not exist before the command are its outputs
+    output_files = [file_path for file_path in get_file_arguments(arguments) if file_path not in input_files]
+
+    write_metrics(METRICS_KIND_COMMAND, name, wall_time, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss,
+                  rusage.ru_inblock, rusage.ru_oublock, input_bytes, get_files_size(output_files), process.returncode)
+
+    return process.returncode, stdout, stderr
+
+def run_piped_processes_with_metrics(commands: list, name: str, stdout_handler: Callable, stderr_handlers: list, cwd: Optional[str] = None) -> list[int]:
+    """
+    Runs the commands connected by pipes, the stdout of each command is the stdin of the next one.
+    The data between the commands is not read by python. The output of the last command and the
+    stderr of all commands are passed line by line to the handlers.
+    The wall time, CPU time, peak memory and I/O of all commands are recorded together.
+    Returns the exit codes of the commands.
+    """
+    arguments = [argument for command in commands for argument in command]
+    input_files = get_file_arguments(arguments)
+    input_bytes = get_files_size(input_files)
+
+    start_time = time.monotonic()
+    processes = []
+    previous_stdout = None
+
+    try:
+        for command in commands:
+            process = subprocess.Popen(command, stdin=previous_stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd=cwd)
+
+            # the next command is the only reader, so the command gets SIGPIPE if the next one exits early
+            if previous_stdout is not None:
+                previous_stdout.close()
+
+            previous_stdout = process.stdout
+            processes.append(process)
+    except Exception:
+        for process in processes:
+            process.kill()
+            process.wait()
+        raise
+
+    def read_lines(stream, line_handler):
+        for line in stream:
+            line_handler(line)
+        stream.close()
+
+    readers = [threading.Thread(target=read_lines, args=(processes[-1].stdout, stdout_handler))]
+    readers += [threading.Thread(target=read_lines, args=(process.stderr, handler)) for process, handler in zip(processes, stderr_handlers)]
+
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+
+    user_time = system_time = 0.0
+    max_rss_kb = block_input = block_output = 0
+
+    for process in processes:
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        # the commands run at the same time, so their peak memory adds up
+        user_time += rusage.ru_utime
+        system_time += rusage.ru_stime
+        max_rss_kb += rusage.ru_maxrss
+        block_input += rusage.ru_inblock
+        block_output += rusage.ru_oublock
+
+    wall_time = time.monotonic() - start_time
+    exit_codes = [process.returncode for process in processes]
+
+    output_files = [file_path for file_path in get_file_arguments(arguments) if file_path not in input_files]
+
+    write_metrics(METRICS_KIND_COMMAND, name, wall_time, user_time, system_time, max_rss_kb,
+                  block_input, block_output, input_bytes, get_files_size(output_files), next((code for code in exit_codes if code != 0), 0))
+
+    return exit_codes
+
+@contextmanager
+def measure_resource_usage(name: str, kind: str = METRICS_KIND_FUNCTION, input_files: list = (), output_files: list = ()):
+    """
+    Records the resource usage of the code in the block, including the processes it waited for.
+    The peak memory is the high-water mark of the process or its children.
+    The list of output files is yielded, so files only known at the end of the block can be added.
+    """
+    input_bytes = get_files_size(input_files)
+    output_files = list(output_files)
+    usage_self_before = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_time = time.monotonic()
+    exit_code = 1
+
+    try:
+        yield output_files
+        exit_code = 0
+    finally:
+        wall_time = time.monotonic() - start_time
+        usage_self = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        def delta(field):
+            return (getattr(usage_self, field) - getattr(usage_self_before, field)) + (getattr(usage_children, field) - getattr(usage_children_before, field))
+
+        write_metrics(kind, name, wall_time, delta('ru_utime'), delta('ru_stime'), max(usage_self.ru_maxrss, usage_children.ru_maxrss),
+                      delta('ru_inblock'), delta('ru_oublock'), input_bytes, get_files_size(output_files), exit_code)
+
+def track_resource_usage(function: Callable) -> Callable:
+    """
+    Decorator recording the resource usage of a python analysis function.
+    File path arguments existing before the call count as input, those created by the call as output.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        arguments = list(args) + list(kwargs.values())
+        input_files = get_file_arguments(arguments)
+
+        with measure_resource_usage(f"{function.__module__}.{function.__name__}", METRICS_KIND_FUNCTION, input_files) as output_files:
+            result = function(*args, **kwargs)
+            output_files.extend(file_path for file_path in get_file_arguments(arguments) if file_path not in input_files)
+
+        return result
+
+    return wrapper
@@ -0,0 +1,176 @@
+import os
+import json
+from multiprocessing import cpu_count
+
+from common.common_constants import *
+from common.common_logging import *
+from common.common_config import *
+from common.common_folder_functions import get_folder_path_logs
+from common.common_config_enumerations import ConfigSettings, SchedulerSettings
+
+# environment variable holding the number of threads assigned to the current task.
+# it is set by the scheduler in the task process and inherited by all subprocesses.
+ENV_TASK_THREADS = 'ADNA_TASK_THREADS'
+
+#####################
+# Threads
+#####################
+
+def get_thread_budget() -> int:
+    """
+    Total number of threads that may be used by all running tasks together.
+    """
+    thread_budget = get_config_value(ConfigSettings.SCHEDULER.value, SchedulerSettings.THREAD_BUDGET.value)
+
+    if thread_budget is None or not isinstance(thread_budget, int) or thread_budget <= 0:
+        return cpu_count()
+
+    return thread_budget
+
+def get_task_threads() -> int:
+    """
+    Number of threads the current task may use.
+    Outside of the scheduler this is THREADS_DEFAULT, limited to the number of CPUs.
+    """
+    task_threads = os.environ.get(ENV_TASK_THREADS)
+
+    if task_threads and task_threads.isdigit() and int(task_threads) > 0:
+        return int(task_threads)
+
+    return max(1, min(THREADS_DEFAULT, cpu_count()))
+
+def set_task_threads(threads: int):
+    os.environ[ENV_TASK_THREADS] = str(max(1, int(threads)))
+
+def get_pool_size(number_of_jobs: int) -> int:
+    # a pool never gets more processes than jobs or threads assigned to the task
+    return max(1, min(get_task_threads(), number_of_jobs))
+
+def get_threads_per_worker(number_of_workers: int) -> int:
+    # split the threads of the task between the workers of a pool
+    return max(1, get_task_threads() // max(1, number_of_workers))
+
+class ThreadAllocator:
+    """
+    Hands out thread tokens to tasks. The sum of all handed out tokens never exceeds the budget.
+    The free threads are shared between the tasks starting at the same time, so threads
+    released by finished tasks are given to the tasks started next.
+    The threads of a task are fixed when it starts, running tasks are never rebalanced.
+    """
+
+    def __init__(self, thread_budget: int):
+        self.thread_budget = max(1, int(thread_budget))
+        self.threads_in_use = 0
+
+    @property
+    def threads_available(self) -> int:
+        return self.thread_budget - self.threads_in_use
+
+    def get_fair_share(self, number_of_tasks_starting: int) -> int:
+        return max(1, self.threads_available // max(1, number_of_tasks_starting))
+
+    def acquire(self, threads_requested: int) -> int:
+        """
+        Returns the number of threads assigned to the task, or 0 if no threads are available.
+        """
+        if self.threads_available <= 0:
+            return 0
+
+        threads = max(1, min(threads_requested, self.threads_available))
+
+        self.threads_in_use += threads
+        return threads
+
+    def release(self, threads: int):
+        self.threads_in_use = max(0, self.threads_in_use - threads)
+
+#####################
+# Memory
+#####################
+
+# memory assumed for tasks without a configured or learned estimate
+DEFAULT_TASK_MEMORY_GB = 2
+
+# safety margin added to the learned peak memory of a task
+LEARNED_MEMORY_HEADROOM = 1.2
+
+def get_memory_budget_mb() -> int:
+    """
+    Total memory that may be used by all running tasks together.
+    If not configured, the physical memory of the machine is used.
+    """
+    memory_budget_gb = get_config_value(ConfigSettings.SCHEDULER.value, SchedulerSettings.MEMORY_BUDGET_GB.value)
+
+    if isinstance(memory_budget_gb, (int, float)) and memory_budget_gb > 0:
+        return int(memory_budget_gb * 1024)
+
+    return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024 * 1024))
+
+def get_configured_memory_estimate_mb(resource_key: str) -> int | None:
+    memory_estimates = get_config_value(ConfigSettings.SCHEDULER.value, SchedulerSettings.MEMORY_ESTIMATES_GB.value, default={})
+    memory_gb = memory_estimates.get(resource_key) if isinstance(memory_estimates, dict) else None
+
+    if isinstance(memory_gb, (int, float)) and memory_gb > 0:
+        return int(memory_gb * 1024)
+
+    return None
+
+def get_default_task_memory_mb() -> int:
+    memory_gb = get_config_value(ConfigSettings.SCHEDULER.value, SchedulerSettings.DEFAULT_TASK_MEMORY_GB.value, default=DEFAULT_TASK_MEMORY_GB)
+
+    if not isinstance(memory_gb, (int, float)) or memory_gb <= 0:
+        memory_gb = DEFAULT_TASK_MEMORY_GB
+
+    return int(memory_gb * 1024)
+
+def get_file_path_task_memory_usage() -> str:
+    return os.path.join(get_folder_path_logs(), FILE_NAME_TASK_MEMORY_USAGE)
+
+def load_learned_memory_usage() -> dict:
+    """
+    Returns the peak memory (in MB) observed in previous runs, per resource key.
+    """
+    file_path = get_file_path_task_memory_usage()
+
+    if not os.path.exists(file_path):
+        return {}
+
+    try:
+        with open(file_path, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        print_warning(f"Could not read learned memory usage from {file_path}: {e}")
+        return {}
+
+def save_learned_memory_usage(learned_memory_usage: dict):
+    file_path = get_file_path_task_memory_usage()
+
+    try:
+        with open(file_path, 'w') as f:
+            json.dump(learned_memory_usage, f, indent=2, sort_keys=True)
+    except Exception as e:
+        print_warning(f"Could not write learned memory usage to {file_path}: {e}")
+
+def get_memory_estimate_mb(resource_key: str, learned_memory_usage: dict) -> int:
+    """
+    Estimated peak memory of a task. The larger of the configured and the learned value is used.
+    If neither exists, the default task memory is used.
+    """
+    configured_memory_mb = get_configured_memory_estimate_mb(resource_key)
+    learned_memory_mb = learned_memory_usage.get(resource_key)
+
+    estimates = []
+    if configured_memory_mb is not None:
+        estimates.append(configured_memory_mb)
+    if learned_memory_mb:
+        estimates.append(int(learned_memory_mb * LEARNED_MEMORY_HEADROOM))
+
+    return max(estimates) if estimates else get_default_task_memory_mb()
+
+def get_max_oom_retries() -> int:
+    max_oom_retries = get_config_value(ConfigSettings.SCHEDULER.value, SchedulerSettings.MAX_OOM_RETRIES.value, default=2)
+
+    if not isinstance(max_oom_retries, int) or max_oom_retries < 0:
+        return 2
+
+    return max_oom_retries
@@ -0,0 +1,235 @@
+import os
+import json
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from common.common_constants import *
+from common.common_logging import *
+from common.common_config import PATH_ADNA_PROJECT
+from common.common_helper_functions import atomic_output
+from common.common_manifest import get_files_fingerprint
+
+# seconds to wait for a write lock, the pool workers of an analysis write at the same time
+DATABASE_LOCK_TIMEOUT = 60
+
+RESULT_TABLE_READS_PROCESSING = 'reads_processing'
+RESULT_TABLE_READ_LENGTH_DISTRIBUTION = 'read_length_distribution'
+RESULT_TABLE_ENDOGENOUS_READS = 'endogenous_reads'
+RESULT_TABLE_COVERAGE_ANALYSIS = 'coverage_analysis'
+
+# fingerprint of the inputs each group of records was computed from
+FINGERPRINT_TABLE = 'result_fingerprints'
+
+# columns and their types per table. The key columns identify the records written together
+# (e.g. the records of one sample), they are replaced when the sample is analyzed again.
+# The version of a table is raised when its records get new columns, so older records are computed again.
+RESULT_TABLES = {
+    RESULT_TABLE_READS_PROCESSING: {
+        'keys': ['species', 'reads_file'],
+        'columns': {
+            'species': 'TEXT',
+            'reads_file': 'TEXT',
+            'individual': 'TEXT',
+            'protocol': 'TEXT',
+            'raw_count': 'INTEGER',
+            'adapter_removed_count': 'INTEGER',
+            'quality_filtered_count': 'INTEGER',
+            'duplicates_removed_count': 'INTEGER',
+        },
+    },
+    RESULT_TABLE_READ_LENGTH_DISTRIBUTION: {
+        'keys': ['species', 'reads_file'],
+        'columns': {
+            'species': 'TEXT',
+            'reads_file': 'TEXT',
+            'individual': 'TEXT',
+            'protocol': 'TEXT',
+            'read_length': 'INTEGER',
+            'read_count_raw': 'INTEGER',
+            'read_count_adapter_removed': 'INTEGER',
+            'read_count_quality_filtered': 'INTEGER',
+            'read_count_duplicates_removed': 'INTEGER',
+        },
+    },
+    RESULT_TABLE_ENDOGENOUS_READS: {
+        'keys': ['species', 'reference_genome', 'Filename'],
+        'columns': {
+            'species': 'TEXT',
+            'reference_genome': 'TEXT',
+            'Filename': 'TEXT',
+            'MappedReads': 'INTEGER',
+            'TotalReads': 'INTEGER',
+            'Proportion': 'REAL',
+        },
+    },
+    RESULT_TABLE_COVERAGE_ANALYSIS: {
+        'version': 2,
+        'keys': ['species', 'reference_genome', 'Filename'],
+        'columns': {
+            'species': 'TEXT',
+            'reference_genome': 'TEXT',
+            'Filename': 'TEXT',
+            'scaffold': 'TEXT',
+            'avg_depth': 'REAL',
+            'max_depth': 'INTEGER',
+            'covered_bases': 'INTEGER',
+            'total_bases': 'INTEGER',
+            'percent_covered': 'REAL',
+            # breadth at the depth thresholds of the coverage engine
+            'percent_covered_2x': 'REAL',
+            'percent_covered_5x': 'REAL',
+            'percent_covered_10x': 'REAL',
+        },
+    },
+    FINGERPRINT_TABLE: {
+        'keys': ['result_table', 'result_key'],
+        'columns': {
+            'result_table': 'TEXT',
+            'result_key': 'TEXT',
+            'fingerprint': 'TEXT',
+            'version': 'INTEGER',
+        },
+    },
+}
+
+def get_file_path_result_store() -> str:
+    return os.path.join(PATH_ADNA_PROJECT, FILE_NAME_RESULT_STORE)
+
+def get_table_version(table: str) -> int:
+    return RESULT_TABLES[table].get('version', 1)
+
+def get_result_fingerprint(input_files: list, **settings) -> str:
+    """
+    Fingerprint of the input files (size and modification time) and the settings the records of a sample depend on.
+    """
+    fingerprint = {
+        'inputs': json.loads(get_files_fingerprint(input_files)),
+        'settings': settings,
+    }
+    return json.dumps(fingerprint, sort_keys=True, default=str)
+
+def quote_identifier(name: str) -> str:
+    # column names like Filename are kept as in the exported files, so they are quoted
+    return f'"{name}"'
+
+def to_sql_value(value):
+    # numpy values (e.g. from pandas) are not supported by sqlite3
+    return value.item() if isinstance(value, np.generic) else value
+
+class ResultStore:
+    """
+    Results of the analyses of all species and samples, stored in a SQLite database.
+    Each sample is written as soon as it is analyzed, the combined tables read by the
+    R scripts are exported from the store with one query.
+    """
+
+    def __init__(self, database_path: str = None):
+        self.database_path = database_path or get_file_path_result_store()
+        self.connection = sqlite3.connect(self.database_path, timeout=DATABASE_LOCK_TIMEOUT)
+
+        for table in RESULT_TABLES:
+            self.create_table(table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def create_table(self, table: str):
+        columns = RESULT_TABLES[table]['columns']
+        keys = RESULT_TABLES[table]['keys']
+
+        column_definitions = ", ".join(f"{quote_identifier(column)} {column_type}" for column, column_type in columns.items())
+        key_columns = ", ".join(quote_identifier(key) for key in keys)
+
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS {quote_identifier(table)} ({column_definitions})")
+        self.connection.execute(f"CREATE INDEX IF NOT EXISTS {quote_identifier(table + '_keys')} ON {quote_identifier(table)} ({key_columns})")
+
+        # columns added in later versions of the pipeline
+        existing_columns = [row[1] for row in self.connection.execute(f"PRAGMA table_info({quote_identifier(table)})")]
+        for column, column_type in columns.items():
+            if column not in existing_columns:
+                self.connection.execute(f"ALTER TABLE {quote_identifier(table)} ADD COLUMN {quote_identifier(column)} {column_type}")
+
+        self.connection.commit()
+
+    def get_where_clause(self, filters: dict) -> tuple[str, list]:
+        if not filters:
+            return "", []
+
+        conditions = " AND ".join(f"{quote_identifier(column)} = ?" for column in filters)
+        return f" WHERE {conditions}", [to_sql_value(value) for value in filters.values()]
+
+    def get_key_identifier(self, key: dict) -> str:
+        return json.dumps({column: to_sql_value(value) for column, value in key.items()}, sort_keys=True)
+
+    def get_fingerprint(self, table: str, key: dict) -> tuple[str | None, int | None]:
+        """
+        Fingerprint and table version of the records with the given key, None for records of
+        earlier versions of the pipeline.
+        """
+        row = self.connection.execute(
+            f"SELECT fingerprint, version FROM {quote_identifier(FINGERPRINT_TABLE)} WHERE result_table = ? AND result_key = ?",
+            (table, self.get_key_identifier(key))).fetchone()
+        return (row[0], row[1]) if row is not None else (None, None)
+
+    def has_records(self, table: str, fingerprint: str = None, **key) -> bool:
+        """
+        Checks if records with the given key exist in the current version of the table. With a
+        fingerprint, they must have been written from the same inputs and settings, so changed
+        inputs are analyzed again.
+        """
+        stored_fingerprint, stored_version = self.get_fingerprint(table, key)
+
+        if stored_version != get_table_version(table):
+            return False
+
+        if fingerprint is not None and stored_fingerprint != fingerprint:
+            return False
+
+        where_clause, values = self.get_where_clause(key)
+        return self.connection.execute(f"SELECT 1 FROM {quote_identifier(table)}{where_clause} LIMIT 1", values).fetchone() is not None
+
+    def write_records(self, table: str, key: dict, records: list, fingerprint: str = None):
+        """
+        Replaces the records with the given key. The key columns are added to each record.
+        The fingerprint of the inputs the records were computed from is stored with them.
+        """
+        columns = list(RESULT_TABLES[table]['columns'])
+        where_clause, key_values = self.get_where_clause(key)
+
+        rows = [
+            tuple(to_sql_value({**record, **key}.get(column)) for column in columns)
+            for record in records
+        ]
+
+        # one transaction, so readers never see a sample with only part of its records
+        with self.connection:
+            self.connection.execute(f"DELETE FROM {quote_identifier(table)}{where_clause}", key_values)
+            self.connection.executemany(
+                f"INSERT INTO {quote_identifier(table)} ({', '.join(quote_identifier(column) for column in columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                rows)
+            self.connection.execute(f"DELETE FROM {quote_identifier(FINGERPRINT_TABLE)} WHERE result_table = ? AND result_key = ?", (table, self.get_key_identifier(key)))
+            self.connection.execute(
+                f"INSERT INTO {quote_identifier(FINGERPRINT_TABLE)} (result_table, result_key, fingerprint, version) VALUES (?, ?, ?, ?)",
+                (table, self.get_key_identifier(key), fingerprint, get_table_version(table)))
+
+    def read_records(self, table: str, **filters) -> pd.DataFrame:
+        # in the order of the keys, the records of a key in the order they were written
+        keys = RESULT_TABLES[table]['keys']
+        where_clause, values = self.get_where_clause(filters)
+        order_clause = ", ".join(quote_identifier(key) for key in keys)
+
+        return pd.read_sql_query(f"SELECT * FROM {quote_identifier(table)}{where_clause} ORDER BY {order_clause}, rowid", self.connection, params=values)
+
+    def close(self):
+        self.connection.close()
+
+def export_result_table(df: pd.DataFrame, file_path: str, columns: list, sep: str = ",", na_rep: str = ""):
+    """
+    Writes the columns of a table read from the result store as CSV/TSV file, e.g. for the R scripts.
+    """
+    with atomic_output(file_path) as temp_file_path:
+        df[columns].to_csv(temp_file_path, sep=sep, index=False, na_rep=na_rep)
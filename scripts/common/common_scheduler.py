@@ -0,0 +1,389 @@
+import os
+import glob
+import time
+from datetime import datetime
+import signal
+from multiprocessing.connection import wait
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+import common.common_logging as common_logging
+from common.common_resources import ThreadAllocator, get_memory_estimate_mb, load_learned_memory_usage, save_learned_memory_usage
+from common.common_executors import LocalExecutor, BatchExecutor
+from common.common_manifest import PipelineManifest, FINGERPRINT_MODE_MTIME, get_files_fingerprint, get_task_parameters, get_tool_version
+
+# Task states used by the scheduler
+TASK_STATE_PENDING = 'pending'
+TASK_STATE_RUNNING = 'running'
+TASK_STATE_DONE = 'done'
+TASK_STATE_FAILED = 'failed'
+TASK_STATE_SKIPPED = 'skipped'
+TASK_STATE_BLOCKED = 'blocked'
+TASK_STATE_UP_TO_DATE = 'up_to_date'
+
+# status of a task compared to the pipeline manifest
+TASK_STATUS_NEW = 'new'               # never run before
+TASK_STATUS_UP_TO_DATE = 'up_to_date' # inputs, parameters, tool version and outputs unchanged
+TASK_STATUS_OUTDATED = 'outdated'     # inputs, parameters or tool version changed, or outputs modified
+TASK_STATUS_FAILED = 'failed'         # last run failed
+TASK_STATUS_UNKNOWN = 'unknown'       # no declared outputs, the step decides itself
+
+@dataclass
+class PipelineTask:
+    """
+    A single unit of work of the pipeline, e.g. one step for one (species, sample, reference genome).
+    The function is one of the existing step functions and is called with args in a separate process.
+    """
+    stage: str
+    step: str
+    function: Callable
+    args: tuple = ()
+    species: Optional[str] = None
+    sample: Optional[str] = None
+    reference_genome: Optional[str] = None
+    substep: Optional[str] = None
+    depends_on: list = field(default_factory=list)
+    inputs: list = field(default_factory=list)
+    outputs: list = field(default_factory=list)
+    # maximum number of threads the task can make use of. None means THREADS_DEFAULT
+    max_threads: Optional[int] = None
+    # tool used for the memory estimate and version of the task. None means the step is used
+    tool: Optional[str] = None
+    # settings the results depend on, e.g. adapter sequences. Changes cause a rerun
+    parameters: dict = field(default_factory=dict)
+    # memory used next to the tool of the task, e.g. by samtools sort next to bwa mem. Added to its estimate
+    additional_memory_mb: int = 0
+
+    @property
+    def name(self) -> str:
+        scope = ",".join(part for part in (self.species, self.sample, self.reference_genome) if part)
+        return f"{self.step}.{self.function.__name__}[{scope}]"
+
+    @property
+    def resource_key(self) -> str:
+        return self.tool or self.step
+
+def get_missing_files(paths: list) -> list:
+    # paths may be file paths or glob patterns
+    return [path for path in paths if not glob.glob(path)]
+
+def get_missing_inputs(task: PipelineTask) -> list:
+    return get_missing_files(task.inputs)
+
+def remove_task_outputs(task: PipelineTask):
+    # outputs of a killed or outdated task would be skipped by the steps, so remove them
+    for output_path in task.outputs:
+        for path in glob.glob(output_path):
+            if os.path.isfile(path):
+                common_logging.print_info(f"Removing output {path}")
+                os.remove(path)
+
+def get_task_status(task: PipelineTask, manifest: PipelineManifest, fingerprint_mode: str = FINGERPRINT_MODE_MTIME) -> tuple[str, dict]:
+    """
+    Compares a task with its last run recorded in the manifest.
+    Returns the status and the current fingerprints of the task.
+    """
+    fingerprints = {
+        'input_fingerprint': get_files_fingerprint(task.inputs, fingerprint_mode),
+        'parameters': get_task_parameters(task),
+        'tool_version': get_tool_version(task.tool),
+    }
+
+    record = manifest.get_task_record(task.name)
+
+    if record is None:
+        return TASK_STATUS_NEW, fingerprints
+
+    if any(record[key] != value for key, value in fingerprints.items()):
+        return TASK_STATUS_OUTDATED, fingerprints
+
+    if record['state'] != TASK_STATE_DONE:
+        return TASK_STATUS_FAILED, fingerprints
+
+    if not task.outputs:
+        return TASK_STATUS_UNKNOWN, fingerprints
+
+    if get_missing_files(task.outputs):
+        return TASK_STATUS_OUTDATED, fingerprints
+
+    if record['output_fingerprint'] != get_files_fingerprint(task.outputs, fingerprint_mode):
+        return TASK_STATUS_OUTDATED, fingerprints
+
+    return TASK_STATUS_UP_TO_DATE, fingerprints
+
+def run_tasks(tasks: list[PipelineTask], max_parallel_tasks: int = 1, thread_budget: int = 1, default_task_threads: int = 1, memory_budget_mb: Optional[int] = None, max_oom_retries: int = 0, manifest: Optional[PipelineManifest] = None, fingerprint_mode: str = FINGERPRINT_MODE_MTIME,
+              batch_executor: Optional[BatchExecutor] = None, batch_task_keys: list = (), max_batch_jobs: Optional[int] = None) -> dict:
+    """
+    Runs the tasks as soon as all tasks they depend on are finished.
+    Up to max_parallel_tasks tasks run at the same time, each in its own process.
+    The threads of all running tasks together never exceed thread_budget.
+    If memory_budget_mb is set, tasks are only started if their estimated memory fits into the budget.
+    Tasks killed by the OOM killer are retried up to max_oom_retries times with fewer threads.
+    If a manifest is given, up-to-date tasks are not run again and outdated tasks are rerun
+    together with all tasks depending on them.
+    If a batch executor is given, tasks whose tool or step is in batch_task_keys are submitted
+    as batch jobs instead. They do not count against the local limits, but at most max_batch_jobs
+    of them run at the same time.
+    Returns a dict of task name -> final task state.
+    """
+
+    tasks_by_name = {}
+    for task in tasks:
+        if task.name in tasks_by_name:
+            raise ValueError(f"Duplicate task name {task.name}")
+        tasks_by_name[task.name] = task
+
+    # dependencies on tasks that are not part of this run are considered fulfilled
+    dependencies = {
+        task.name: [name for name in task.depends_on if name in tasks_by_name]
+        for task in tasks
+    }
+
+    dependents = {name: [] for name in tasks_by_name}
+    for name, task_dependencies in dependencies.items():
+        for dependency in task_dependencies:
+            dependents[dependency].append(name)
+
+    states = {name: TASK_STATE_PENDING for name in tasks_by_name}
+    remaining_dependencies = {name: len(task_dependencies) for name, task_dependencies in dependencies.items()}
+
+    # keep the order in which the tasks were defined for tasks that are ready at the same time
+    ready = [name for name in tasks_by_name if remaining_dependencies[name] == 0]
+    running = {}  # task name -> details of the running task
+
+    max_parallel_tasks = max(1, int(max_parallel_tasks))
+    thread_allocator = ThreadAllocator(thread_budget)
+    local_executor = LocalExecutor()
+
+    # memory admission control, batch jobs request the estimated memory from the batch system
+    is_memory_tracked = bool(memory_budget_mb) or batch_executor is not None
+    learned_memory_usage = load_learned_memory_usage() if is_memory_tracked else {}
+    memory_in_use = 0
+
+    # adjustments for tasks retried after being killed by the OOM killer
+    oom_retries = {name: 0 for name in tasks_by_name}
+    max_threads_after_oom = {}
+
+    # tasks are compared with the manifest once, before their first start
+    task_fingerprints = {}
+
+    common_logging.print_execution(f"Running {len(tasks_by_name)} tasks with up to {max_parallel_tasks} tasks in parallel and {thread_allocator.thread_budget} threads ...")
+    if memory_budget_mb:
+        common_logging.print_info(f"Memory budget: {memory_budget_mb} MB")
+
+    def is_batch_task(name: str) -> bool:
+        task = tasks_by_name[name]
+        return batch_executor is not None and (task.tool in batch_task_keys or task.step in batch_task_keys)
+
+    def get_running_tasks(is_batch: bool) -> list:
+        return [name for name in running if running[name]['is_batch'] == is_batch]
+
+    if batch_executor is not None:
+        common_logging.print_info(f"Tasks of {list(batch_task_keys)} are submitted as batch jobs")
+
+    def get_task_memory_mb(name: str, is_batch: bool = False) -> int:
+        if not memory_budget_mb and not is_batch:
+            return 0
+        memory_mb = get_memory_estimate_mb(tasks_by_name[name].resource_key, learned_memory_usage) + tasks_by_name[name].additional_memory_mb
+        # each OOM kill doubles the estimate, so fewer tasks run next to the retried task
+        # and a retried batch job requests more memory
+        memory_mb *= 2 ** oom_retries[name]
+        # the memory of the batch nodes is not limited by the local budget
+        return memory_mb if is_batch or not memory_budget_mb else min(memory_mb, memory_budget_mb)
+
+    def get_all_dependents(name: str) -> set:
+        all_dependents = set()
+        to_visit = list(dependents[name])
+        while to_visit:
+            dependent = to_visit.pop()
+            if dependent not in all_dependents:
+                all_dependents.add(dependent)
+                to_visit += dependents[dependent]
+        return all_dependents
+
+    def finish(name: str, state: str):
+        states[name] = state
+
+        if state in (TASK_STATE_FAILED, TASK_STATE_BLOCKED):
+            # nothing that depends on a failed task can run
+            for dependent in dependents[name]:
+                if states[dependent] == TASK_STATE_PENDING:
+                    common_logging.print_warning(f"Task {dependent} blocked by task {name}")
+                    finish(dependent, TASK_STATE_BLOCKED)
+            return
+
+        for dependent in dependents[name]:
+            remaining_dependencies[dependent] -= 1
+            if remaining_dependencies[dependent] == 0 and states[dependent] == TASK_STATE_PENDING:
+                ready.append(dependent)
+
+    while ready or running:
+
+        # the free threads are shared between the local tasks that can be started now
+        local_running = len(get_running_tasks(is_batch=False))
+        local_ready = len([name for name in ready if not is_batch_task(name)])
+        fair_share = thread_allocator.get_fair_share(min(max_parallel_tasks - local_running, local_ready))
+
+        for name in list(ready):
+
+            task = tasks_by_name[name]
+            is_batch = is_batch_task(name)
+
+            if states[name] != TASK_STATE_PENDING:
+                ready.remove(name)
+                continue
+
+            if is_batch:
+                if max_batch_jobs and len(get_running_tasks(is_batch=True)) >= max_batch_jobs:
+                    continue
+            elif len(get_running_tasks(is_batch=False)) >= max_parallel_tasks or thread_allocator.threads_available <= 0:
+                continue
+
+            missing_inputs = get_missing_inputs(task)
+            if missing_inputs:
+                ready.remove(name)
+                common_logging.print_skipping(f"Task {name}: inputs do not exist: {missing_inputs}")
+                finish(name, TASK_STATE_SKIPPED)
+                continue
+
+            if manifest is not None and name not in task_fingerprints:
+                status, task_fingerprints[name] = get_task_status(task, manifest, fingerprint_mode)
+
+                if status == TASK_STATUS_UP_TO_DATE:
+                    ready.remove(name)
+                    common_logging.print_skipping(f"Task {name} is up to date.")
+                    finish(name, TASK_STATE_UP_TO_DATE)
+                    continue
+
+                if status == TASK_STATUS_OUTDATED:
+                    # results of this task and of all tasks using them have to be created again
+                    common_logging.print_info(f"Task {name} is outdated. Removing its outputs and the outputs of depending tasks.")
+                    remove_task_outputs(task)
+                    for dependent in get_all_dependents(name):
+                        remove_task_outputs(tasks_by_name[dependent])
+
+            max_threads = min(task.max_threads or default_task_threads, max_threads_after_oom.get(name, thread_allocator.thread_budget))
+            memory_mb = get_task_memory_mb(name, is_batch)
+
+            if is_batch:
+                # batch jobs run on other nodes, the batch system assigns their threads and memory
+                threads = max_threads
+                executor = batch_executor
+            else:
+                # a task that does not fit into the free memory waits, unless nothing else is running
+                if memory_budget_mb and get_running_tasks(is_batch=False) and memory_in_use + memory_mb > memory_budget_mb:
+                    common_logging.print_debug(f"Task {name} waits for memory ({memory_mb} MB needed, {memory_budget_mb - memory_in_use} MB free)")
+                    continue
+
+                threads = thread_allocator.acquire(min(max_threads, fair_share))
+                executor = local_executor
+
+            ready.remove(name)
+
+            try:
+                execution = executor.submit(task, threads, memory_mb)
+            except Exception as e:
+                common_logging.print_error(f"Failed to start task {name}: {e}")
+                if not is_batch:
+                    thread_allocator.release(threads)
+                finish(name, TASK_STATE_FAILED)
+                continue
+
+            if not is_batch:
+                memory_in_use += memory_mb
+
+            states[name] = TASK_STATE_RUNNING
+            running[name] = {
+                'execution': execution,
+                'is_batch': is_batch,
+                'started_at': datetime.now(),
+                'start_time': time.time(),
+                'threads': threads,
+                'memory_mb': memory_mb if not is_batch else 0,
+                'fingerprints': task_fingerprints.get(name),
+            }
+
+        if not running:
+            continue
+
+        # local tasks are waited for, batch jobs are polled for their marker files
+        sentinels = [running_task['execution'].sentinel for running_task in running.values() if running_task['is_batch'] is False]
+        poll_interval = batch_executor.poll_interval if get_running_tasks(is_batch=True) else None
+
+        if sentinels:
+            wait(sentinels, timeout=poll_interval)
+        else:
+            time.sleep(poll_interval)
+
+        for name in list(running.keys()):
+            running_task = running[name]
+            exit_code = running_task['execution'].poll()
+
+            if exit_code is None:
+                continue
+
+            running.pop(name)
+            threads = running_task['threads']
+
+            if not running_task['is_batch']:
+                thread_allocator.release(threads)
+            memory_in_use -= running_task['memory_mb']
+
+            task = tasks_by_name[name]
+            duration = time.time() - running_task['start_time']
+
+            peak_memory_mb = running_task['execution'].peak_memory_mb
+
+            if peak_memory_mb is not None and is_memory_tracked:
+                common_logging.print_debug(f"Task {name} peak memory: {peak_memory_mb} MB")
+                if peak_memory_mb > learned_memory_usage.get(task.resource_key, 0):
+                    learned_memory_usage[task.resource_key] = peak_memory_mb
+                    save_learned_memory_usage(learned_memory_usage)
+
+            is_killed = exit_code == -signal.SIGKILL
+
+            # the steps report their errors and return, so a task without its declared outputs failed
+            missing_outputs = get_missing_files(task.outputs) if exit_code == 0 else []
+            is_done = exit_code == 0 and not missing_outputs
+
+            if manifest is not None and running_task['fingerprints'] and not (is_killed and oom_retries[name] < max_oom_retries):
+                state = TASK_STATE_DONE if is_done else TASK_STATE_FAILED
+                output_fingerprint = get_files_fingerprint(task.outputs, fingerprint_mode) if is_done else None
+                manifest.record_task(task, state, output_fingerprint=output_fingerprint, started_at=running_task['started_at'],
+                                     duration=duration, **running_task['fingerprints'])
+
+            if is_done:
+                common_logging.print_success(f"Task {name} finished in {duration:.1f}s")
+                finish(name, TASK_STATE_DONE)
+
+            elif missing_outputs:
+                common_logging.print_error(f"Task {name} finished after {duration:.1f}s without creating its outputs: {missing_outputs}")
+                finish(name, TASK_STATE_FAILED)
+
+            elif is_killed and oom_retries[name] < max_oom_retries:
+                # most likely killed by the OOM killer. retry with less parallelism
+                oom_retries[name] += 1
+                max_threads_after_oom[name] = max(1, threads // 2)
+
+                retry_memory_mb = get_task_memory_mb(name, running_task['is_batch'])
+                common_logging.print_warning(f"Task {name} was killed after {duration:.1f}s, probably out of memory. "
+                                             f"Retry {oom_retries[name]}/{max_oom_retries} with {max_threads_after_oom[name]} threads"
+                                             + (f" and {retry_memory_mb} MB." if retry_memory_mb else "."))
+
+                remove_task_outputs(task)
+                states[name] = TASK_STATE_PENDING
+                ready.insert(0, name)
+
+            else:
+                common_logging.print_error(f"Task {name} failed with exit code {exit_code} after {duration:.1f}s")
+                finish(name, TASK_STATE_FAILED)
+
+    failed_tasks = [name for name, state in states.items() if state == TASK_STATE_FAILED]
+    blocked_tasks = [name for name, state in states.items() if state == TASK_STATE_BLOCKED]
+
+    if failed_tasks:
+        common_logging.print_error(f"{len(failed_tasks)} tasks failed: {failed_tasks}")
+    if blocked_tasks:
+        common_logging.print_warning(f"{len(blocked_tasks)} tasks were not run because a task they depend on failed.")
+
+    return states
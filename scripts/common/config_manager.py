@@ -1,5 +1,11 @@
 import yaml
 
+# the C based loader is much faster, but only available if PyYAML was built with libyaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 _config = None  # Private module-level variable
 
 def load_config(config_file):
@@ -7,7 +13,7 @@ def load_config(config_file):
     global _config
     
     with open(config_file, 'r') as f:
-        _config = yaml.safe_load(f)
+        _config = yaml.load(f, Loader=SafeLoader)
         
     return _config
 
@@ -0,0 +1,30 @@
+#!/bin/bash
+# Local stand-in for sbatch, used to test the batch executor without a cluster.
+# Accepts the options used by the pipeline (--job-name, --cpus-per-task, --mem, --output, ...),
+# runs the job script in the background and prints the job id like sbatch.
+#
+# config.yaml:
+#   scheduler:
+#     batch:
+#       submit_command: "bash /path/to/scripts/common/sbatch_local.sh"
+
+output=/dev/null
+
+while [[ $# -gt 0 && "$1" == -* ]]; do
+    case "$1" in
+        --output=*) output="${1#--output=}" ;;
+        -o) shift; output="$1" ;;
+    esac
+    shift
+done
+
+job_script="$1"
+
+if [[ -z "$job_script" || ! -f "$job_script" ]]; then
+    echo "sbatch_local: job script not found: $job_script" >&2
+    exit 1
+fi
+
+nohup bash "$job_script" > "$output" 2>&1 < /dev/null &
+
+echo "Submitted batch job $!"
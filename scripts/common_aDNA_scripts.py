@@ -3,4 +3,6 @@ from common.common_logging import *
 from common.common_config import *
 from common.common_folder_functions import *
 from common.common_helper_functions import *
+from common.common_metrics import *
+from common.common_resources import *
 from common.common_config_enumerations import *
\ No newline at end of file
@@ -1,46 +1,99 @@
 from common_aDNA_scripts import *
+import sys
+import argparse
+from enum import Enum
+from typing import Optional
+from common.common_scheduler import PipelineTask, run_tasks, get_task_status, TASK_STATE_FAILED, TASK_STATUS_UP_TO_DATE
+from common.common_manifest import PipelineManifest, get_file_path_pipeline_manifest, get_fingerprint_mode, is_manifest_enabled
+from common.common_lazy_loading import LazyStepModule
+from common.common_executors import run_batch_task, get_batch_executor, get_batch_task_keys, get_max_batch_jobs
+
+import raw_reads_processing.common_raw_reads_processing_helpers as common_rrp
+import ref_genome_processing.common_ref_genome_processing_helpers as common_rgp
 
 #load individual scripts to run within the pipeline
-import raw_reads_processing.quality_checking.execute_fastqc as execute_fastqc
-import raw_reads_processing.quality_checking.execute_multiqc as execute_multiqc
-import raw_reads_processing.execute_fastp_adapter_remove_and_merge as execute_fastp_adapter_remove_and_merge
-import raw_reads_processing.polish_fastp_quality_filter as polish_fastp_quality_filter
-import raw_reads_processing.polish_fastp_deduplication as polish_fastp_deduplication
-import raw_reads_processing.quality_checking.generate_quality_check_report as generate_quality_check_report
-import raw_reads_processing.merge_reads_by_individual as merge_reads_by_individual
-import raw_reads_processing.analysis.determine_reads_processing_result as determine_reads_processing_result
-import raw_reads_processing.analysis.determine_read_length_distribution as determine_read_length_distribution
-import raw_reads_processing.analysis.generate_plots_raw_reads_processing as generate_plots_raw_reads_processing
-import raw_reads_processing.analysis.contamination.check_contamination_centrifuge as check_contamination_centrifuge
-import raw_reads_processing.analysis.contamination.check_contamination_kraken as check_contamination_kraken
-
-import ref_genome_processing.prepare_ref_genome_for_mapping as prepare_ref_genome_for_mapping
-import ref_genome_processing.prepare_species_for_map_to_ref_genome as prepare_species_for_map_to_ref_genome
-import ref_genome_processing.map_aDNA_to_refgenome as map_aDNA_to_refgenome
-import ref_genome_processing.convert_mapped_sam2bam as convert_mapped_sam2bam
-import ref_genome_processing.analysis.determine_endogenous_reads as determine_endogenous_reads
-import ref_genome_processing.analysis.extract_special_sequences as extract_special_sequences
-import ref_genome_processing.analysis.determine_coverage_depth_and_breadth as determine_coverage_depth_and_breadth
-import ref_genome_processing.analysis.generate_plots_ref_genome_processing as generate_plots_ref_genome_processing
-import ref_genome_processing.analysis.analyze_damage as analyze_damage
-
-import additional_analysis.species_comparison.analysis.generate_plots_species_compare as generate_plots_species_compare
-import additional_analysis.mtdna_analysis.pipeline_mtdna_analysis as pipeline_mtdna_analysis
-
+# the step modules are imported on the first call of one of their functions,
+# so only the steps that run pay for their dependencies (pandas, pysam, Biopython, ...)
+execute_fastqc = LazyStepModule("raw_reads_processing.quality_checking.execute_fastqc")
+execute_multiqc = LazyStepModule("raw_reads_processing.quality_checking.execute_multiqc")
+execute_fastp_adapter_remove_and_merge = LazyStepModule("raw_reads_processing.execute_fastp_adapter_remove_and_merge")
+polish_fastp_quality_filter = LazyStepModule("raw_reads_processing.polish_fastp_quality_filter")
+polish_fastp_deduplication = LazyStepModule("raw_reads_processing.polish_fastp_deduplication")
+generate_quality_check_report = LazyStepModule("raw_reads_processing.quality_checking.generate_quality_check_report")
+merge_reads_by_individual = LazyStepModule("raw_reads_processing.merge_reads_by_individual")
+determine_reads_processing_result = LazyStepModule("raw_reads_processing.analysis.determine_reads_processing_result")
+determine_read_length_distribution = LazyStepModule("raw_reads_processing.analysis.determine_read_length_distribution")
+generate_plots_raw_reads_processing = LazyStepModule("raw_reads_processing.analysis.generate_plots_raw_reads_processing")
+check_contamination_centrifuge = LazyStepModule("raw_reads_processing.analysis.contamination.check_contamination_centrifuge")
+check_contamination_kraken = LazyStepModule("raw_reads_processing.analysis.contamination.check_contamination_kraken")
+
+prepare_ref_genome_for_mapping = LazyStepModule("ref_genome_processing.prepare_ref_genome_for_mapping")
+prepare_species_for_map_to_ref_genome = LazyStepModule("ref_genome_processing.prepare_species_for_map_to_ref_genome")
+map_aDNA_to_refgenome = LazyStepModule("ref_genome_processing.map_aDNA_to_refgenome")
+convert_mapped_sam2bam = LazyStepModule("ref_genome_processing.convert_mapped_sam2bam")
+determine_endogenous_reads = LazyStepModule("ref_genome_processing.analysis.determine_endogenous_reads")
+extract_special_sequences = LazyStepModule("ref_genome_processing.analysis.extract_special_sequences")
+determine_coverage_depth_and_breadth = LazyStepModule("ref_genome_processing.analysis.determine_coverage_depth_and_breadth")
+generate_plots_ref_genome_processing = LazyStepModule("ref_genome_processing.analysis.generate_plots_ref_genome_processing")
+analyze_damage = LazyStepModule("ref_genome_processing.analysis.analyze_damage")
+
+generate_plots_species_compare = LazyStepModule("additional_analysis.species_comparison.analysis.generate_plots_species_compare")
+pipeline_mtdna_analysis = LazyStepModule("additional_analysis.mtdna_analysis.pipeline_mtdna_analysis")
+determine_mtdna_step1_map_to_ref_genome = LazyStepModule("additional_analysis.mtdna_analysis.determine_mtdna_step1_map_to_ref_genome")
+determine_mtdna_step2_determine_regions = LazyStepModule("additional_analysis.mtdna_analysis.determine_mtdna_step2_determine_regions")
+determine_mtdna_step3_create_and_map_consensus_sequence = LazyStepModule("additional_analysis.mtdna_analysis.determine_mtdna_step3_create_and_map_consensus_sequence")
+determine_mtdna_step4_extract_coi_regions = LazyStepModule("additional_analysis.mtdna_analysis.determine_mtdna_step4_extract_coi_regions")
+determine_mtdna_step5_check_extracted_regions_for_content = LazyStepModule("additional_analysis.mtdna_analysis.determine_mtdna_step5_check_extracted_regions_for_content")
+
+def is_pipeline_step_enabled(stage: str, step: Optional[str] = None, substep: Optional[str] = None) -> bool:
+    """
+    Stages, steps and substeps can be disabled in the config, e.g.
+    pipeline:
+      reference_genome_processing:
+        analyze_damage:
+          enabled: false
+    A disabled stage or step disables everything below it.
+    """
+    keys = [ConfigSettings.PIPELINE.value]
+
+    for key in (stage, step, substep):
+        if key is None:
+            break
+        keys.append(key)
+        if not is_setting_enabled(*keys):
+            return False
+
+    return True
+
+def run_step(stage: PipelineStages, step: Enum, function, substep: Optional[Enum] = None):
+    substep_value = substep.value if substep else None
+
+    if not is_pipeline_step_enabled(stage.value, step.value, substep_value):
+        print_skipping(f"{' / '.join(key for key in (stage.value, step.value, substep_value) if key)} is disabled in the config.")
+        return
+
+    function()
 
 def run_pipeline_reference_genome_processing():
 
     print_execution("Starting reference genome processing pipeline ...")
+
+    stage = PipelineStages.REFERENCE_GENOME_PROCESSING
     
     ############################################################
     # Mapping to reference genome
     ############################################################
 
     # prepare reference genome for mapping
-    prepare_ref_genome_for_mapping.all_species_prepare_ref_genome()
+    run_step(stage, ReferenceGenomeProcessingSteps.PREPARE_REFERENCE_GENOME, prepare_ref_genome_for_mapping.all_species_prepare_ref_genome)
     
     # map reads to reference genome
-    map_aDNA_to_refgenome.all_species_map_aDNA_to_refgenome()
+    run_step(stage, ReferenceGenomeProcessingSteps.MAP_READS_TO_REFERENCE_GENOME, map_aDNA_to_refgenome.all_species_map_aDNA_to_refgenome)
+
+    # determine contamination of the species that classify only the reads that did not map
+    # the step belongs to the raw reads processing, so it is enabled and disabled there
+    run_step(PipelineStages.RAW_READS_PROCESSING, RawReadsProcessingSteps.CONTAMINATION_CHECK, check_contamination_centrifuge.all_species_run_centrifuge_on_unmapped_reads)
+    run_step(PipelineStages.RAW_READS_PROCESSING, RawReadsProcessingSteps.CONTAMINATION_CHECK, check_contamination_kraken.all_species_run_Kraken_on_unmapped_reads)
 
     # convert mapped reads from sam to bam. also sorts the bam file and indexes it
     # Note 2025-04-07: This step is now called directly after mapping to reduce space usage
@@ -48,14 +101,14 @@ def run_pipeline_reference_genome_processing():
 
     # run mapDamage on the mapped reads
     # this step analyzes the damage patterns in the mapped reads
-    analyze_damage.all_species_run_mapdamage()
+    run_step(stage, ReferenceGenomeProcessingSteps.ANALYZE_DAMAGE, analyze_damage.all_species_run_mapdamage)
     
     # quality control for mapped reads
     # determine endogenous reads
-    determine_endogenous_reads.all_species_determine_endogenous_reads()
+    run_step(stage, ReferenceGenomeProcessingSteps.DETERMINE_ENDOGENOUS_READS, determine_endogenous_reads.all_species_determine_endogenous_reads)
 
     # determine coverage depth and breadth
-    determine_coverage_depth_and_breadth.all_species_determine_coverage_depth_and_breath()
+    run_step(stage, ReferenceGenomeProcessingSteps.DETERMINE_COVERAGE_DEPTH_AND_BREADTH, determine_coverage_depth_and_breadth.all_species_determine_coverage_depth_and_breath)
 
     # extract special sequences 
     #extract_special_sequences.all_species_extract_special_sequences()
@@ -64,83 +117,87 @@ def run_pipeline_reference_genome_processing():
     # these contain 
     # 1. coverage depth and breadth
     # 2. endogenous reads
-    generate_plots_ref_genome_processing.all_species_generate_plots()
+    run_step(stage, ReferenceGenomeProcessingSteps.GENERATE_REF_GENOME_PLOTS, generate_plots_ref_genome_processing.all_species_generate_plots)
 
 
 def run_pipeline_raw_reads_processing():
 
     print_execution("Starting raw reads processing pipeline ...")
 
+    stage = PipelineStages.RAW_READS_PROCESSING
+
     ############################################################
     # Processing of reads
     ############################################################
 
     # quality control for raw reads using fastqc and multiqc
-    execute_fastqc.all_species_fastqc_raw()
-    execute_multiqc.all_species_multiqc_raw()
+    run_step(stage, RawReadsProcessingSteps.QC, execute_fastqc.all_species_fastqc_raw, RawReadsQualityControlSteps.QC_RAW)
+    run_step(stage, RawReadsProcessingSteps.QC, execute_multiqc.all_species_multiqc_raw, RawReadsQualityControlSteps.QC_RAW)
 
     # adapter removal
     # this step uses fastp to remove adapters from the raw reads
     # it can handle single and paired end reads. paired end reads are merged
-    execute_fastp_adapter_remove_and_merge.all_species_fastp_adapter_remove_and_merge()
+    run_step(stage, RawReadsProcessingSteps.ADAPTER_REMOVE_AND_MERGE, execute_fastp_adapter_remove_and_merge.all_species_fastp_adapter_remove_and_merge)
 
     # quality control for adapter removed reads using fastqc and multiqc
-    execute_fastqc.all_species_fastqc_adapter_removed()
-    execute_multiqc.all_species_multiqc_adapter_removed()
+    run_step(stage, RawReadsProcessingSteps.QC, execute_fastqc.all_species_fastqc_adapter_removed, RawReadsQualityControlSteps.QC_ADAPTER_REMOVED)
+    run_step(stage, RawReadsProcessingSteps.QC, execute_multiqc.all_species_multiqc_adapter_removed, RawReadsQualityControlSteps.QC_ADAPTER_REMOVED)
 
     # apply quality filtering to adapter removed reads
     # this step uses fastp to apply quality filtering to the adapter removed reads
-    polish_fastp_quality_filter.all_species_fastp_quality_filter()
+    run_step(stage, RawReadsProcessingSteps.QUALITY_FILTER, polish_fastp_quality_filter.all_species_fastp_quality_filter)
 
     # quality control for quality filtered reads using fastqc and multiqc
-    execute_fastqc.all_species_fastqc_quality_filtered()
-    execute_multiqc.all_species_multiqc_quality_filtered()
+    run_step(stage, RawReadsProcessingSteps.QC, execute_fastqc.all_species_fastqc_quality_filtered, RawReadsQualityControlSteps.QC_QUALITY_FILTERED)
+    run_step(stage, RawReadsProcessingSteps.QC, execute_multiqc.all_species_multiqc_quality_filtered, RawReadsQualityControlSteps.QC_QUALITY_FILTERED)
 
     # remove duplicates from quality filtered reads
-    polish_fastp_deduplication.all_species_fastp_deduplication()
+    run_step(stage, RawReadsProcessingSteps.DEDUPLICATION, polish_fastp_deduplication.all_species_fastp_deduplication)
 
     # quality control for duplicates removed reads
-    execute_fastqc.all_species_fastqc_duplicates_removed()
-    execute_multiqc.all_species_multiqc_duplicates_removed()
+    run_step(stage, RawReadsProcessingSteps.QC, execute_fastqc.all_species_fastqc_duplicates_removed, RawReadsQualityControlSteps.QC_DUPLICATES_REMOVED)
+    run_step(stage, RawReadsProcessingSteps.QC, execute_multiqc.all_species_multiqc_duplicates_removed, RawReadsQualityControlSteps.QC_DUPLICATES_REMOVED)
 
     # generate quality check report (html) to easily access all qc results
-    generate_quality_check_report.all_species_generate_quality_check_report()
+    run_step(stage, RawReadsProcessingSteps.GENERATE_QUALITY_CHECK_REPORT, generate_quality_check_report.all_species_generate_quality_check_report)
 
     # prepare species for mapping to reference genome
     # this step uses the processed reads and prepares them for mapping to the 
     # reference genome by concatenating the reads and creating different fastq files.
     # fastq files are created per individual
     #prepare_species_for_map_to_ref_genome.all_species_prepare()
-    merge_reads_by_individual.all_species_merge_reads_by_individual()
+    run_step(stage, ReferenceGenomeProcessingSteps.PREPARE_SPECIES_FOR_MAPPING, merge_reads_by_individual.all_species_merge_reads_by_individual)
 
     # determine reads processing before and after
-    determine_reads_processing_result.all_species_determine_determine_reads_processing_result()
+    run_step(stage, RawReadsProcessingSteps.DETERMINE_READS_PROCESSING_RESULT, determine_reads_processing_result.all_species_determine_determine_reads_processing_result)
 
     # determine read length distribution
-    determine_read_length_distribution.all_species_determine_read_length_distribution()
+    run_step(stage, RawReadsProcessingSteps.DETERMINE_READ_LENGTH_DISTRIBUTION, determine_read_length_distribution.all_species_determine_read_length_distribution)
 
     # determine contamination using centrifuge
-    check_contamination_centrifuge.all_species_run_centrifuge()
+    run_step(stage, RawReadsProcessingSteps.CONTAMINATION_CHECK, check_contamination_centrifuge.all_species_run_centrifuge)
 
     # determine contamination using kraken
-    check_contamination_kraken.all_species_run_Kraken()
+    run_step(stage, RawReadsProcessingSteps.CONTAMINATION_CHECK, check_contamination_kraken.all_species_run_Kraken)
 
      # generate plots for all species to visualize results
     # these contain 
     # 1. reads processing results before and after
     # 2. sequence length distribution
     # 3. contamination analysis
-    generate_plots_raw_reads_processing.all_species_generate_plots()
+    run_step(stage, RawReadsProcessingSteps.GENERATE_RAW_READS_PLOTS, generate_plots_raw_reads_processing.all_species_generate_plots)
 
 def run_pipeline_post_processing():
 
     print_execution("Starting post processing pipeline ...")
 
+    stage = PipelineStages.POST_PROCESSING
+
     ############################################################
     # Post processing
     ############################################################
     # determine coi
-    pipeline_mtdna_analysis.pipeline_mtdna_analysis()
+    run_step(stage, PostProcessingSteps.MTDNA_ANALYSIS, pipeline_mtdna_analysis.pipeline_mtdna_analysis)
 
     ############################################################
     # Generate plots
@@ -150,14 +207,449 @@ def run_pipeline_post_processing():
     # 1. reads processing results before and after
     # 2. coverage depth and breadth
     # 3. endogenous reads
-    generate_plots_species_compare.species_generate_comparison_plots()
+    run_step(stage, PostProcessingSteps.GENERATE_SPECIES_COMPARISON_PLOTS, generate_plots_species_compare.species_generate_comparison_plots)
     
 
-def run_pipeline():
+def get_individuals_for_species(species: str) -> list[str]:
+    # the individuals are known from the raw reads, the merged reads are created by the raw reads processing
+    individuals = set()
+    for raw_read_path, _ in execute_fastp_adapter_remove_and_merge.get_raw_read_pairs_for_species(species):
+        try:
+            individuals.add(common_rgp.get_individual_from_file(raw_read_path))
+        except ValueError as e:
+            print_warning(f"Skipping {raw_read_path} for mapping: {e}")
+
+    return sorted(individuals)
+
+def build_raw_reads_processing_tasks(species: str) -> list[PipelineTask]:
+
+    stage = PipelineStages.RAW_READS_PROCESSING.value
+    tasks = []
+
+    def add_task(step: Enum, function, *args, **kwargs) -> PipelineTask:
+        task = PipelineTask(stage, step.value, function, args, species=species, **kwargs)
+        tasks.append(task)
+        return task
+
+    # quality control per processing state: fastqc followed by multiqc
+    def add_qc_tasks(qc_step: RawReadsQualityControlSteps, fastqc_function, multiqc_function, depends_on: list) -> PipelineTask:
+        fastqc_task = add_task(RawReadsProcessingSteps.QC, fastqc_function, species, substep=qc_step.value, depends_on=depends_on, tool='fastqc')
+        return add_task(RawReadsProcessingSteps.QC, multiqc_function, species, substep=qc_step.value, depends_on=[fastqc_task.name], tool='multiqc')
+
+    try:
+        adapter_sequences = get_adapter_sequence(species)
+    except Exception as e:
+        print_warning(f"Failed to get adapter sequences for species {species}: {e}")
+        adapter_sequences = None
+
+    multiqc_tasks = [add_qc_tasks(RawReadsQualityControlSteps.QC_RAW, execute_fastqc.fastqc_for_raw_data, execute_multiqc.multiqc_for_raw_data, [])]
+
+    adapter_removal_tasks = []
+    quality_filter_tasks = []
+    deduplication_tasks = []
+
+    # in fused mode, one fastp pass writes the duplicates removed reads, without intermediate fastq files
+    fused = common_rrp.is_fastp_fused_mode(species)
+
+    # one chain of fastp steps per raw read file (or read pair)
+    for r1, r2 in execute_fastp_adapter_remove_and_merge.get_raw_read_pairs_for_species(species):
+
+        read_files = [r1] if r2 is None else [r1, r2]
+
+        adapter_removed_file_path = common_rrp.get_adapter_removed_path_for_paired_raw_reads(species, read_files)
+        sample = get_filename_from_path(adapter_removed_file_path).replace(FILE_ENDING_ADAPTER_REMOVED_FASTQ_GZ, "")
+
+        quality_filtered_file_path = common_rrp.get_quality_filtered_path_for_adapter_removed_reads(species, adapter_removed_file_path)
+        deduplicated_file_path = common_rrp.get_deduplication_path_for_quality_filtered_reads(species, quality_filtered_file_path)
+
+        # the fastp steps skip the read files of an individual whose merged reads already exist,
+        # e.g. after the large intermediate fastq files were deleted. Their outputs are not expected then.
+        try:
+            is_individual_prepared = common_rrp.is_species_individual_reads_file_exists(species, common_rrp.get_individual_from_file(r1))
+        except ValueError:
+            # the step itself reports the file name
+            is_individual_prepared = False
+
+        def get_expected_outputs(output_file_path: str) -> list:
+            return [] if is_individual_prepared else [output_file_path]
+
+        if fused:
+            fused_task = add_task(
+                RawReadsProcessingSteps.ADAPTER_REMOVE_AND_MERGE,
+                execute_fastp_adapter_remove_and_merge.adapter_remove_for_read_pair, species, r1, r2,
+                sample=sample, inputs=read_files, outputs=get_expected_outputs(deduplicated_file_path), tool='fastp',
+                parameters={'adapters': adapter_sequences, 'fused': True})
+
+            deduplication_tasks.append(fused_task.name)
+            continue
+
+        adapter_removal_task = add_task(
+            RawReadsProcessingSteps.ADAPTER_REMOVE_AND_MERGE,
+            execute_fastp_adapter_remove_and_merge.adapter_remove_for_read_pair, species, r1, r2,
+            sample=sample, inputs=read_files, outputs=get_expected_outputs(adapter_removed_file_path), tool='fastp',
+            parameters={'adapters': adapter_sequences})
+
+        quality_filter_task = add_task(
+            RawReadsProcessingSteps.QUALITY_FILTER,
+            polish_fastp_quality_filter.fastp_quality_filter_for_read_file, species, adapter_removed_file_path,
+            sample=sample, depends_on=[adapter_removal_task.name], inputs=[adapter_removed_file_path], outputs=get_expected_outputs(quality_filtered_file_path), tool='fastp')
+
+        deduplication_task = add_task(
+            RawReadsProcessingSteps.DEDUPLICATION,
+            polish_fastp_deduplication.fastp_deduplication_for_read_file, species, quality_filtered_file_path,
+            sample=sample, depends_on=[quality_filter_task.name], inputs=[quality_filtered_file_path], outputs=get_expected_outputs(deduplicated_file_path), tool='fastp')
+
+        adapter_removal_tasks.append(adapter_removal_task.name)
+        quality_filter_tasks.append(quality_filter_task.name)
+        deduplication_tasks.append(deduplication_task.name)
+
+    # the intermediate fastq files do not exist in fused mode
+    if not fused:
+        multiqc_tasks.append(add_qc_tasks(RawReadsQualityControlSteps.QC_ADAPTER_REMOVED, execute_fastqc.fastqc_for_adapter_removed_data, execute_multiqc.multiqc_for_adapter_removed_data, adapter_removal_tasks))
+        multiqc_tasks.append(add_qc_tasks(RawReadsQualityControlSteps.QC_QUALITY_FILTERED, execute_fastqc.fastqc_for_quality_filtered_data, execute_multiqc.multiqc_for_quality_filtered_data, quality_filter_tasks))
+    multiqc_tasks.append(add_qc_tasks(RawReadsQualityControlSteps.QC_DUPLICATES_REMOVED, execute_fastqc.fastqc_for_duplicates_removed_data, execute_multiqc.multiqc_for_duplicates_removed_data, deduplication_tasks))
+
+    add_task(RawReadsProcessingSteps.GENERATE_QUALITY_CHECK_REPORT, generate_quality_check_report.species_generate_quality_check_report, species,
+             depends_on=[task.name for task in multiqc_tasks], max_threads=1)
+
+    # merged reads per individual are the input for the reference genome processing
+    add_task(ReferenceGenomeProcessingSteps.PREPARE_SPECIES_FOR_MAPPING, merge_reads_by_individual.merge_fastq_by_individual, species,
+             depends_on=deduplication_tasks, max_threads=1,
+             outputs=[common_rgp.create_species_individual_combined_read_filepath(species, individual) for individual in get_individuals_for_species(species)])
+
+    reads_processing_result_task = add_task(RawReadsProcessingSteps.DETERMINE_READS_PROCESSING_RESULT, determine_reads_processing_result.determine_reads_processing_result, species, depends_on=deduplication_tasks)
+    read_length_distribution_task = add_task(RawReadsProcessingSteps.DETERMINE_READ_LENGTH_DISTRIBUTION, determine_read_length_distribution.determine_read_length_distribution, species, depends_on=deduplication_tasks)
+
+    analysis_tasks = [
+        add_task(RawReadsProcessingSteps.DETERMINE_READS_PROCESSING_RESULT, determine_reads_processing_result.combine_reads_processing_results, species, depends_on=[reads_processing_result_task.name], max_threads=1),
+        add_task(RawReadsProcessingSteps.DETERMINE_READ_LENGTH_DISTRIBUTION, determine_read_length_distribution.combine_read_length_distributions, species, depends_on=[read_length_distribution_task.name], max_threads=1),
+    ]
+
+    if common_rrp.is_contamination_check_unmapped_reads_only(species):
+        # only the reads that did not map are classified, so the check waits for the mapping of all individuals
+        ref_genome = common_rrp.get_contamination_check_reference_genome(species)
+
+        if ref_genome is not None:
+            ref_genome_id, _ = ref_genome
+
+            individuals = get_individuals_for_species(species)
+
+            mapping_tasks = [
+                PipelineTask(PipelineStages.REFERENCE_GENOME_PROCESSING.value, ReferenceGenomeProcessingSteps.MAP_READS_TO_REFERENCE_GENOME.value,
+                             map_aDNA_to_refgenome.map_read_file_to_refgenome, species=species, sample=individual, reference_genome=ref_genome_id).name
+                for individual in individuals
+            ]
+            sorted_bam_files = [common_rgp.get_sorted_bam_file_path_for_individual(species, individual, ref_genome_id) for individual in individuals]
+
+            add_task(RawReadsProcessingSteps.CONTAMINATION_CHECK, check_contamination_centrifuge.run_centrifuge_on_unmapped_reads_per_species, species,
+                     depends_on=mapping_tasks, inputs=sorted_bam_files, tool='centrifuge')
+            add_task(RawReadsProcessingSteps.CONTAMINATION_CHECK, check_contamination_kraken.run_Kraken_on_unmapped_reads_per_species, species,
+                     depends_on=mapping_tasks, inputs=sorted_bam_files, tool='kraken')
+    else:
+        # in batch mode, one task classifies the reads of all species (see build_pipeline_tasks)
+        if not common_rrp.is_centrifuge_batch_mode():
+            analysis_tasks.append(add_task(RawReadsProcessingSteps.CONTAMINATION_CHECK, check_contamination_centrifuge.run_centrifuge_per_species, species, depends_on=deduplication_tasks, tool='centrifuge'))
+
+        if not common_rrp.is_kraken_batch_mode():
+            analysis_tasks.append(add_task(RawReadsProcessingSteps.CONTAMINATION_CHECK, check_contamination_kraken.run_Kraken_per_species, species, depends_on=deduplication_tasks, tool='kraken'))
+
+    add_task(RawReadsProcessingSteps.GENERATE_RAW_READS_PLOTS, generate_plots_raw_reads_processing.species_generate_plots, species,
+             depends_on=[task.name for task in analysis_tasks], max_threads=1)
+
+    return tasks
+
+def build_reference_genome_processing_tasks(species: str) -> list[PipelineTask]:
+
+    stage = PipelineStages.REFERENCE_GENOME_PROCESSING.value
+    tasks = []
+
+    try:
+        ref_genome_list = common_rgp.get_reference_genome_file_list_for_species(species)
+    except Exception as e:
+        print_error(f"Failed to get reference genome files for species {species}: {e}")
+        return tasks
+
+    individuals = get_individuals_for_species(species)
+
+    merge_task_name = PipelineTask(stage, ReferenceGenomeProcessingSteps.PREPARE_SPECIES_FOR_MAPPING.value, merge_reads_by_individual.merge_fastq_by_individual, species=species).name
+
+    for ref_genome_id, ref_genome_path in ref_genome_list:
+
+        def add_task(step: Enum, function, *args, **kwargs) -> PipelineTask:
+            task = PipelineTask(stage, step.value, function, args, species=species, reference_genome=ref_genome_id, **kwargs)
+            tasks.append(task)
+            return task
+
+        prepare_task = add_task(
+            ReferenceGenomeProcessingSteps.PREPARE_REFERENCE_GENOME,
+            prepare_ref_genome_for_mapping.execute_bwa_index_reference_genome, ref_genome_path,
+            inputs=[ref_genome_path], outputs=[f"{ref_genome_path}{index_ending}" for index_ending in FILE_ENDINGS_BWA_INDEX], tool='bwa_index')
+
+        # in streaming mode, samtools sort runs next to bwa mem, with its share of the default threads of a task
+        sort_memory_mb = map_aDNA_to_refgenome.get_sort_memory_mb(species, THREADS_DEFAULT) if map_aDNA_to_refgenome.is_streaming_mapping_mode(species) else 0
+
+        mapping_tasks = []
+        for individual in individuals:
+            read_file_path = common_rgp.create_species_individual_combined_read_filepath(species, individual)
+
+            sam_file_path = common_rgp.get_sam_file_path_for_read_file_and_ref_genome(species, read_file_path, ref_genome_id)
+            bam_file_path = common_rgp.get_bam_file_path_for_sam_file(species, ref_genome_id, sam_file_path)
+            sorted_bam_file_path = common_rgp.get_sorted_bam_file_path_for_bam_file(species, ref_genome_id, bam_file_path)
+
+            mapping_task = add_task(
+                ReferenceGenomeProcessingSteps.MAP_READS_TO_REFERENCE_GENOME,
+                map_aDNA_to_refgenome.map_read_file_to_refgenome, species, read_file_path, ref_genome_id, ref_genome_path,
+                sample=individual, depends_on=[merge_task_name, prepare_task.name], inputs=[read_file_path, ref_genome_path],
+                outputs=[sorted_bam_file_path, sorted_bam_file_path + FILE_ENDING_BAI], tool='bwa_mem',
+                additional_memory_mb=sort_memory_mb)
+
+            mapping_tasks.append(mapping_task.name)
+
+        add_task(ReferenceGenomeProcessingSteps.ANALYZE_DAMAGE, analyze_damage.run_mapdamage_for_reference_genome, species, ref_genome_id, ref_genome_path,
+                 depends_on=mapping_tasks, tool='mapdamage')
+
+        endogenous_reads_task = add_task(
+            ReferenceGenomeProcessingSteps.DETERMINE_ENDOGENOUS_READS,
+            determine_endogenous_reads.determine_endogenous_reads_for_reference_genome, species, ref_genome_id,
+            depends_on=mapping_tasks)
+
+        coverage_task = add_task(
+            ReferenceGenomeProcessingSteps.DETERMINE_COVERAGE_DEPTH_AND_BREADTH,
+            determine_coverage_depth_and_breadth.determine_coverage_depth_and_breath_for_reference_genome, species, ref_genome_id,
+            depends_on=mapping_tasks)
+
+        add_task(ReferenceGenomeProcessingSteps.GENERATE_REF_GENOME_PLOTS, generate_plots_ref_genome_processing.generate_plots_for_reference_genome, species, ref_genome_id,
+                 depends_on=[endogenous_reads_task.name, coverage_task.name], max_threads=1)
+
+    return tasks
+
+def build_post_processing_tasks(species: str, depends_on: list) -> list[PipelineTask]:
+
+    stage = PipelineStages.POST_PROCESSING.value
+    tasks = []
+
+    mtdna_steps = [
+        (MtdnaAnalysisSteps.MTDNA_MAP_TO_REF_GENOME, determine_mtdna_step1_map_to_ref_genome.map_mtdna_to_refgenome_for_species),
+        (MtdnaAnalysisSteps.MTDNA_DETERMINE_REGIONS, determine_mtdna_step2_determine_regions.mtdna_get_regions_for_species),
+        (MtdnaAnalysisSteps.MTDNA_CREATE_AND_MAP_CONSENSUS, determine_mtdna_step3_create_and_map_consensus_sequence.create_and_map_consensus_sequence_for_species),
+        (MtdnaAnalysisSteps.MTDNA_EXTRACT_COI_REGIONS, determine_mtdna_step4_extract_coi_regions.extract_mtdna_region_for_species),
+        (MtdnaAnalysisSteps.MTDNA_CHECK_EXTRACTED_REGIONS, determine_mtdna_step5_check_extracted_regions_for_content.check_extracted_region_for_species),
+    ]
+
+    # the mtDNA steps of a species run one after the other
+    for mtdna_step, function in mtdna_steps:
+        task = PipelineTask(stage, PostProcessingSteps.MTDNA_ANALYSIS.value, function, (species,), species=species,
+                            substep=mtdna_step.value, depends_on=depends_on)
+        tasks.append(task)
+        depends_on = [task.name]
+
+    return tasks
+
+def build_pipeline_tasks(species_list: Optional[list] = None) -> list[PipelineTask]:
+    """
+    Builds the task graph of the whole pipeline. Each task is one step for one species,
+    sample or reference genome and only depends on the tasks that create its inputs.
+    If species_list is given, only the tasks of these species are created.
+    """
+
+    tasks = []
+
+    for species in species_list or FOLDER_SPECIES:
+        raw_reads_processing_tasks = build_raw_reads_processing_tasks(species)
+        reference_genome_processing_tasks = build_reference_genome_processing_tasks(species)
+
+        # mtDNA analysis uses the indexed reference genomes
+        prepare_tasks = [
+            task.name for task in reference_genome_processing_tasks
+            if task.step == ReferenceGenomeProcessingSteps.PREPARE_REFERENCE_GENOME.value
+        ]
+
+        tasks += raw_reads_processing_tasks
+        tasks += reference_genome_processing_tasks
+        tasks += build_post_processing_tasks(species, prepare_tasks)
+
+    # one centrifuge or kraken2 run for the reads of all species, the plots of each species need its results
+    batched_classifications = [
+        (common_rrp.is_centrifuge_batch_mode(), check_contamination_centrifuge.run_centrifuge_batched, 'centrifuge'),
+        (common_rrp.is_kraken_batch_mode(), check_contamination_kraken.run_Kraken_batched, 'kraken'),
+    ]
+
+    deduplication_tasks = [task.name for task in tasks if any(output.endswith(FILE_ENDING_DUPLICATES_REMOVED_FASTQ_GZ) for output in task.outputs)]
+
+    # the species that classify only their unmapped reads have their own tasks
+    batched_species = [species for species in species_list or FOLDER_SPECIES if not common_rrp.is_contamination_check_unmapped_reads_only(species)]
+
+    for batch_mode, function, tool in batched_classifications:
+        if not batch_mode or not batched_species:
+            continue
+
+        classification_task = PipelineTask(
+            PipelineStages.RAW_READS_PROCESSING.value,
+            RawReadsProcessingSteps.CONTAMINATION_CHECK.value,
+            function,
+            (batched_species,),
+            depends_on=deduplication_tasks,
+            tool=tool)
+
+        for task in tasks:
+            if task.step == RawReadsProcessingSteps.GENERATE_RAW_READS_PLOTS.value:
+                task.depends_on.append(classification_task.name)
+
+        tasks.append(classification_task)
+
+    # the species comparison needs the results of all species
+    tasks.append(PipelineTask(
+        PipelineStages.POST_PROCESSING.value,
+        PostProcessingSteps.GENERATE_SPECIES_COMPARISON_PLOTS.value,
+        generate_plots_species_compare.species_generate_comparison_plots,
+        depends_on=[task.name for task in tasks],
+        max_threads=1))
+
+    return tasks
+
+def get_max_parallel_tasks() -> int:
+    max_parallel_tasks = get_config_value(ConfigSettings.SCHEDULER.value, SchedulerSettings.MAX_PARALLEL_TASKS.value)
+
+    if max_parallel_tasks is None or not isinstance(max_parallel_tasks, int) or max_parallel_tasks <= 0:
+        # by default, run as many tasks as fit in the thread budget with the default number of threads per task
+        return max(1, get_thread_budget() // max(1, THREADS_DEFAULT))
+
+    return max_parallel_tasks
+
+def get_pipeline_manifest() -> PipelineManifest | None:
+    if not is_manifest_enabled():
+        return None
+
+    return PipelineManifest(get_file_path_pipeline_manifest())
+
+def is_task_selected(task: PipelineTask, stages: Optional[list] = None, steps: Optional[list] = None, samples: Optional[list] = None, reference_genomes: Optional[list] = None) -> bool:
+    """
+    Checks if a task belongs to the selected stages and steps (or substeps) and to the selected samples
+    and reference genomes. Tasks not bound to a sample or reference genome (e.g. the combined results
+    of a species) are kept, so they include the new results.
+    """
+    if stages and task.stage not in stages:
+        return False
+
+    if steps and task.step not in steps and task.substep not in steps:
+        return False
+
+    # a sample is selected by its name or by its individual, e.g. "Ind1" selects "Ind1_L1"
+    if samples and task.sample and not any(task.sample == sample or task.sample.startswith(f"{sample}_") for sample in samples):
+        return False
+
+    if reference_genomes and task.reference_genome and task.reference_genome not in reference_genomes:
+        return False
+
+    return True
+
+def select_pipeline_tasks(species_list: Optional[list] = None, stages: Optional[list] = None, steps: Optional[list] = None, samples: Optional[list] = None, reference_genomes: Optional[list] = None) -> list[PipelineTask]:
+    """
+    Builds the task graph and keeps the selected tasks of the steps enabled in the config.
+    Dependencies on tasks that are not selected are considered fulfilled by the scheduler,
+    so a selected step uses the existing results of the steps before it.
+    """
+    tasks = []
+
+    for task in build_pipeline_tasks(species_list):
+
+        if not is_task_selected(task, stages, steps, samples, reference_genomes):
+            continue
+
+        if not is_pipeline_step_enabled(task.stage, task.step, task.substep):
+            print_debug(f"Task {task.name} is disabled in the config.")
+            continue
+
+        tasks.append(task)
+
+    for reference_genome in reference_genomes or []:
+        if not any(task.reference_genome == reference_genome for task in tasks):
+            print_warning(f"No tasks selected for reference genome {reference_genome}.")
+
+    return tasks
+
+def print_selected_tasks(tasks: list[PipelineTask]):
+    """
+    Prints the tasks that would run, without running them.
+    """
+    print_info(f"{len(tasks)} tasks selected:")
+
+    for task in tasks:
+        print_info(f"{task.stage} / {task.step}: {task.name}")
+
+def print_pipeline_status(tasks: Optional[list[PipelineTask]] = None):
+    """
+    Prints which tasks are up to date and what is left to do, based on the pipeline manifest.
+    """
+    print_execution("Determining pipeline status ...")
+
+    manifest = PipelineManifest(get_file_path_pipeline_manifest())
+    fingerprint_mode = get_fingerprint_mode()
+
+    status_per_step = {}
+
+    for task in tasks if tasks is not None else build_pipeline_tasks():
+        status, _ = get_task_status(task, manifest, fingerprint_mode)
+
+        status_per_step.setdefault((task.stage, task.step), {}).setdefault(status, 0)
+        status_per_step[(task.stage, task.step)][status] += 1
+
+        if status != TASK_STATUS_UP_TO_DATE:
+            print_debug(f"{status}: {task.name}")
+
+    manifest.close()
+
+    for (stage, step), status_counts in status_per_step.items():
+        counts = ", ".join(f"{count} {status}" for status, count in sorted(status_counts.items()))
+        print_info(f"{stage} / {step}: {counts}")
+
+def run_pipeline_scheduled(tasks: Optional[list[PipelineTask]] = None):
+
+    if tasks is None:
+        tasks = select_pipeline_tasks()
+
+    manifest = get_pipeline_manifest()
+
+    # tasks of the configured tools and steps (e.g. mapping, kraken) are sent to the batch system
+    batch_task_keys = get_batch_task_keys()
+
+    # without the scheduler, selected tasks run one after the other
+    is_scheduler_enabled = get_config_value(ConfigSettings.SCHEDULER.value, SchedulerSettings.ENABLED.value, default=False)
+
+    states = run_tasks(
+        tasks,
+        max_parallel_tasks=get_max_parallel_tasks() if is_scheduler_enabled else 1,
+        thread_budget=get_thread_budget(),
+        default_task_threads=THREADS_DEFAULT,
+        memory_budget_mb=get_memory_budget_mb(),
+        max_oom_retries=get_max_oom_retries(),
+        manifest=manifest,
+        fingerprint_mode=get_fingerprint_mode(),
+        batch_executor=get_batch_executor() if batch_task_keys else None,
+        batch_task_keys=batch_task_keys,
+        max_batch_jobs=get_max_batch_jobs())
+
+    if manifest is not None:
+        manifest.close()
+
+    if any(state == TASK_STATE_FAILED for state in states.values()):
+        print_error("Pipeline finished with failed tasks.")
+        return
+
+    print_success("Pipeline completed successfully.")
+
+def run_pipeline(tasks: Optional[list[PipelineTask]] = None):
+    """
+    Runs the whole pipeline or, if given, only the selected tasks.
+    """
 
     pid = os.getpid()
 
     print_execution(f"Starting pipeline (Main PID: {pid}) ...")
+
+    if tasks is not None or get_config_value(ConfigSettings.SCHEDULER.value, SchedulerSettings.ENABLED.value, default=False):
+        run_pipeline_scheduled(tasks)
+        return
     
     ############################################################
     # Processing of reads
@@ -177,8 +669,71 @@ def run_pipeline():
     print_success("Pipeline completed successfully.")
 
 
+def run_single_task(task_name: str) -> int:
+    """
+    Runs one task of the task graph. Called by the batch jobs submitted by the scheduler.
+    """
+    for task in build_pipeline_tasks():
+        if task.name == task_name:
+            return run_batch_task(task)
+
+    print_error(f"Task {task_name} not found in the pipeline.")
+    return 1
+
+def parse_arguments(arguments: Optional[list] = None) -> argparse.Namespace:
+
+    steps = [step.value for step_enum in (RawReadsProcessingSteps, RawReadsQualityControlSteps, ReferenceGenomeProcessingSteps, PostProcessingSteps, MtdnaAnalysisSteps) for step in step_enum]
+
+    parser = argparse.ArgumentParser(
+        description="aDNA pipeline. Without arguments, all stages are run for all species.",
+        epilog="Example: rerun the coverage for a new reference genome: "
+               "python pipeline_aDNA.py --steps determine_coverage_depth_and_breadth --species Bger --reference-genomes new_refgenome")
+
+    parser.add_argument("--stages", nargs="+", choices=[stage.value for stage in PipelineStages], metavar="STAGE",
+                        help=f"Stages to run: {', '.join(stage.value for stage in PipelineStages)}")
+    parser.add_argument("--steps", nargs="+", choices=list(dict.fromkeys(steps)), metavar="STEP",
+                        help=f"Steps or substeps to run: {', '.join(dict.fromkeys(steps))}")
+    parser.add_argument("--species", nargs="+", choices=FOLDER_SPECIES, metavar="SPECIES",
+                        help=f"Species to process: {', '.join(FOLDER_SPECIES)}")
+    parser.add_argument("--samples", nargs="+", metavar="SAMPLE",
+                        help="Samples or individuals to process, e.g. Ind1 or Ind1_L1")
+    parser.add_argument("--reference-genomes", nargs="+", metavar="REFERENCE_GENOME",
+                        help="Reference genomes (file name without extension) to process")
+    parser.add_argument("--status", action="store_true",
+                        help="Show which tasks are up to date and what is left to do, without running anything")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Show the tasks that would run, without running them")
+    parser.add_argument("--run-task", metavar="TASK_NAME",
+                        help=argparse.SUPPRESS) # used by the batch jobs
+
+    return parser.parse_args(arguments)
+
 def main():
-    run_pipeline()
+    arguments = parse_arguments()
+
+    if arguments.run_task:
+        sys.exit(run_single_task(arguments.run_task))
+
+    is_selection = any([arguments.stages, arguments.steps, arguments.species, arguments.samples, arguments.reference_genomes])
+
+    # the sequential pipeline runs everything, a selection is run as tasks
+    tasks = None
+    if is_selection or arguments.status or arguments.dry_run:
+        tasks = select_pipeline_tasks(arguments.species, arguments.stages, arguments.steps, arguments.samples, arguments.reference_genomes)
+
+    if arguments.status:
+        print_pipeline_status(tasks)
+        return
+
+    if arguments.dry_run:
+        print_selected_tasks(tasks)
+        return
+
+    if is_selection and not tasks:
+        print_warning("No tasks selected. Nothing to do.")
+        return
+
+    run_pipeline(tasks if is_selection else None)
 
 if __name__ == "__main__":  
     main()
\ No newline at end of file
@@ -2,10 +2,25 @@ import os
 import subprocess
 
 from common_aDNA_scripts import *
+import raw_reads_processing.common_raw_reads_processing_helpers as common_rrp
+import ref_genome_processing.common_ref_genome_processing_helpers as common_rgp
+import raw_reads_processing.analysis.contamination.common_contamination_helpers as common_contamination
 
 
-def run_centrifuge_on_file(species: str, fastq_file_path: str, centrifuge_output_txt: str, centrifuge_report_tsv: str, threads: int = THREADS_DEFAULT):
-   
+def get_centrifuge_database() -> str | None:
+    # get the Centrifuge database path from the config
+    centrifuge_db = get_processing_settings(RawReadsProcessingSteps.CONTAMINATION_CHECK).get(ContaminationCheckSettings.CENTRIFUGE_DB.value)
+
+    if not centrifuge_db:
+        print_error("Centrifuge database path is not set. Please check your configuration.")
+        return None
+
+    return centrifuge_db
+
+def run_centrifuge_on_file(species: str, fastq_file_path: str, centrifuge_output_txt: str, centrifuge_report_tsv: str, threads: int = None):
+    if threads is None:
+        threads = get_task_threads()
+
     print_info(f"Running Centrifuge on file: {get_filename_from_path(fastq_file_path)}")
 
              # Check if output files already exist
@@ -13,11 +28,8 @@ def run_centrifuge_on_file(species: str, fastq_file_path: str, centrifuge_output
         print_skipping(f"Output files for {get_filename_from_path(fastq_file_path)} already exist.")
         return
 
-    # get the Centrifuge database path from the config
-    centrifuge_db = get_processing_settings(RawReadsProcessingSteps.CONTAMINATION_CHECK).get(ContaminationCheckSettings.CENTRIFUGE_DB.value)
-
+    centrifuge_db = get_centrifuge_database()
     if not centrifuge_db:
-        print_error("Centrifuge database path is not set. Please check your configuration.")
         return
 
     # https://ccb.jhu.edu/software/centrifuge/manual.shtml#usage
@@ -27,8 +39,8 @@ def run_centrifuge_on_file(species: str, fastq_file_path: str, centrifuge_output
         PROGRAM_PATH_CENTRIFUGE,
         "-x", centrifuge_db,
         "-U", fastq_file_path,
-        "-S", centrifuge_output_txt,
-        "--report-file", centrifuge_report_tsv,
+        "-S", get_temp_file_path(centrifuge_output_txt),
+        "--report-file", get_temp_file_path(centrifuge_report_tsv),
         "--threads", str(threads), # Number of threads        
         "--seed", "999"
     ]
@@ -37,11 +49,10 @@ def run_centrifuge_on_file(species: str, fastq_file_path: str, centrifuge_output
 
     # Execute the command
     try:
-        result = subprocess.run(centrifuge_command, check=True, capture_output=True, text=True)
+        with atomic_output(centrifuge_output_txt, centrifuge_report_tsv):
+            # the summary written by centrifuge to stderr is streamed to the command log
+            run_command(centrifuge_command, capture_output=False)
         print_success(f"Centrifuge analysis complete for {get_filename_from_path(fastq_file_path)}")
-        # Optionally print stdout/stderr for debugging
-        print_debug("Centrifuge stdout:\n" + result.stdout)
-        print_debug("Centrifuge stderr:\n" + result.stderr)
     except subprocess.CalledProcessError as e:
         print_error(f"Centrifuge failed for {get_filename_from_path(fastq_file_path)} with error: {e}")
         print_error("Centrifuge stdout:\n" + e.stdout)
@@ -51,6 +62,170 @@ def run_centrifuge_on_file(species: str, fastq_file_path: str, centrifuge_output
     except Exception as e:
         print_error(f"An unexpected error occurred while running Centrifuge on {get_filename_from_path(fastq_file_path)}: {e}")
 
+def run_centrifuge_on_files_batched(samples: list, threads: int = None):
+    """
+    Classifies the reads of several samples in one centrifuge run, so the index is only loaded once.
+    samples is a list of (fastq file, classification output, report) and each sample gets its own
+    classification output and report, as if centrifuge ran on its fastq file alone:
+    - the reads are passed to centrifuge with the index of their sample in front of the read name
+    - the classification output is split by this index and written without it
+    - the report of each sample is created from its classifications and the taxa of the report of the run
+    """
+    if threads is None:
+        threads = get_task_threads()
+
+    # Check if output files already exist
+    samples = [sample for sample in samples if not (os.path.exists(sample[1]) and os.path.exists(sample[2]))]
+
+    if not samples:
+        print_skipping("Centrifuge output files of all samples already exist.")
+        return
+
+    centrifuge_db = get_centrifuge_database()
+    if not centrifuge_db:
+        return
+
+    print_info(f"Running Centrifuge on {len(samples)} files in one run")
+
+    output_files = [output_file for _, centrifuge_output_txt, centrifuge_report_tsv in samples for output_file in (centrifuge_output_txt, centrifuge_report_tsv)]
+
+    # report of all samples, only used for the taxa
+    batch_report_tsv = get_temp_file_path(os.path.join(os.path.dirname(samples[0][2]), f"centrifuge_batch{FILE_ENDING_CENTRIFUGE_REPORT_TSV}"))
+
+    # the reads are read from stdin and the classification is written to stdout
+    centrifuge_command = [
+        PROGRAM_PATH_CENTRIFUGE,
+        "-x", centrifuge_db,
+        "-U", "-",
+        "--report-file", batch_report_tsv,
+        "--threads", str(threads), # Number of threads
+        "--seed", "999"
+    ]
+
+    print_debug(f"Centrifuge command: {' '.join(centrifuge_command)}")
+
+    # number of reads per combination of taxa they are assigned to, per sample
+    read_classes = [{} for _ in samples]
+    invalid_lines = []
+
+    # the hits of a read are consecutive lines
+    current_read = {'name': None, 'sample_index': None, 'taxids': []}
+
+    def add_current_read():
+        taxids = tuple(taxid for taxid in current_read['taxids'] if taxid != common_contamination.TAXID_UNCLASSIFIED)
+
+        if taxids:
+            sample_read_classes = read_classes[current_read['sample_index']]
+            sample_read_classes[taxids] = sample_read_classes.get(taxids, 0) + 1
+
+    def write_reads(stream):
+        for sample_index, (fastq_file_path, _, _) in enumerate(samples):
+            common_contamination.write_tagged_fastq(fastq_file_path, sample_index, stream)
+
+    try:
+        with atomic_output(*output_files):
+            output_files_per_sample = [open(get_temp_file_path(centrifuge_output_txt), "wb") for _, centrifuge_output_txt, _ in samples]
+
+            def handle_output_line(line: bytes):
+                # errors must not stop the reading, centrifuge would wait for its output to be read
+                try:
+                    tagged_read_name, classification = line.split(b"\t", 1)
+
+                    # header line
+                    if current_read['name'] is None and tagged_read_name == b"readID":
+                        for output_file in output_files_per_sample:
+                            output_file.write(line)
+                        return
+
+                    sample_index, read_name = common_contamination.split_sample_tag(tagged_read_name)
+                    output_file = output_files_per_sample[sample_index]
+                    taxid = classification.split(b"\t", 2)[1].decode()
+                except (ValueError, IndexError):
+                    invalid_lines.append(line)
+                    return
+
+                output_file.write(read_name + b"\t" + classification)
+
+                if tagged_read_name != current_read['name']:
+                    if current_read['name'] is not None:
+                        add_current_read()
+                    current_read.update(name=tagged_read_name, sample_index=sample_index, taxids=[])
+
+                current_read['taxids'].append(taxid)
+
+            try:
+                run_streaming_command(centrifuge_command, write_reads, handle_output_line, description=f"Centrifuge on {len(samples)} files")
+            finally:
+                for output_file in output_files_per_sample:
+                    output_file.close()
+
+            if current_read['name'] is not None:
+                add_current_read()
+
+            if invalid_lines:
+                raise ValueError(f"{len(invalid_lines)} lines of the Centrifuge output could not be assigned to a sample, e.g. {invalid_lines[0][:200]!r}")
+
+            header, taxa = common_contamination.read_centrifuge_report_taxa(batch_report_tsv)
+
+            for sample_index, (_, _, centrifuge_report_tsv) in enumerate(samples):
+                common_contamination.write_centrifuge_report(header, taxa, read_classes[sample_index], get_temp_file_path(centrifuge_report_tsv))
+
+        print_success(f"Centrifuge analysis complete for {len(samples)} files")
+    except subprocess.CalledProcessError as e:
+        print_error(f"Centrifuge failed with error: {e}")
+        print_error("Centrifuge stderr:\n" + e.stderr)
+    except FileNotFoundError:
+         print_error("Centrifuge command not found. Make sure Centrifuge is installed and in your PATH.")
+    except Exception as e:
+        print_error(f"An unexpected error occurred while running Centrifuge on {len(samples)} files: {e}")
+    finally:
+        remove_file_if_exists(batch_report_tsv)
+
+def run_centrifuge_on_unmapped_reads(bam_file_path: str, centrifuge_output_txt: str, centrifuge_report_tsv: str, threads: int = None):
+    """
+    Classifies the reads of a BAM file that did not map to the reference genome.
+    The unmapped reads are piped from samtools to centrifuge, no fastq file is written.
+    """
+    if threads is None:
+        threads = get_task_threads()
+
+    print_info(f"Running Centrifuge on the unmapped reads of: {get_filename_from_path(bam_file_path)}")
+
+    # Check if output files already exist
+    if os.path.exists(centrifuge_output_txt) and os.path.exists(centrifuge_report_tsv):
+        print_skipping(f"Output files for {get_filename_from_path(bam_file_path)} already exist.")
+        return
+
+    centrifuge_db = get_centrifuge_database()
+    if not centrifuge_db:
+        return
+
+    samtools_threads, centrifuge_threads = common_contamination.get_unmapped_reads_threads(threads)
+
+    # the reads are read from stdin
+    centrifuge_command = [
+        PROGRAM_PATH_CENTRIFUGE,
+        "-x", centrifuge_db,
+        "-U", "-",
+        "-S", get_temp_file_path(centrifuge_output_txt),
+        "--report-file", get_temp_file_path(centrifuge_report_tsv),
+        "--threads", str(centrifuge_threads), # Number of threads
+        "--seed", "999"
+    ]
+
+    try:
+        with atomic_output(centrifuge_output_txt, centrifuge_report_tsv):
+            run_piped_commands([common_contamination.get_unmapped_reads_command(bam_file_path, samtools_threads), centrifuge_command],
+                               description=f"samtools fastq | centrifuge for {get_filename_from_path(bam_file_path)}")
+        print_success(f"Centrifuge analysis complete for the unmapped reads of {get_filename_from_path(bam_file_path)}")
+    except subprocess.CalledProcessError as e:
+        print_error(f"Centrifuge failed for the unmapped reads of {get_filename_from_path(bam_file_path)} with error: {e}")
+        print_error("Centrifuge stderr:\n" + e.stderr)
+    except FileNotFoundError:
+         print_error("Centrifuge or samtools command not found. Make sure both are installed and in your PATH.")
+    except Exception as e:
+        print_error(f"An unexpected error occurred while running Centrifuge on the unmapped reads of {get_filename_from_path(bam_file_path)}: {e}")
+
 def analyze_centrifuge_output(output_file_path: str, taxon_counts_output_path: str):
 
     print_info(f"Analyzing Centrifuge output for taxon counts: {get_filename_from_path(output_file_path)}")
@@ -60,33 +235,17 @@ def analyze_centrifuge_output(output_file_path: str, taxon_counts_output_path: s
         print_skipping(f"Taxon counts output file {get_filename_from_path(taxon_counts_output_path)} already exists.")
         return
 
-    # Construct the shell command pipeline
-    # awk '$3 != 0 {print $3}': Filters lines where the 3rd column (abundance) is not 0 and prints the 3rd column (taxon ID)
-    # sort: Sorts the taxon IDs
-    # uniq -c: Counts occurrences of each unique taxon ID
-    # sort -nr: Sorts the counts in reverse numerical order
-    analysis_command = f"awk '$3 != 0 {{print $3}}' {output_file_path} | sort | uniq -c | sort -nr > {taxon_counts_output_path}"
-
-    print_debug(f"Analysis command: {analysis_command}")
-
-    # Execute the command
+    # Count the classifications per taxon in one pass, all taxa sorted by count
+    # the header line and the unclassified reads (taxID 0) are not counted
     try:
-        # Use shell=True because we are using a pipeline with pipes (|) and redirection (>)
-        subprocess.run(analysis_command, shell=True, check=True, capture_output=True, text=True)
+        taxon_counts = common_contamination.count_centrifuge_taxa(output_file_path)
+        common_contamination.write_taxon_counts(common_contamination.get_top_taxa(taxon_counts), taxon_counts_output_path)
         print_success(f"Taxon counts analysis complete. Results written to {get_filename_from_path(taxon_counts_output_path)}")
-        # Optionally print stdout/stderr for debugging
-        # print_debug("Analysis stdout:\n" + result.stdout)
-        # print_debug("Analysis stderr:\n" + result.stderr)
-    except subprocess.CalledProcessError as e:
-        print_error(f"Taxon counts analysis failed for {get_filename_from_path(output_file_path)} with error: {e.returncode}")
-        print_error("Analysis stdout:\n" + e.stdout)
-        print_error("Analysis stderr:\n" + e.stderr)
     except Exception as e:
         print_error(f"An unexpected error occurred during taxon counts analysis of {get_filename_from_path(output_file_path)}: {e}")
 
 
-def run_centrifuge_per_species(species: str):
-    print_info(f"Processing species: {species}")
+def get_centrifuge_fastq_files_for_species(species: str) -> list:
 
     duplicates_removed_folder = get_folder_path_species_processed_duplicates_removed(species)
     
@@ -98,7 +257,7 @@ def run_centrifuge_per_species(species: str):
     # if no files are found, skip species
     if not fastq_files:
         print_warning(f"No duplicate removed FASTQ.GZ files found for species {species}.")
-        return
+        return []
 
     print_info(f"Found {len(fastq_files)} relevant FASTQ.GZ files for species {species}")
     print_debug(f"Files found: {fastq_files}")
@@ -116,23 +275,39 @@ def run_centrifuge_per_species(species: str):
     # if no files remain after filtering, skip species
     if not fastq_files_filtered:
         print_warning(f"No FASTQ.GZ files found for species {species} after filtering.")
-        return
+        return []
 
     print_debug(f"Found {len(fastq_files_filtered)} relevant FASTQ.GZ files after filtering")
     print_debug(f"Files to process: {[os.path.basename(f) for f in fastq_files_filtered]}")
 
-    # Run centrifuge on each filtered file
-    for fastq_file in fastq_files_filtered:
+    return fastq_files_filtered
+
+def get_centrifuge_output_paths(species: str, fastq_file: str) -> tuple[str, str, str]:
 
-        filename_without_ext = get_filename_from_path_without_extension(fastq_file)
-        processed_folder = get_folder_path_species_processed_qc_centrifuge(species)
-        results_folder = get_folder_path_species_results_qc_centrifuge(species)
+    filename_without_ext = get_filename_from_path_without_extension(fastq_file)
+    processed_folder = get_folder_path_species_processed_qc_centrifuge(species)
+    results_folder = get_folder_path_species_results_qc_centrifuge(species)
 
-        # Define output file paths based on the input filename
-        centrifuge_output_txt = os.path.join(processed_folder, f"{filename_without_ext}{FILE_ENDING_CENTRIFUGE_OUTPUT_TXT}")
-        centrifuge_report_tsv = os.path.join(processed_folder, f"{filename_without_ext}{FILE_ENDING_CENTRIFUGE_REPORT_TSV}")
+    # Define output file paths based on the input filename
+    centrifuge_output_txt = os.path.join(processed_folder, f"{filename_without_ext}{FILE_ENDING_CENTRIFUGE_OUTPUT_TXT}")
+    centrifuge_report_tsv = os.path.join(processed_folder, f"{filename_without_ext}{FILE_ENDING_CENTRIFUGE_REPORT_TSV}")
 
-        taxon_counts_output_txt = os.path.join(results_folder, f"{filename_without_ext}{FILE_ENDING_CENTRIFUGE_TAXON_COUNTS_TXT}") # Define analysis output path
+    taxon_counts_output_txt = os.path.join(results_folder, f"{filename_without_ext}{FILE_ENDING_CENTRIFUGE_TAXON_COUNTS_TXT}") # Define analysis output path
+
+    return centrifuge_output_txt, centrifuge_report_tsv, taxon_counts_output_txt
+
+def run_centrifuge_per_species(species: str):
+    print_info(f"Processing species: {species}")
+
+    fastq_files_filtered = get_centrifuge_fastq_files_for_species(species)
+
+    if not fastq_files_filtered:
+        return
+
+    # Run centrifuge on each filtered file
+    for fastq_file in fastq_files_filtered:
+
+        centrifuge_output_txt, centrifuge_report_tsv, taxon_counts_output_txt = get_centrifuge_output_paths(species, fastq_file)
 
         run_centrifuge_on_file(species, fastq_file, centrifuge_output_txt , centrifuge_report_tsv)
 
@@ -140,24 +315,128 @@ def run_centrifuge_per_species(species: str):
 
     print_info(f"Finished processing species: {species}")
 
+def run_centrifuge_batched(species_list: list = None):
+    """
+    Runs Centrifuge on the files of all given species in one centrifuge run, the analysis per file is the same as without batching.
+    """
+    species_list = species_list or FOLDER_SPECIES
+
+    print_info(f"Processing species: {', '.join(species_list)}")
+
+    output_paths = [
+        (fastq_file, *get_centrifuge_output_paths(species, fastq_file))
+        for species in species_list
+        for fastq_file in get_centrifuge_fastq_files_for_species(species)
+    ]
+
+    if not output_paths:
+        print_warning(f"No FASTQ.GZ files found for species {', '.join(species_list)}.")
+        return
+
+    run_centrifuge_on_files_batched([(fastq_file, centrifuge_output_txt, centrifuge_report_tsv) for fastq_file, centrifuge_output_txt, centrifuge_report_tsv, _ in output_paths])
+
+    for _, centrifuge_output_txt, _, taxon_counts_output_txt in output_paths:
+        analyze_centrifuge_output(centrifuge_output_txt, taxon_counts_output_txt)
+
+    print_info(f"Finished processing species: {', '.join(species_list)}")
+
+def get_centrifuge_unmapped_reads_output_paths(species: str, bam_file: str) -> tuple[str, str, str]:
+
+    filename_without_ext = get_filename_from_path(bam_file).replace(FILE_ENDING_SORTED_BAM, "")
+    processed_folder = get_folder_path_species_processed_qc_centrifuge_unmapped_reads(species)
+    results_folder = get_folder_path_species_results_qc_centrifuge_unmapped_reads(species)
+
+    centrifuge_output_txt = os.path.join(processed_folder, f"{filename_without_ext}{FILE_ENDING_CENTRIFUGE_OUTPUT_TXT}")
+    centrifuge_report_tsv = os.path.join(processed_folder, f"{filename_without_ext}{FILE_ENDING_CENTRIFUGE_REPORT_TSV}")
+    taxon_counts_output_txt = os.path.join(results_folder, f"{filename_without_ext}{FILE_ENDING_CENTRIFUGE_TAXON_COUNTS_TXT}")
+
+    return centrifuge_output_txt, centrifuge_report_tsv, taxon_counts_output_txt
+
+def run_centrifuge_on_unmapped_reads_per_species(species: str):
+    """
+    Runs Centrifuge on the reads of each individual that did not map to the reference genome of the contamination check.
+    The summary lists the mapped, unmapped and classified reads per individual.
+    """
+    print_info(f"Processing unmapped reads of species: {species}")
+
+    ref_genome = common_rrp.get_contamination_check_reference_genome(species)
+    if ref_genome is None:
+        return
+
+    ref_genome_id, _ = ref_genome
+
+    bam_files = common_contamination.get_unmapped_reads_bam_files(species, ref_genome_id)
+
+    if not bam_files:
+        print_warning(f"No sorted BAM files found for species {species} and reference genome {ref_genome_id}.")
+        return
+
+    rows = []
+    for bam_file in bam_files:
+
+        centrifuge_output_txt, centrifuge_report_tsv, taxon_counts_output_txt = get_centrifuge_unmapped_reads_output_paths(species, bam_file)
+
+        run_centrifuge_on_unmapped_reads(bam_file, centrifuge_output_txt, centrifuge_report_tsv)
+
+        analyze_centrifuge_output(centrifuge_output_txt, taxon_counts_output_txt)
+
+        if not os.path.exists(centrifuge_output_txt):
+            continue
+
+        try:
+            classified_reads, unclassified_reads = common_contamination.count_centrifuge_classified_reads(centrifuge_output_txt)
+            rows.append(common_contamination.get_unmapped_reads_classification(common_rgp.get_individual_from_file(bam_file), ref_genome_id, bam_file, classified_reads, unclassified_reads))
+        except Exception as e:
+            print_error(f"Failed to count the classified reads of {get_filename_from_path(bam_file)}: {e}")
+
+    if rows:
+        output_path = os.path.join(get_folder_path_species_results_qc_centrifuge_unmapped_reads(species), f"{species}_{ref_genome_id}{FILE_ENDING_UNMAPPED_READS_CLASSIFICATION_CSV}")
+        common_contamination.write_unmapped_reads_classification(rows, output_path)
+        print_info(f"Saved the classification of the unmapped reads to: {output_path}")
+
+    print_info(f"Finished processing unmapped reads of species: {species}")
+
 def all_species_run_centrifuge():
     print_execution("Starting Centrifuge analysis for all species on individual deduplicated FASTQ files.")
 
-    # get the Centrifuge database path from the config
-    centrifuge_db = get_processing_settings(RawReadsProcessingSteps.CONTAMINATION_CHECK).get(ContaminationCheckSettings.CENTRIFUGE_DB.value)
-
-    if not centrifuge_db:
-        print_error("Centrifuge database path is not set. Please check your configuration.")
+    if not get_centrifuge_database():
         return
 
-    for species in FOLDER_SPECIES:
-        run_centrifuge_per_species(species)
+    # with unmapped reads only, the reads are classified after the mapping (see all_species_run_centrifuge_on_unmapped_reads)
+    all_reads_species = [species for species in FOLDER_SPECIES if not common_rrp.is_contamination_check_unmapped_reads_only(species)]
+
+    if common_rrp.is_centrifuge_batch_mode():
+        if all_reads_species:
+            run_centrifuge_batched(all_reads_species)
+    else:
+        for species in all_reads_species:
+            run_centrifuge_per_species(species)
 
     print_success("Finished Centrifuge analysis for all species.")
 
+def all_species_run_centrifuge_on_unmapped_reads():
+    """
+    Classifies the unmapped reads of the species checked with unmapped reads only. Runs after the mapping.
+    """
+    unmapped_reads_species = [species for species in FOLDER_SPECIES if common_rrp.is_contamination_check_unmapped_reads_only(species)]
+
+    if not unmapped_reads_species:
+        return
+
+    print_execution("Starting Centrifuge analysis of the unmapped reads.")
+
+    if not get_centrifuge_database():
+        return
+
+    for species in unmapped_reads_species:
+        run_centrifuge_on_unmapped_reads_per_species(species)
+
+    print_success("Finished Centrifuge analysis of the unmapped reads.")
+
 
 def main():
     all_species_run_centrifuge()
+    all_species_run_centrifuge_on_unmapped_reads()
 
 if __name__ == "__main__":
     main()
@@ -4,7 +4,10 @@ import subprocess
 import common_aDNA_scripts as common_adna
 
 
-def run_ecmsd_on_file(species: str, fastq_file_path: str, output_folder: str, threads: int = common_adna.THREADS_DEFAULT):
+def run_ecmsd_on_file(species: str, fastq_file_path: str, output_folder: str, threads: int = None):
+    if threads is None:
+        threads = common_adna.get_task_threads()
+
     common_adna.print_info(f"Running ECMSD on file: {common_adna.get_filename_from_path(fastq_file_path)}")
 
     # Create output folder if it doesn't exist
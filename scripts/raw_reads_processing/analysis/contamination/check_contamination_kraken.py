@@ -4,37 +4,94 @@ import pandas as pd
 from collections import defaultdict
 
 from common_aDNA_scripts import *
+import raw_reads_processing.common_raw_reads_processing_helpers as common_rrp
+import ref_genome_processing.common_ref_genome_processing_helpers as common_rgp
+import raw_reads_processing.analysis.contamination.common_contamination_helpers as common_contamination
 
 
-def run_kraken_on_file(species: str, fastq_file_path: str,  Kraken_report_tsv: str, threads: int = THREADS_DEFAULT):
-   
-    print_info(f"Running Kraken on file: {os.path.basename(fastq_file_path)}")
+def is_kraken_per_read_output_enabled(species: str) -> bool:
+    # the top 5 analysis only needs the summary report, the per-read output has one line per read
+    settings = get_processing_settings(RawReadsProcessingSteps.CONTAMINATION_CHECK, species)
+    return bool(settings.get(ContaminationCheckSettings.KRAKEN_PER_READ_OUTPUT.value, True))
 
-    # Check if output files already exist
-    if os.path.exists(Kraken_report_tsv):
-        print_skipping(f"Output files {Kraken_report_tsv} already exist.")
-        return
-    
+def is_kraken_memory_mapping_enabled() -> bool:
+    # the database is mapped from the page cache instead of loaded into the memory of each run
+    settings = get_processing_settings(RawReadsProcessingSteps.CONTAMINATION_CHECK)
+    return bool(settings.get(ContaminationCheckSettings.KRAKEN_MEMORY_MAPPING.value, False))
+
+def get_kraken_database() -> str | None:
     # get the Kraken database path from the config
     Kraken_db = get_processing_settings(RawReadsProcessingSteps.CONTAMINATION_CHECK).get(ContaminationCheckSettings.KRAKEN_DB.value)
 
     # Ensure Kraken2 database path is set and exists
     if not Kraken_db:
         print_error("Kraken2 database path is not set. Please check your pipeline configuration.")
-        return
+        return None
     
     if not os.path.exists(Kraken_db):
         print_error(f"Kraken2 database path does not exist: {Kraken_db}")
+        return None
+
+    return Kraken_db
+
+def get_kraken_database_options(Kraken_db: str) -> list:
+    if is_kraken_memory_mapping_enabled():
+        return ["--db", Kraken_db, "--memory-mapping"]
+    return ["--db", Kraken_db]
+
+def warm_up_kraken_database(Kraken_db: str):
+    """
+    With memory mapping, the database files are read into the page cache once, so the kraken2 runs
+    of all samples use the cached database instead of loading it again.
+    """
+    if not is_kraken_memory_mapping_enabled():
+        return
+
+    database_files = get_files_in_folder_matching_pattern(Kraken_db, "*.k2d")
+
+    print_info(f"Reading Kraken2 database {Kraken_db} into the page cache")
+
+    try:
+        common_contamination.warm_up_page_cache(database_files)
+    except Exception as e:
+        print_warning(f"Could not read Kraken2 database {Kraken_db} into the page cache: {e}")
+
+def is_kraken_output_existing(species: str, Kraken_report_tsv: str, kraken_summary_report_tsv: str) -> bool:
+    # a per-read output of an earlier run without summary report is enough for the analysis
+    return os.path.exists(Kraken_report_tsv) or (os.path.exists(kraken_summary_report_tsv) and not is_kraken_per_read_output_enabled(species))
+
+def run_kraken_on_file(species: str, fastq_file_path: str,  Kraken_report_tsv: str, kraken_summary_report_tsv: str, threads: int = None):
+    if threads is None:
+        threads = get_task_threads()
+
+    print_info(f"Running Kraken on file: {os.path.basename(fastq_file_path)}")
+
+    # Check if output files already exist
+    if is_kraken_output_existing(species, Kraken_report_tsv, kraken_summary_report_tsv):
+        print_skipping(f"Output files for {get_filename_from_path(fastq_file_path)} already exist.")
         return
+    
+    Kraken_db = get_kraken_database()
+    if not Kraken_db:
+        return
+
+    per_read_output = is_kraken_per_read_output_enabled(species)
+
+    output_files = [kraken_summary_report_tsv]
+    if per_read_output:
+        output_files.append(Kraken_report_tsv)
 
     # Construct the kraken2 command
     # Using --gzip-compressed assumes the input is .gz
+    # the summary report holds the read counts per taxon. Without per-read output,
+    # the classification of each read is discarded instead of written
     kraken2_command = [
         PROGRAM_PATH_KRAKEN,
-        "--db", Kraken_db,
+        *get_kraken_database_options(Kraken_db),
         "--threads", str(threads),
         "--gzip-compressed",
-        "--output", Kraken_report_tsv,
+        "--report", get_temp_file_path(kraken_summary_report_tsv),
+        "--output", get_temp_file_path(Kraken_report_tsv) if per_read_output else os.devnull,
         fastq_file_path # Input file
     ]
 
@@ -42,12 +99,10 @@ def run_kraken_on_file(species: str, fastq_file_path: str,  Kraken_report_tsv: s
 
     # Execute the command
     try:
-        # Using capture_output=True and text=True to get stdout/stderr in case of errors
-        result = subprocess.run(kraken2_command, check=True, capture_output=True, text=True)
+        with atomic_output(*output_files):
+            # the summary written by kraken2 to stderr is streamed to the command log
+            run_command(kraken2_command, capture_output=False)
         print_success(f"Kraken2 analysis complete for {get_filename_from_path(fastq_file_path)}")
-        # Optionally print stdout/stderr for debugging
-        print_debug("Kraken2 stdout:\n" + result.stdout)
-        print_debug("Kraken2 stderr:\n" + result.stderr)
     except subprocess.CalledProcessError as e:
         print_error(f"Kraken2 failed for {get_filename_from_path(fastq_file_path)} with error: {e.returncode}")
         print_error("Kraken2 stdout:\n" + e.stdout)
@@ -57,40 +112,191 @@ def run_kraken_on_file(species: str, fastq_file_path: str,  Kraken_report_tsv: s
     except Exception as e:
         print_error(f"An unexpected error occurred while running Kraken2 on {get_filename_from_path(fastq_file_path)}: {e}")
 
-def create_kraken_top5_analysis(report_file_path: str, output_file_path: str):
+def run_kraken_on_files_batched(samples: list, threads: int = None):
+    """
+    Classifies the reads of several samples in one kraken2 run, so the database is only loaded once.
+    samples is a list of (species, fastq file, per-read output, summary report) and the outputs
+    of each sample are the same as if kraken2 ran on its fastq file alone:
+    - the reads are passed to kraken2 with the index of their sample in front of the read name
+    - the per-read output is split by this index and written without it
+    - the summary report of each sample is created from its read counts and the taxa of the report of the run
+    """
+    if threads is None:
+        threads = get_task_threads()
+
+    # Check if output files already exist
+    samples = [sample for sample in samples if not is_kraken_output_existing(sample[0], sample[2], sample[3])]
+
+    if not samples:
+        print_skipping("Kraken2 output files of all samples already exist.")
+        return
+
+    Kraken_db = get_kraken_database()
+    if not Kraken_db:
+        return
+
+    print_info(f"Running Kraken on {len(samples)} files in one run")
+
+    per_read_outputs = [is_kraken_per_read_output_enabled(species) for species, _, _, _ in samples]
+
+    output_files = []
+    for (_, _, Kraken_report_tsv, kraken_summary_report_tsv), per_read_output in zip(samples, per_read_outputs):
+        output_files.append(kraken_summary_report_tsv)
+        if per_read_output:
+            output_files.append(Kraken_report_tsv)
+
+    # report of all samples, only used for the taxa
+    batch_report_tsv = get_temp_file_path(os.path.join(os.path.dirname(samples[0][3]), f"kraken_batch{FILE_ENDING_KRAKEN_SUMMARY_REPORT_TSV}"))
+
+    # the reads are read from stdin and the per-read output is written to stdout
+    kraken2_command = [
+        PROGRAM_PATH_KRAKEN,
+        *get_kraken_database_options(Kraken_db),
+        "--threads", str(threads),
+        "--report", batch_report_tsv,
+    ]
+
+    print_debug(f"Kraken2 command: {' '.join(kraken2_command)}")
+
+    taxon_counts = [{} for _ in samples]
+    unclassified_counts = [0 for _ in samples]
+    invalid_lines = []
+
+    def write_reads(stream):
+        for sample_index, (_, fastq_file_path, _, _) in enumerate(samples):
+            common_contamination.write_tagged_fastq(fastq_file_path, sample_index, stream)
+
+    try:
+        with atomic_output(*output_files):
+            per_read_files = [
+                open(get_temp_file_path(Kraken_report_tsv), "wb") if per_read_output else None
+                for (_, _, Kraken_report_tsv, _), per_read_output in zip(samples, per_read_outputs)
+            ]
+
+            def handle_output_line(line: bytes):
+                # errors must not stop the reading, kraken2 would wait for its output to be read
+                try:
+                    status, tagged_read_name, classification = line.split(b"\t", 2)
+                    sample_index, read_name = common_contamination.split_sample_tag(tagged_read_name)
+                    per_read_file = per_read_files[sample_index]
+                except (ValueError, IndexError):
+                    invalid_lines.append(line)
+                    return
+
+                if per_read_file is not None:
+                    per_read_file.write(b"\t".join((status, read_name, classification)))
+
+                if status == common_contamination.KRAKEN_STATUS_CLASSIFIED:
+                    taxid = classification.split(b"\t", 1)[0]
+                    taxon_counts[sample_index][taxid] = taxon_counts[sample_index].get(taxid, 0) + 1
+                else:
+                    unclassified_counts[sample_index] += 1
+
+            try:
+                run_streaming_command(kraken2_command, write_reads, handle_output_line, description=f"Kraken2 on {len(samples)} files")
+            finally:
+                for per_read_file in per_read_files:
+                    if per_read_file is not None:
+                        per_read_file.close()
+
+            if invalid_lines:
+                raise ValueError(f"{len(invalid_lines)} lines of the Kraken2 output could not be assigned to a sample, e.g. {invalid_lines[0][:200]!r}")
+
+            top_level_taxa = common_contamination.read_kraken_report_taxonomy(batch_report_tsv)
+
+            for sample_index, (_, _, _, kraken_summary_report_tsv) in enumerate(samples):
+                sample_taxon_counts = {taxid.decode(): count for taxid, count in taxon_counts[sample_index].items()}
+                common_contamination.write_kraken_report(top_level_taxa, sample_taxon_counts, unclassified_counts[sample_index], get_temp_file_path(kraken_summary_report_tsv))
+
+        print_success(f"Kraken2 analysis complete for {len(samples)} files")
+    except subprocess.CalledProcessError as e:
+        print_error(f"Kraken2 failed with error: {e.returncode}")
+        print_error("Kraken2 stderr:\n" + e.stderr)
+    except FileNotFoundError:
+         print_error("Kraken2 command not found. Make sure kraken2 is installed and in your PATH.")
+    except Exception as e:
+        print_error(f"An unexpected error occurred while running Kraken2 on {len(samples)} files: {e}")
+    finally:
+        remove_file_if_exists(batch_report_tsv)
+
+def run_kraken_on_unmapped_reads(species: str, bam_file_path: str, Kraken_report_tsv: str, kraken_summary_report_tsv: str, threads: int = None):
+    """
+    Classifies the reads of a BAM file that did not map to the reference genome.
+    The unmapped reads are piped from samtools to kraken2, no fastq file is written.
+    """
+    if threads is None:
+        threads = get_task_threads()
+
+    print_info(f"Running Kraken on the unmapped reads of: {get_filename_from_path(bam_file_path)}")
+
+    # Check if output files already exist
+    if is_kraken_output_existing(species, Kraken_report_tsv, kraken_summary_report_tsv):
+        print_skipping(f"Output files for {get_filename_from_path(bam_file_path)} already exist.")
+        return
+
+    Kraken_db = get_kraken_database()
+    if not Kraken_db:
+        return
+
+    per_read_output = is_kraken_per_read_output_enabled(species)
+
+    output_files = [kraken_summary_report_tsv]
+    if per_read_output:
+        output_files.append(Kraken_report_tsv)
+
+    samtools_threads, kraken_threads = common_contamination.get_unmapped_reads_threads(threads)
+
+    # without input file, kraken2 reads the uncompressed reads from stdin
+    kraken2_command = [
+        PROGRAM_PATH_KRAKEN,
+        *get_kraken_database_options(Kraken_db),
+        "--threads", str(kraken_threads),
+        "--report", get_temp_file_path(kraken_summary_report_tsv),
+        "--output", get_temp_file_path(Kraken_report_tsv) if per_read_output else os.devnull,
+    ]
+
+    try:
+        with atomic_output(*output_files):
+            run_piped_commands([common_contamination.get_unmapped_reads_command(bam_file_path, samtools_threads), kraken2_command],
+                               description=f"samtools fastq | kraken2 for {get_filename_from_path(bam_file_path)}")
+        print_success(f"Kraken2 analysis complete for the unmapped reads of {get_filename_from_path(bam_file_path)}")
+    except subprocess.CalledProcessError as e:
+        print_error(f"Kraken2 failed for the unmapped reads of {get_filename_from_path(bam_file_path)} with error: {e.returncode}")
+        print_error("Kraken2 stderr:\n" + e.stderr)
+    except FileNotFoundError:
+         print_error("Kraken2 or samtools command not found. Make sure both are installed and in your PATH.")
+    except Exception as e:
+        print_error(f"An unexpected error occurred while running Kraken2 on the unmapped reads of {get_filename_from_path(bam_file_path)}: {e}")
 
-    print_info(f"Analyzing Kraken2 report: {get_filename_from_path(report_file_path)}")
+def create_kraken_top5_analysis(report_file_path: str, summary_report_file_path: str, output_file_path: str):
 
     # Check if output file already exists
     if os.path.exists(output_file_path):
         print_skipping(f"Analysis output file {get_filename_from_path(output_file_path)} already exists.")
         return
 
-    # Construct the shell command pipeline
-    # awk '$1 == "C" {print $3}': Filters lines starting with 'C' and prints the 3rd column (species name)
-    # sort: Sorts the species names alphabetically
-    # uniq -c: Counts occurrences of each unique species name
-    # sort -nr: Sorts the counts in reverse numerical order
-    # head -5: Takes the top 5 entries
-    analysis_command = f"awk '$1 == \"C\" {{print $3}}' {report_file_path} | sort | uniq -c | sort -nr | head -5 > {output_file_path}"
+    # the summary report is small, the per-read output is only counted if there is no summary report
+    source_file_path = summary_report_file_path if os.path.exists(summary_report_file_path) else report_file_path
 
-    print_debug(f"Analysis command: {analysis_command}")
+    print_info(f"Analyzing Kraken2 report: {get_filename_from_path(source_file_path)}")
 
-    # Execute the command
+    if not os.path.exists(source_file_path):
+        print_error(f"Kraken2 report not found: {source_file_path}")
+        return
+
+    # Count the classified reads per taxon in one pass and keep the top 5
     try:
-        # Use shell=True because we are using a pipeline with pipes (|) and redirection (>)
-        subprocess.run(analysis_command, shell=True, check=True, capture_output=True, text=True)
+        if source_file_path == summary_report_file_path:
+            taxon_counts = common_contamination.count_kraken_report_taxa(source_file_path)
+        else:
+            taxon_counts = common_contamination.count_kraken_classified_taxa(source_file_path)
+
+        common_contamination.write_taxon_counts(common_contamination.get_top_taxa(taxon_counts, 5), output_file_path)
         print_success(f"Analysis complete. Top 5 species written to {get_filename_from_path(output_file_path)}")
-        # Optionally print stdout/stderr for debugging
-        # print_debug("Analysis stdout:\n" + result.stdout)
-        # print_debug("Analysis stderr:\n" + result.stderr)
-    except subprocess.CalledProcessError as e:
-        print_error(f"Analysis failed for {get_filename_from_path(report_file_path)} with error: {e.returncode}")
-        print_error("Analysis stdout:\n" + e.stdout)
-        print_error("Analysis stderr:\n" + e.stderr)
     except Exception as e:
-        print_error(f"An unexpected error occurred during analysis of {get_filename_from_path(report_file_path)}: {e}")
+        print_error(f"An unexpected error occurred during analysis of {get_filename_from_path(source_file_path)}: {e}")
 
+@track_resource_usage
 def combine_kraken2_top5_analysis(species: str):
     # Print which species is being analyzed
     print(f"Combining Kraken2 top 5 analysis for species: {species}")
@@ -175,24 +381,26 @@ def combine_kraken2_top5_analysis(species: str):
 
     # Save the DataFrame as a CSV file
     output_path = os.path.join(results_folder, f"{species}{FILE_ENDING_KRAKEN_ALL_READS_COMBINED_ANALYSIS_CSV}")
-    df.to_csv(output_path, index=False)
+    with atomic_output(output_path) as temp_output_path:
+        df.to_csv(temp_output_path, index=False)
     print_info(f"Saved combined Kraken2 report to: {output_path}")
 
     # combine by individuum
     individuum_combined = df.groupby(['individuum']).sum(numeric_only=True).reset_index()
     individuum_combined_output_path = os.path.join(results_folder, f"{species}{FILE_ENDING_KRAKEN_BY_INDIVIDUAL_COMBINED_ANALYSIS_CSV}")
-    individuum_combined.to_csv(individuum_combined_output_path, index=False)
+    with atomic_output(individuum_combined_output_path) as temp_output_path:
+        individuum_combined.to_csv(temp_output_path, index=False)
     print_info(f"Saved combined Kraken2 report to: {individuum_combined_output_path}")
 
     # combine by protocol
     protocol_combined = df.groupby(['protocol']).sum(numeric_only=True).reset_index()
     protocol_combined_output_path = os.path.join(results_folder, f"{species}{FILE_ENDING_KRAKEN_BY_PROTOCOL_COMBINED_ANALYSIS_CSV}")
-    protocol_combined.to_csv(protocol_combined_output_path, index=False)
+    with atomic_output(protocol_combined_output_path) as temp_output_path:
+        protocol_combined.to_csv(temp_output_path, index=False)
     print_info(f"Saved combined Kraken2 report to: {protocol_combined_output_path}")
     
 
-def run_Kraken_per_species(species: str):
-    print_info(f"Processing species: {species}")
+def get_kraken_fastq_files_for_species(species: str) -> list:
 
     duplicates_removed_folder = get_folder_path_species_processed_duplicates_removed(species)
     
@@ -204,7 +412,7 @@ def run_Kraken_per_species(species: str):
     # if no files are found, skip species
     if not fastq_files:
         print_warning(f"No duplicate removed FASTQ.GZ files found for species {species}.")
-        return
+        return []
 
     print_info(f"Found {len(fastq_files)} relevant FASTQ.GZ files for species {species}")
     print_debug(f"Files found: {fastq_files}")
@@ -222,49 +430,186 @@ def run_Kraken_per_species(species: str):
     # if no files remain after filtering, skip species
     if not fastq_files_filtered:
         print_warning(f"No FASTQ.GZ files found for species {species} after filtering.")
-        return
+        return []
 
     print_debug(f"Found {len(fastq_files_filtered)} relevant FASTQ.GZ files after filtering")
     print_debug(f"Files to process: {[get_filename_from_path(f) for f in fastq_files_filtered]}")
 
+    return fastq_files_filtered
+
+def get_kraken_output_paths(species: str, fastq_file: str) -> tuple[str, str, str]:
+
+    filename_without_ext = get_filename_from_path_without_extension(fastq_file)
+    processed_folder = get_folder_path_species_processed_qc_kraken(species)
+    results_folder = get_folder_path_species_results_qc_kraken(species)
+
+    # Define output file paths based on the input filename
+    kraken_report_tsv = os.path.join(processed_folder, f"{filename_without_ext}{FILE_ENDING_KRAKEN_REPORT_TSV}")
+    kraken_summary_report_tsv = os.path.join(processed_folder, f"{filename_without_ext}{FILE_ENDING_KRAKEN_SUMMARY_REPORT_TSV}")
+    analysis_output_txt = os.path.join(results_folder, f"{filename_without_ext}{FILE_ENDING_KRAKEN_TOP5_ANALYSIS_TSV}") # Define analysis output path
+
+    return kraken_report_tsv, kraken_summary_report_tsv, analysis_output_txt
+
+def run_Kraken_per_species(species: str):
+    print_info(f"Processing species: {species}")
+
+    fastq_files_filtered = get_kraken_fastq_files_for_species(species)
+
+    if not fastq_files_filtered:
+        return
+
+    Kraken_db = get_kraken_database()
+    if Kraken_db:
+        warm_up_kraken_database(Kraken_db)
+
     # Run Kraken on each filtered file
     for fastq_file in fastq_files_filtered:
 
-        filename_without_ext = get_filename_from_path_without_extension(fastq_file)
-        processed_folder = get_folder_path_species_processed_qc_kraken(species)
-        results_folder = get_folder_path_species_results_qc_kraken(species)
-
-        # Define output file paths based on the input filename
-        kraken_report_tsv = os.path.join(processed_folder, f"{filename_without_ext}{FILE_ENDING_KRAKEN_REPORT_TSV}")
-        analysis_output_txt = os.path.join(results_folder, f"{filename_without_ext}{FILE_ENDING_KRAKEN_TOP5_ANALYSIS_TSV}") # Define analysis output path
+        kraken_report_tsv, kraken_summary_report_tsv, analysis_output_txt = get_kraken_output_paths(species, fastq_file)
 
-        run_kraken_on_file(species, fastq_file, kraken_report_tsv)
+        run_kraken_on_file(species, fastq_file, kraken_report_tsv, kraken_summary_report_tsv)
 
-        create_kraken_top5_analysis(kraken_report_tsv, analysis_output_txt)
+        create_kraken_top5_analysis(kraken_report_tsv, kraken_summary_report_tsv, analysis_output_txt)
 
     combine_kraken2_top5_analysis(species)
 
     print_info(f"Finished processing species: {species}")
 
+def run_Kraken_batched(species_list: list = None):
+    """
+    Runs Kraken on the files of all given species in one kraken2 run, the analysis per species is the same as without batching.
+    """
+    species_list = species_list or FOLDER_SPECIES
+
+    print_info(f"Processing species: {', '.join(species_list)}")
+
+    samples = []
+    for species in species_list:
+        for fastq_file in get_kraken_fastq_files_for_species(species):
+            kraken_report_tsv, kraken_summary_report_tsv, _ = get_kraken_output_paths(species, fastq_file)
+            samples.append((species, fastq_file, kraken_report_tsv, kraken_summary_report_tsv))
+
+    if not samples:
+        print_warning(f"No FASTQ.GZ files found for species {', '.join(species_list)}.")
+        return
+
+    Kraken_db = get_kraken_database()
+    if Kraken_db:
+        warm_up_kraken_database(Kraken_db)
+
+    run_kraken_on_files_batched(samples)
+
+    for species, fastq_file, kraken_report_tsv, kraken_summary_report_tsv in samples:
+        _, _, analysis_output_txt = get_kraken_output_paths(species, fastq_file)
+        create_kraken_top5_analysis(kraken_report_tsv, kraken_summary_report_tsv, analysis_output_txt)
+
+    for species in species_list:
+        combine_kraken2_top5_analysis(species)
+
+    print_info(f"Finished processing species: {', '.join(species_list)}")
+
+def get_kraken_unmapped_reads_output_paths(species: str, bam_file: str) -> tuple[str, str, str]:
+
+    filename_without_ext = get_filename_from_path(bam_file).replace(FILE_ENDING_SORTED_BAM, "")
+    processed_folder = get_folder_path_species_processed_qc_kraken_unmapped_reads(species)
+    results_folder = get_folder_path_species_results_qc_kraken_unmapped_reads(species)
+
+    kraken_report_tsv = os.path.join(processed_folder, f"{filename_without_ext}{FILE_ENDING_KRAKEN_REPORT_TSV}")
+    kraken_summary_report_tsv = os.path.join(processed_folder, f"{filename_without_ext}{FILE_ENDING_KRAKEN_SUMMARY_REPORT_TSV}")
+    analysis_output_txt = os.path.join(results_folder, f"{filename_without_ext}{FILE_ENDING_KRAKEN_TOP5_ANALYSIS_TSV}")
+
+    return kraken_report_tsv, kraken_summary_report_tsv, analysis_output_txt
+
+def run_Kraken_on_unmapped_reads_per_species(species: str):
+    """
+    Runs Kraken on the reads of each individual that did not map to the reference genome of the contamination check.
+    The summary lists the mapped, unmapped and classified reads per individual.
+    """
+    print_info(f"Processing unmapped reads of species: {species}")
+
+    ref_genome = common_rrp.get_contamination_check_reference_genome(species)
+    if ref_genome is None:
+        return
+
+    ref_genome_id, _ = ref_genome
+
+    bam_files = common_contamination.get_unmapped_reads_bam_files(species, ref_genome_id)
+
+    if not bam_files:
+        print_warning(f"No sorted BAM files found for species {species} and reference genome {ref_genome_id}.")
+        return
+
+    Kraken_db = get_kraken_database()
+    if Kraken_db:
+        warm_up_kraken_database(Kraken_db)
+
+    rows = []
+    for bam_file in bam_files:
+
+        kraken_report_tsv, kraken_summary_report_tsv, analysis_output_txt = get_kraken_unmapped_reads_output_paths(species, bam_file)
+
+        run_kraken_on_unmapped_reads(species, bam_file, kraken_report_tsv, kraken_summary_report_tsv)
+
+        create_kraken_top5_analysis(kraken_report_tsv, kraken_summary_report_tsv, analysis_output_txt)
+
+        if not os.path.exists(kraken_summary_report_tsv):
+            continue
+
+        try:
+            classified_reads, unclassified_reads = common_contamination.get_kraken_report_read_counts(kraken_summary_report_tsv)
+            rows.append(common_contamination.get_unmapped_reads_classification(common_rgp.get_individual_from_file(bam_file), ref_genome_id, bam_file, classified_reads, unclassified_reads))
+        except Exception as e:
+            print_error(f"Failed to count the classified reads of {get_filename_from_path(bam_file)}: {e}")
+
+    if rows:
+        output_path = os.path.join(get_folder_path_species_results_qc_kraken_unmapped_reads(species), f"{species}_{ref_genome_id}{FILE_ENDING_UNMAPPED_READS_CLASSIFICATION_CSV}")
+        common_contamination.write_unmapped_reads_classification(rows, output_path)
+        print_info(f"Saved the classification of the unmapped reads to: {output_path}")
+
+    print_info(f"Finished processing unmapped reads of species: {species}")
+
 def all_species_run_Kraken():
     print_execution("Starting Kraken analysis for all species on individual deduplicated FASTQ files.")
 
-     # get the Kraken database path from the config
-    Kraken_db = get_processing_settings(RawReadsProcessingSteps.CONTAMINATION_CHECK).get(ContaminationCheckSettings.KRAKEN_DB.value)
-
     # Ensure Kraken2 database path is set and exists
-    if not Kraken_db:
-        print_error("Kraken2 database path is not set. Please check your pipeline configuration.")
+    if not get_kraken_database():
         return
 
-    for species in FOLDER_SPECIES:
-        run_Kraken_per_species(species)
+    # with unmapped reads only, the reads are classified after the mapping (see all_species_run_Kraken_on_unmapped_reads)
+    all_reads_species = [species for species in FOLDER_SPECIES if not common_rrp.is_contamination_check_unmapped_reads_only(species)]
+
+    if common_rrp.is_kraken_batch_mode():
+        if all_reads_species:
+            run_Kraken_batched(all_reads_species)
+    else:
+        for species in all_reads_species:
+            run_Kraken_per_species(species)
 
     print_success("Finished Kraken analysis for all species.")
 
+def all_species_run_Kraken_on_unmapped_reads():
+    """
+    Classifies the unmapped reads of the species checked with unmapped reads only. Runs after the mapping.
+    """
+    unmapped_reads_species = [species for species in FOLDER_SPECIES if common_rrp.is_contamination_check_unmapped_reads_only(species)]
+
+    if not unmapped_reads_species:
+        return
+
+    print_execution("Starting Kraken analysis of the unmapped reads.")
+
+    if not get_kraken_database():
+        return
+
+    for species in unmapped_reads_species:
+        run_Kraken_on_unmapped_reads_per_species(species)
+
+    print_success("Finished Kraken analysis of the unmapped reads.")
+
 
 def main():
     all_species_run_Kraken()
+    all_species_run_Kraken_on_unmapped_reads()
 
 if __name__ == "__main__":
     main()
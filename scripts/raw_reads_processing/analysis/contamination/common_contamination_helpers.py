@@ -0,0 +1,402 @@
+import csv
+import heapq
+from dataclasses import dataclass, field
+import common_aDNA_scripts as common
+import ref_genome_processing.common_ref_genome_processing_helpers as common_rgp
+from raw_reads_processing.analysis.fastq_scanner import open_fastq
+
+# taxid of the reads that could not be classified
+TAXID_UNCLASSIFIED = "0"
+
+# status of a classified read in the per-read output of kraken2
+KRAKEN_STATUS_CLASSIFIED = b"C"
+
+# separator between the sample tag and the read name in a classification of several samples
+SAMPLE_TAG_SEPARATOR = b"|"
+
+# lines of a fastq file read at once when the reads are tagged
+TAGGED_READS_BLOCK_SIZE = 16 * 1024 * 1024
+
+# block size used to read database files into the page cache
+PAGE_CACHE_BLOCK_SIZE = 64 * 1024 * 1024
+
+# abundance of the centrifuge reports of a batch run, centrifuge only estimates it for all samples together
+CENTRIFUGE_ABUNDANCE_NOT_AVAILABLE = "NA"
+
+# columns of the summary of the classification of the unmapped reads
+UNMAPPED_READS_CLASSIFICATION_COLUMNS = ["individual", "reference_genome", "mapped_reads", "unmapped_reads", "classified_reads", "unclassified_reads", "classified_proportion"]
+
+@dataclass
+class KrakenReportTaxon:
+    """
+    A taxon of a kraken2 report and its children, as listed in the report.
+    """
+    taxid: str
+    rank: str
+    # name with the indentation of the report, two spaces per level
+    name: str
+    children: list = field(default_factory=list)
+
+def count_kraken_classified_taxa(kraken_output_file: str) -> dict:
+    """
+    Number of classified reads per taxid in the per-read output of kraken2.
+    The file is read line by line and only one count per taxon is kept, so the memory
+    does not depend on the number of reads.
+    Columns: status (C/U), read id, taxid, read length, LCA mapping
+    """
+    counts = {}
+
+    with open(kraken_output_file, "rb") as f:
+        for line in f:
+            columns = line.split(b"\t", 3)
+
+            if len(columns) < 3 or columns[0] != KRAKEN_STATUS_CLASSIFIED:
+                continue
+
+            taxid = columns[2]
+            counts[taxid] = counts.get(taxid, 0) + 1
+
+    return {taxid.decode(): count for taxid, count in counts.items()}
+
+def count_kraken_report_taxa(kraken_summary_report: str) -> dict:
+    """
+    Number of classified reads per taxid in the report written by kraken2 --report.
+    The reads assigned directly to a taxon are the same as the classified reads with
+    this taxid in the per-read output, so the per-read output is not needed for the counts.
+    Columns: percentage, reads of the clade, reads assigned directly, rank, taxid, name
+    """
+    counts = {}
+
+    with open(kraken_summary_report, "r") as f:
+        for line in f:
+            columns = line.rstrip("\n").split("\t")
+
+            if len(columns) < 6:
+                continue
+
+            taxid = columns[4].strip()
+            direct_reads = int(columns[2])
+
+            if taxid == TAXID_UNCLASSIFIED or direct_reads == 0:
+                continue
+
+            counts[taxid] = counts.get(taxid, 0) + direct_reads
+
+    return counts
+
+def count_centrifuge_taxa(centrifuge_output_file: str) -> dict:
+    """
+    Number of classifications per taxid in the per-read output of centrifuge.
+    A read with several best hits has one line per hit, each line is counted.
+    Columns: readID, seqID, taxID, score, 2ndBestScore, hitLength, queryLength, numMatches
+    """
+    counts = {}
+
+    with open(centrifuge_output_file, "rb") as f:
+        # header line
+        f.readline()
+
+        for line in f:
+            columns = line.split(b"\t", 3)
+
+            if len(columns) < 3:
+                continue
+
+            taxid = columns[2]
+            counts[taxid] = counts.get(taxid, 0) + 1
+
+    counts.pop(TAXID_UNCLASSIFIED.encode(), None)
+
+    return {taxid.decode(): count for taxid, count in counts.items()}
+
+def get_top_taxa(taxon_counts: dict, top_n: int = None) -> list:
+    """
+    Taxa with the highest counts as list of (taxid, count), highest count first.
+    Taxa with the same count are ordered as sort -nr did before: it compares the whole lines of
+    uniq -c in reverse, so the taxids are compared as text, e.g. 9606 comes before 10000.
+    If top_n is None, all taxa are returned.
+    """
+    def sort_key(item):
+        taxid, count = item
+        return (count, taxid)
+
+    if top_n is None:
+        return sorted(taxon_counts.items(), key=sort_key, reverse=True)
+
+    return heapq.nlargest(top_n, taxon_counts.items(), key=sort_key)
+
+def write_taxon_counts(top_taxa: list, output_file_path: str):
+    """
+    Writes the taxon counts in the format of uniq -c: count and taxid per line.
+    """
+    with common.atomic_output(output_file_path) as temp_output_path:
+        with open(temp_output_path, "w") as f:
+            for taxid, count in top_taxa:
+                f.write(f"{count:7d} {taxid}\n")
+
+def warm_up_page_cache(file_paths: list):
+    """
+    Reads the files once, so they are in the page cache of the operating system.
+    Tools mapping the files into memory (e.g. kraken2 --memory-mapping) then do not load
+    them from disk again, and all runs on the machine share the same copy in memory.
+    """
+    buffer = bytearray(PAGE_CACHE_BLOCK_SIZE)
+
+    for file_path in file_paths:
+        common.print_debug(f"Reading {file_path} into the page cache")
+
+        with open(file_path, "rb", buffering=0) as f:
+            while f.readinto(buffer):
+                pass
+
+def get_sample_tag(sample_index: int) -> bytes:
+    return str(sample_index).encode() + SAMPLE_TAG_SEPARATOR
+
+def split_sample_tag(read_name: bytes) -> tuple[int, bytes]:
+    # the sample index and the original read name
+    sample_index, _, read_name = read_name.partition(SAMPLE_TAG_SEPARATOR)
+    return int(sample_index), read_name
+
+def write_tagged_fastq(fastq_file: str, sample_index: int, stream):
+    """
+    Writes the reads of the fastq file to the stream with the sample tag in front of each
+    read name, so the reads of several samples can be classified in one run and the
+    classifications assigned to the samples again.
+    """
+    tag = b"@" + get_sample_tag(sample_index)
+    line_count = 0
+
+    with open_fastq(fastq_file) as f:
+        while True:
+            lines = f.readlines(TAGGED_READS_BLOCK_SIZE)
+
+            if not lines:
+                break
+
+            # the read name is the first of the four lines of a record
+            first_read_name = -line_count % 4
+            lines[first_read_name::4] = [tag + line[1:] for line in lines[first_read_name::4]]
+
+            stream.writelines(lines)
+            line_count += len(lines)
+
+def read_kraken_report_taxonomy(kraken_summary_report: str) -> list:
+    """
+    Reads the taxa of a kraken2 report as tree. Returns the top level taxa (usually only root),
+    the unclassified reads are not part of the tree.
+    The report lists each taxon before its children, the level is given by the indentation of the name.
+    """
+    top_level_taxa = []
+    # taxa of the current path through the tree, by level
+    path = []
+
+    with open(kraken_summary_report, "r") as f:
+        for line in f:
+            columns = line.rstrip("\n").split("\t")
+
+            if len(columns) < 6 or columns[4].strip() == TAXID_UNCLASSIFIED:
+                continue
+
+            name = columns[5]
+            level = (len(name) - len(name.lstrip(" "))) // 2
+            taxon = KrakenReportTaxon(taxid=columns[4].strip(), rank=columns[3], name=name)
+
+            del path[level:]
+            if path:
+                path[-1].children.append(taxon)
+            else:
+                top_level_taxa.append(taxon)
+            path.append(taxon)
+
+    return top_level_taxa
+
+def write_kraken_report(top_level_taxa: list, taxon_counts: dict, unclassified_count: int, output_file_path: str):
+    """
+    Writes a kraken2 report for the read counts of one sample, using the taxa of a report of
+    the classification of several samples. The lines are the same as kraken2 writes them:
+    only taxa with reads, each followed by its children sorted by the reads of their clade.
+    Columns: percentage, reads of the clade, reads assigned directly, rank, taxid, name
+    """
+    clade_counts = {}
+
+    def count_clade(taxon: KrakenReportTaxon) -> int:
+        clade_count = taxon_counts.get(taxon.taxid, 0) + sum(count_clade(child) for child in taxon.children)
+        clade_counts[id(taxon)] = clade_count
+        return clade_count
+
+    total_count = unclassified_count + sum(count_clade(taxon) for taxon in top_level_taxa)
+
+    def get_percentage(count: int) -> float:
+        return 100.0 * count / total_count if total_count else 0.0
+
+    with open(output_file_path, "w") as f:
+
+        if unclassified_count:
+            f.write(f"{get_percentage(unclassified_count):6.2f}\t{unclassified_count}\t{unclassified_count}\tU\t{TAXID_UNCLASSIFIED}\tunclassified\n")
+
+        def write_taxon(taxon: KrakenReportTaxon):
+            clade_count = clade_counts[id(taxon)]
+
+            if not clade_count:
+                return
+
+            f.write(f"{get_percentage(clade_count):6.2f}\t{clade_count}\t{taxon_counts.get(taxon.taxid, 0)}\t{taxon.rank}\t{taxon.taxid}\t{taxon.name}\n")
+
+            for child in sorted(taxon.children, key=lambda child: clade_counts[id(child)], reverse=True):
+                write_taxon(child)
+
+        for taxon in sorted(top_level_taxa, key=lambda taxon: clade_counts[id(taxon)], reverse=True):
+            write_taxon(taxon)
+
+def read_centrifuge_report_taxa(centrifuge_report: str) -> tuple[str, list]:
+    """
+    Reads the header and the taxa of a centrifuge report as list of (name, taxID, taxRank, genomeSize).
+    Columns: name, taxID, taxRank, genomeSize, numReads, numUniqueReads, abundance
+    """
+    taxa = []
+
+    with open(centrifuge_report, "r") as f:
+        header = f.readline()
+
+        for line in f:
+            columns = line.rstrip("\n").split("\t")
+
+            if len(columns) < 7:
+                continue
+
+            taxa.append(tuple(columns[:4]))
+
+    return header, taxa
+
+def write_centrifuge_report(header: str, taxa: list, read_classes: dict, output_file_path: str):
+    """
+    Writes a centrifuge report for the reads of one sample, using the taxa of a report of the
+    classification of several samples. read_classes holds the number of reads per combination of
+    taxa they are assigned to (a taxon appears once per hit of the read).
+    The read counts are the same as centrifuge writes them. The abundance is NA, as centrifuge
+    estimates it from the reads of all samples of the run.
+    """
+    read_counts = {}
+    unique_read_counts = {}
+
+    for taxa_of_reads, read_count in read_classes.items():
+        for taxid in set(taxa_of_reads):
+            read_counts[taxid] = read_counts.get(taxid, 0) + read_count
+
+        # reads with a single hit
+        if len(taxa_of_reads) == 1:
+            unique_read_counts[taxa_of_reads[0]] = unique_read_counts.get(taxa_of_reads[0], 0) + read_count
+
+    with open(output_file_path, "w") as f:
+        f.write(header)
+
+        for name, taxid, rank, genome_size in taxa:
+            if taxid not in read_counts:
+                continue
+
+            f.write(f"{name}\t{taxid}\t{rank}\t{genome_size}\t{read_counts[taxid]}\t{unique_read_counts.get(taxid, 0)}\t{CENTRIFUGE_ABUNDANCE_NOT_AVAILABLE}\n")
+
+def get_unmapped_reads_bam_files(species: str, ref_genome_id: str) -> list:
+    """
+    Sorted BAM files of the individuals of a species, without library and extraction blanks.
+    """
+    mapped_folder = common.get_folder_path_species_processed_refgenome_mapped(species, ref_genome_id)
+    bam_files = common.get_files_in_folder_matching_pattern(mapped_folder, f"*{common.FILE_ENDING_SORTED_BAM}")
+
+    # Filter out files that contain "LB" or "EB" (Library Blanks or Extraction Blanks)
+    return [f for f in bam_files if "LB" not in common.get_filename_from_path(f) and "EB" not in common.get_filename_from_path(f)]
+
+def get_unmapped_reads_threads(threads: int) -> tuple[int, int]:
+    """
+    Threads of samtools fastq and of the classifier reading its output, split from the threads of the task.
+    The classifier does the work, samtools only decompresses the BAM file.
+    """
+    samtools_threads = max(1, threads // 4)
+    return samtools_threads, max(1, threads - samtools_threads)
+
+def get_unmapped_reads_command(bam_file: str, samtools_threads: int) -> list:
+    # reads that did not map (-f 4), written as fastq to stdout. Unmapped reads are never secondary or supplementary
+    return [
+        common.PROGRAM_PATH_SAMTOOLS, common.PROGRAM_PATH_SAMTOOLS_FASTQ,
+        "-@", str(samtools_threads),
+        "-f", "4",
+        "-F", "0x900",
+        bam_file
+    ]
+
+def get_kraken_report_read_counts(kraken_summary_report: str) -> tuple[int, int]:
+    """
+    Number of classified and unclassified reads of a kraken2 report.
+    The classified reads are the reads of the top level taxa (root).
+    """
+    classified_reads = 0
+    unclassified_reads = 0
+
+    with open(kraken_summary_report, "r") as f:
+        for line in f:
+            columns = line.rstrip("\n").split("\t")
+
+            if len(columns) < 6:
+                continue
+
+            if columns[4].strip() == TAXID_UNCLASSIFIED:
+                unclassified_reads += int(columns[1])
+            elif not columns[5].startswith(" "):
+                classified_reads += int(columns[1])
+
+    return classified_reads, unclassified_reads
+
+def count_centrifuge_classified_reads(centrifuge_output_file: str) -> tuple[int, int]:
+    """
+    Number of classified and unclassified reads in the per-read output of centrifuge.
+    The hits of a read are consecutive lines, each read is counted once.
+    """
+    classified_reads = 0
+    unclassified_reads = 0
+    previous_read_name = None
+
+    with open(centrifuge_output_file, "rb") as f:
+        # header line
+        f.readline()
+
+        for line in f:
+            columns = line.split(b"\t", 3)
+
+            if len(columns) < 3 or columns[0] == previous_read_name:
+                continue
+
+            previous_read_name = columns[0]
+
+            if columns[2] == TAXID_UNCLASSIFIED.encode():
+                unclassified_reads += 1
+            else:
+                classified_reads += 1
+
+    return classified_reads, unclassified_reads
+
+def get_unmapped_reads_classification(individual: str, ref_genome_id: str, bam_file: str, classified_reads: int, unclassified_reads: int) -> dict:
+    # the unmapped reads are the classified reads, the mapped reads are taken from the index of the BAM file
+    mapped_reads, _ = common_rgp.execute_samtools_idxstats_read_counts(bam_file)
+    unmapped_reads = classified_reads + unclassified_reads
+    total_reads = mapped_reads + unmapped_reads
+
+    return {
+        "individual": individual,
+        "reference_genome": ref_genome_id,
+        "mapped_reads": mapped_reads,
+        "unmapped_reads": unmapped_reads,
+        "classified_reads": classified_reads,
+        "unclassified_reads": unclassified_reads,
+        "classified_proportion": classified_reads / total_reads if total_reads else 0.0,
+    }
+
+def write_unmapped_reads_classification(rows: list, output_file_path: str):
+    """
+    Writes the mapped, unmapped and classified reads per individual as CSV file.
+    """
+    with common.atomic_output(output_file_path) as temp_output_path:
+        with open(temp_output_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=UNMAPPED_READS_CLASSIFICATION_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+
@@ -1,73 +1,65 @@
 import os
-import re
-import subprocess
-import pandas as pd
 import raw_reads_processing.common_raw_reads_processing_helpers as common_rrp
+import raw_reads_processing.analysis.fastq_scanner as fastq_scanner
 
-from multiprocessing import Pool, cpu_count
-from common_aDNA_scripts import *
-
-def execute_seqkit_stats_count_reads(input_file: str, thread:int = THREADS_DEFAULT) -> int:
-
-    print_info(f"Executing seqkit stats for {input_file}")
+from common.common_result_store import ResultStore, RESULT_TABLE_READS_PROCESSING, export_result_table, get_result_fingerprint
 
-    if not os.path.exists(input_file):
-        raise Exception(f"Input file {input_file} does not exist!")
+from multiprocessing import Pool
+from common_aDNA_scripts import *
 
+def scan_read_count(fastq_file: str) -> int:
     try:
-        command = [PROGRAM_PATH_SEQKIT, PROGRAM_PATH_SEQKIT_STATS, "--threads", str(thread), input_file]
-
-        print_debug(f"Executing command: {' '.join(command)}")
-
-        result = subprocess.run( command, capture_output=True, text=True, check=True)
-    
+        return fastq_scanner.get_fastq_stats(fastq_file).read_count
     except Exception as e:
-        print_error(f"Failed to execute seqkit stats: {e}")
+        print_error(f"Failed to count the reads of {fastq_file}: {e}")
         return -1
 
-    try:
-
-        # the result looks like this:
-        # seqkit stats -j 10 /mnt/data2/sarah/aDNA/Mmus/raw/reads/326862_S37_R1_001.fastq.gz
-        # file                                                             format  type   num_seqs        sum_len  min_len  avg_len  max_len
-        # /mnt/data2/sarah/aDNA/Mmus/raw/reads/326862_S37_R1_001.fastq.gz  FASTQ   DNA   7,729,611  1,159,441,650      150      150      150
-
-        # Read output into pandas DataFrame so that we can get the data we need
-
-        output = result.stdout
+def count_raw_reads(raw_read_path: str, adapter_removed_file_path: str) -> int:
+    """
+    Number of reads in a raw read file. It is taken from the fastp json report of the adapter removal,
+    the raw reads are only scanned if the report does not exist.
+    """
+    json_report_path = common_rrp.get_fastp_json_report_path(adapter_removed_file_path)
 
-        # Print raw output to debug the format
-
-        # Define the regular expression pattern to capture columns
-        pattern = r"([^\s]+)\s+([^\s]+)\s+([^\s]+)\s+([0-9,]+)\s+([0-9,]+)\s+([0-9,]+)\s+([0-9,\.]+)\s+([0-9,]+)"
+    if os.path.exists(json_report_path):
+        try:
+            return common_rrp.get_raw_read_count_from_fastp_json_report(json_report_path)
+        except Exception as e:
+            print_warning(f"Failed to get raw read count of {raw_read_path} from fastp report {json_report_path}: {e}")
 
-        # Use regex to extract all lines matching the pattern
-        matches = re.findall(pattern, output)
+    return scan_read_count(raw_read_path)
 
-        # If no matches were found, raise an error
-        if not matches:
-            raise ValueError("No valid output found to parse.")
+def count_reads_of_processed_file(processed_file_path: str) -> int:
+    """
+    Number of reads in a file written by a fastp step. It is taken from the fastp json report
+    of the step, the file is only scanned if the report does not exist.
+    In fused fastp mode the intermediate fastq files are not written, so only the report exists.
+    """
+    json_report_path = common_rrp.get_fastp_json_report_path(processed_file_path)
 
-        # Convert matches to a DataFrame
-        df = pd.DataFrame(matches, columns=["file", "format", "type", "num_seqs", "sum_len", "min_len", "avg_len", "max_len"])
+    if os.path.exists(json_report_path):
+        try:
+            return common_rrp.get_read_count_from_fastp_json_report(json_report_path)
+        except Exception as e:
+            print_warning(f"Failed to get read count of {processed_file_path} from fastp report {json_report_path}: {e}")
 
-        # Convert numeric columns to correct types
-        df[["num_seqs", "sum_len", "min_len", "max_len"]] = df[["num_seqs", "sum_len", "min_len", "max_len"]].apply(lambda x: x.str.replace(',', '').astype(int))
+    if not os.path.exists(processed_file_path):
+        print_error(f"Neither {processed_file_path} nor its fastp report {json_report_path} exist!")
+        return -1
 
-        # Extract number of sequences from the DataFrame
-        sequences_count = df["num_seqs"].iloc[0]
+    return scan_read_count(processed_file_path)
 
-        print_debug(f"Seqkit stats complete for {input_file}: {sequences_count} reads")
+# columns of the reads processing result file
+READS_PROCESSING_COLUMNS = [
+    "reads_file", "individual", "protocol", "raw_count",
+    "adapter_removed_count", "quality_filtered_count", "duplicates_removed_count"
+]
 
-        return sequences_count
-    except Exception as e:
-        print_error(f"Failed to process seqkit stats output: {e}")
-        return -1
-    
 def get_file_name_reads_processing(species: str) -> str:
     return f"{species}{FILE_ENDING_READS_PROCESSING_RESULT_TSV}"
 
 # --- Helper function for parallel processing ---
+@track_resource_usage
 def _process_single_read_file(raw_read_path: str, species: str):
     try:
 
@@ -75,40 +67,41 @@ def _process_single_read_file(raw_read_path: str, species: str):
 
         print_info(f"[PID {pid}] Processing single read file: {raw_read_path}")
 
-         # Create a temporary directory to store individual results from parallel processes
-        processed_dir = get_folder_path_species_processed_qc_reads_processing(species)
-
         # Extract reads_id, individual, and protocol from the filename
         reads_id = get_filename_from_path_without_extension(raw_read_path)
-        
-        temp_file_name = f"{reads_id}{FILE_ENDING_READS_PROCESSING_RESULT_TSV}" # Using .tsv for tab-separated
-        temp_file_path = os.path.join(processed_dir, temp_file_name)
 
-        if os.path.exists(temp_file_path):
-            print_skipping(f"[PID {pid}] File already exists: {temp_file_path}.")
-            return
+        # Determine the paths of the processed files
+        # Note: get_adapter_removed_path_for_paired_raw_reads expects a list,
+        # so we wrap raw_read_path in a list for compatibility with its placeholder.
+        adapter_removed_file = common_rrp.get_adapter_removed_path_for_paired_raw_reads(species, [raw_read_path])
+        quality_filtered_file = common_rrp.get_quality_filtered_path_for_adapter_removed_reads(species, adapter_removed_file)
+        duplicates_removed_file = common_rrp.get_deduplication_path_for_quality_filtered_reads(species, quality_filtered_file)
+
+        # the reads are counted again when one of the read files or fastp reports changes
+        processed_files = [adapter_removed_file, quality_filtered_file, duplicates_removed_file]
+        fingerprint = get_result_fingerprint([raw_read_path] + processed_files + [common_rrp.get_fastp_json_report_path(file_path) for file_path in processed_files])
+
+        with ResultStore() as result_store:
+            if result_store.has_records(RESULT_TABLE_READS_PROCESSING, fingerprint=fingerprint, species=species, reads_file=reads_id):
+                print_skipping(f"[PID {pid}] Reads processing result already exists for {reads_id}.")
+                return
 
         # Count raw reads
-        raw_count = execute_seqkit_stats_count_reads(raw_read_path, thread=1)
+        raw_count = count_raw_reads(raw_read_path, adapter_removed_file)
+        print_info(f"[PID {pid}] Raw count: {raw_count}")
 
-        # Determine paths and count reads after adapter removal
-        # Note: get_adapter_removed_path_for_paired_raw_reads expects a list,
-        # so we wrap raw_read_path in a list for compatibility with its placeholder.
         print_info(f"[PID {pid}] Processing adapter removed file for {reads_id}")
-        adapter_removed_file = common_rrp.get_adapter_removed_path_for_paired_raw_reads(species, [raw_read_path])
-        adapter_removed_count = execute_seqkit_stats_count_reads(adapter_removed_file, thread=1)
+        adapter_removed_count = count_reads_of_processed_file(adapter_removed_file)
         print_info(f"[PID {pid}] Adapter removed count: {adapter_removed_count}")
 
         # Determine paths and count reads after quality filtering
         print_info(f"[PID {pid}] Processing quality filtered file for {reads_id}")
-        quality_filtered_file = common_rrp.get_quality_filtered_path_for_adapter_removed_reads(species, adapter_removed_file)
-        quality_filtered_count = execute_seqkit_stats_count_reads(quality_filtered_file, thread=1)
+        quality_filtered_count = count_reads_of_processed_file(quality_filtered_file)
         print_info(f"[PID {pid}] Quality filtered count: {quality_filtered_count}")
 
         # Determine paths and count reads after deduplication
         print_info(f"[PID {pid}] Processing duplicates removed file for {reads_id}")
-        duplicates_removed_file = common_rrp.get_deduplication_path_for_quality_filtered_reads(species, quality_filtered_file)
-        duplicates_removed_count = execute_seqkit_stats_count_reads(duplicates_removed_file, thread=1)
+        duplicates_removed_count = count_reads_of_processed_file(duplicates_removed_file)
         print_info(f"[PID {pid}] Duplicates removed count: {duplicates_removed_count}")
 
         # Assuming filename format like "individual_protocol_R1.fastq.gz"
@@ -116,22 +109,20 @@ def _process_single_read_file(raw_read_path: str, species: str):
         individual = parts[0] if len(parts) > 0 else "N/A"
         protocol = parts[1] if len(parts) > 1 else "N/A"
 
-        # Create a DataFrame for the current row
-        new_row_df = pd.DataFrame({
-            "reads_file": [reads_id],
-            "individual": [individual],
-            "protocol": [protocol],
-            "raw_count": [raw_count],
-            "adapter_removed_count": [adapter_removed_count],
-            "quality_filtered_count": [quality_filtered_count],
-            "duplicates_removed_count": [duplicates_removed_count]
-        })
-
-        # Save this single row to a temporary file
-        
-        new_row_df.to_csv(temp_file_path, sep="\t", index=False)
-
-        print_info(f"[PID {pid}] Saved file: {temp_file_path}")
+        result = {
+            "individual": individual,
+            "protocol": protocol,
+            "raw_count": raw_count,
+            "adapter_removed_count": adapter_removed_count,
+            "quality_filtered_count": quality_filtered_count,
+            "duplicates_removed_count": duplicates_removed_count
+        }
+
+        # Save the result of this read file to the result store
+        with ResultStore() as result_store:
+            result_store.write_records(RESULT_TABLE_READS_PROCESSING, {"species": species, "reads_file": reads_id}, [result], fingerprint)
+
+        print_info(f"[PID {pid}] Saved reads processing result for {reads_id}")
     except Exception as e:
         print_error(f"[PID {pid}] Error processing {raw_read_path}: {e}")
 
@@ -153,21 +144,16 @@ def determine_reads_processing_result(species: str):
     print_debug(f"Raw reads: {raw_reads}")
 
     # Determine the number of processes to use for parallel execution.
-    # It takes the minimum of a predefined default (THREADS_DEFAULT) and the
-    # actual number of CPU cores available on the system, ensuring efficient
-    # resource utilization without overloading the system.
-    num_processes = min(THREADS_DEFAULT, cpu_count())
+    # It takes the minimum of the threads assigned to this task and the
+    # number of files, so running tasks together never use more threads
+    # than the configured thread budget.
+    num_processes = get_pool_size(len(raw_reads))
     print_debug(f"Using {num_processes} processes for parallel execution.")
 
-    # we get the processed directory for the species in order to create the folder before
-    # starting the parallel processing
-    # This is important to ensure that the directory exists before any worker tries to write to it.
-    processed_dir = get_folder_path_species_processed_qc_reads_processing(species)
-
     # Initialize a multiprocessing Pool. This creates a pool of worker processes
     # that can execute tasks concurrently. The 'processes' argument specifies
     # the maximum number of worker processes to use.
-    with Pool(processes=num_processes) as pool:
+    with Pool(processes=num_processes, initializer=set_task_threads, initargs=(get_threads_per_worker(num_processes),)) as pool:
         # Prepare the arguments for each call to the _process_single_read_file helper function.
         # Each tuple (raw_read, species) represents one set of arguments for a single task.
         args_for_pool = [(raw_read, species) for raw_read in raw_reads]
@@ -178,49 +164,28 @@ def determine_reads_processing_result(species: str):
         # This call blocks until all tasks in the pool have completed.
         pool.starmap(_process_single_read_file, args_for_pool)
 
+@track_resource_usage
 def combine_reads_processing_results(species: str):
 
     print_info(f"Combining reads processing results for {species}")
 
-     # Get a list of raw read files for the species
-    analysis_files = get_files_in_folder_matching_pattern(
-        get_folder_path_species_processed_qc_reads_processing(species),
-        f"*{FILE_ENDING_READS_PROCESSING_RESULT_TSV}"
-    )
+    with ResultStore() as result_store:
+        combined_df = result_store.read_records(RESULT_TABLE_READS_PROCESSING, species=species)
 
-    if not analysis_files:
-        print_warning(f"No analysis files found for species {species}.")
+    if combined_df.empty:
+        print_warning(f"No reads processing results found for species {species}.")
         return
-    
-    print_debug(f"Found {len(analysis_files)} analysis files for species {species}.")
-    print_debug(f"Analysis files: {analysis_files}")
-
-    # Initialize an empty DataFrame to collect all results
-    # Define columns explicitly to ensure order and presence even if no data is collected
-    combined_df = pd.DataFrame(columns=[
-        "reads_file", "individual", "protocol", "raw_count",
-        "adapter_removed_count", "quality_filtered_count", "duplicates_removed_count"
-    ])
-
-        # Define the final output file path
+
+    print_debug(f"Found reads processing results of {len(combined_df)} read files for species {species}.")
+
+    # Define the final output file path
     output_file_path = os.path.join(
         get_folder_path_species_results_qc_reads_processing(species),
         get_file_name_reads_processing(species)
     )
 
-    # Combine all individual temporary result files into a single DataFrame
-    print_info(f"Combining {len(analysis_files)} individual result files...")
-    for temp_file in analysis_files:
-        try:
-            # Read each temporary file (which contains a single row)
-            df_part = pd.read_csv(temp_file, sep="\t")
-            # Concatenate it to the main combined DataFrame
-            combined_df = pd.concat([combined_df, df_part], ignore_index=True)
-        except Exception as e:
-            print_warning(f"Error reading temporary file {temp_file} during combination: {e}")
-
-    # Save the final combined DataFrame to the specified output file
-    combined_df.to_csv(output_file_path, sep="\t", index=False)
+    # Save the results of the species to the output file read by the plots
+    export_result_table(combined_df, output_file_path, READS_PROCESSING_COLUMNS, sep="\t")
     print_info(f"Successfully combined results and saved to: {output_file_path}")
 
 def all_species_determine_determine_reads_processing_result():
@@ -0,0 +1,182 @@
+import os
+import gzip
+import json
+import numpy as np
+from collections import Counter
+from dataclasses import dataclass, field
+
+from common.common_logging import print_debug, print_warning
+from common.common_manifest import PipelineManifest, get_file_path_pipeline_manifest, get_files_fingerprint, get_fingerprint_mode, is_manifest_enabled
+
+# a faster inflate implementation is used if installed (python-isal or zlib-ng),
+# both offer the same open() as the gzip module
+try:
+    from isal import igzip as gzip_backend
+except ImportError:
+    try:
+        from zlib_ng import gzip_ng as gzip_backend
+    except ImportError:
+        gzip_backend = gzip
+
+# size of the decompressed blocks, large enough to keep the per-block overhead of numpy small
+BLOCK_SIZE = 16 * 1024 * 1024
+
+# offset of the phred quality characters (Sanger / Illumina 1.8+)
+PHRED_OFFSET = 33
+
+NEWLINE = ord("\n")
+CARRIAGE_RETURN = ord("\r")
+GC_BASES = [ord(base) for base in "GCgc"]
+
+@dataclass
+class FastqStats:
+    """
+    Statistics of a fastq file, determined in one pass over the file.
+    """
+    read_count: int = 0
+    total_bases: int = 0
+    gc_bases: int = 0
+    # sum of the phred qualities of all bases
+    quality_sum: int = 0
+    # read length -> number of reads, only lengths that occur
+    length_counts: Counter = field(default_factory=Counter)
+
+    @property
+    def gc_fraction(self) -> float:
+        return self.gc_bases / self.total_bases if self.total_bases else 0.0
+
+    @property
+    def mean_quality(self) -> float:
+        # mean phred quality per base
+        return self.quality_sum / self.total_bases if self.total_bases else 0.0
+
+def open_fastq(fastq_file: str):
+    # plain fastq files are read as well, the gzip ending decides
+    if fastq_file.endswith(".gz"):
+        return gzip_backend.open(fastq_file, "rb")
+    return open(fastq_file, "rb")
+
+def scan_fastq(fastq_file: str) -> FastqStats:
+    """
+    Determines the read count, number of bases, read length distribution, GC content and
+    mean quality of a fastq file in a single decompression pass.
+
+    The file is decompressed in large blocks and the lines are found with numpy, so no
+    python object is created per read. The sequence and quality are the second and fourth
+    of the four lines of a record, so fastq files with wrapped lines are not supported
+    (fastp never writes them).
+    """
+    length_counts = np.zeros(0, dtype=np.int64)
+    gc_bases = 0
+    quality_sum = 0
+
+    # number of lines before the current block, to know which lines hold sequences and qualities
+    line_count = 0
+    remainder = b""
+
+    def add_block(data: bytes):
+        nonlocal length_counts, gc_bases, quality_sum, line_count
+
+        block = np.frombuffer(data, dtype=np.uint8)
+
+        newline_positions = np.flatnonzero(block == NEWLINE)
+
+        line_starts = np.empty_like(newline_positions)
+        line_starts[0] = 0
+        line_starts[1:] = newline_positions[:-1] + 1
+
+        # windows line endings
+        has_carriage_return = (newline_positions > line_starts) & (block[np.maximum(newline_positions - 1, 0)] == CARRIAGE_RETURN)
+        line_lengths = newline_positions - line_starts - has_carriage_return
+
+        # the sequence is line 1, 5, 9, ... and the quality line 3, 7, 11, ... of the file
+        first_sequence_line = (1 - line_count) % 4
+        first_quality_line = (3 - line_count) % 4
+
+        block_counts = np.bincount(line_lengths[first_sequence_line::4])
+        if len(block_counts) > len(length_counts):
+            length_counts = np.pad(length_counts, (0, len(block_counts) - len(length_counts)))
+        length_counts[:len(block_counts)] += block_counts
+
+        # sums per line including its line ending. Each line has at least its newline, so no segment is empty
+        line_gc_bases = np.add.reduceat(np.isin(block, GC_BASES), line_starts, dtype=np.int64)
+        gc_bases += int(line_gc_bases[first_sequence_line::4].sum())
+
+        # the quality of a base is its character minus the phred offset
+        line_sums = np.add.reduceat(block, line_starts, dtype=np.int64)[first_quality_line::4]
+        line_ending_sums = NEWLINE + CARRIAGE_RETURN * has_carriage_return[first_quality_line::4]
+        quality_sum += int((line_sums - line_ending_sums - PHRED_OFFSET * line_lengths[first_quality_line::4]).sum())
+
+        line_count += len(newline_positions)
+
+    with open_fastq(fastq_file) as handle:
+        while True:
+            data = handle.read(BLOCK_SIZE)
+
+            if not data:
+                break
+
+            block = remainder + data
+
+            # the incomplete last line is kept for the next block
+            last_newline = block.rfind(b"\n")
+            if last_newline == -1:
+                remainder = block
+                continue
+
+            remainder = block[last_newline + 1:]
+            add_block(block[:last_newline + 1])
+
+    # last line without newline at the end of the file
+    if remainder:
+        add_block(remainder + b"\n")
+
+    read_lengths = np.flatnonzero(length_counts)
+
+    return FastqStats(
+        read_count=int(length_counts.sum()),
+        total_bases=int((read_lengths * length_counts[read_lengths]).sum()),
+        gc_bases=gc_bases,
+        quality_sum=quality_sum,
+        length_counts=Counter({int(read_length): int(length_counts[read_length]) for read_length in read_lengths}))
+
+def get_fastq_stats(fastq_file: str) -> FastqStats:
+    """
+    Statistics of a fastq file. They are cached in the pipeline manifest by file fingerprint,
+    so each file is only scanned once, no matter how many analyses need its statistics.
+    Without the pipeline manifest, the file is scanned each time.
+    """
+    fastq_file = os.path.abspath(fastq_file)
+
+    if not is_manifest_enabled():
+        print_debug(f"Scanning {fastq_file}")
+        return scan_fastq(fastq_file)
+
+    fingerprint = get_files_fingerprint([fastq_file], get_fingerprint_mode())
+
+    try:
+        manifest = PipelineManifest(get_file_path_pipeline_manifest())
+    except Exception as e:
+        print_warning(f"Could not open the pipeline manifest to cache the statistics of {fastq_file}: {e}")
+        return scan_fastq(fastq_file)
+
+    try:
+        record = manifest.get_fastq_stats(fastq_file, fingerprint)
+
+        if record is not None:
+            print_debug(f"Using cached statistics of {fastq_file}")
+            return FastqStats(
+                read_count=record['read_count'],
+                total_bases=record['total_bases'],
+                gc_bases=record['gc_bases'],
+                quality_sum=record['quality_sum'],
+                length_counts=Counter({int(read_length): count for read_length, count in json.loads(record['length_histogram']).items()}))
+
+        print_debug(f"Scanning {fastq_file}")
+        stats = scan_fastq(fastq_file)
+
+        manifest.record_fastq_stats(fastq_file, fingerprint, stats.read_count, stats.total_bases, stats.gc_bases,
+                                    stats.quality_sum, json.dumps(stats.length_counts, sort_keys=True))
+        return stats
+    finally:
+        manifest.close()
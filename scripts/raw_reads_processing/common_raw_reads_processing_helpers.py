@@ -1,6 +1,7 @@
 import os
+import json
 import common_aDNA_scripts as common
-from ref_genome_processing.common_ref_genome_processing_helpers import is_species_combined_reads_file_exists, is_species_individual_reads_file_exists, is_species_individual_and_combined_reads_file_exists, get_individual_from_file
+from ref_genome_processing.common_ref_genome_processing_helpers import is_species_combined_reads_file_exists, is_species_individual_reads_file_exists, is_species_individual_and_combined_reads_file_exists, get_individual_from_file, get_reference_genome_file_list_for_species
 
 def get_adapter_removed_path_for_paired_raw_reads(species, paired_read_file_path_list: list) -> str:
     filename_new = os.path.basename(paired_read_file_path_list[0]).replace("_R1_","_").replace("_R2_","_").replace(common.FILE_ENDING_FASTQ_GZ, common.FILE_ENDING_ADAPTER_REMOVED_FASTQ_GZ )
@@ -13,3 +14,88 @@ def get_quality_filtered_path_for_adapter_removed_reads(species: str, adapter_re
 def get_deduplication_path_for_quality_filtered_reads(species: str, quality_filtered_file_path: str) -> str:
     output_file = os.path.basename(quality_filtered_file_path).replace(common.FILE_ENDING_QUALITY_FILTERED_FASTQ_GZ, common.FILE_ENDING_DUPLICATES_REMOVED_FASTQ_GZ)
     return os.path.join(common.get_folder_path_species_processed_duplicates_removed(species), output_file)
+
+def is_fastp_fused_mode(species: str) -> bool:
+    # adapter removal, quality filtering and deduplication in one pass without intermediate fastq files
+    settings = common.get_processing_settings(common.RawReadsProcessingSteps.ADAPTER_REMOVE_AND_MERGE, species)
+    return bool(settings.get(common.AdapterRemovalSettings.FUSED.value, False))
+
+def is_kraken_batch_mode() -> bool:
+    # the reads of all samples of all species are classified in one kraken2 run, so the database is loaded once
+    settings = common.get_processing_settings(common.RawReadsProcessingSteps.CONTAMINATION_CHECK)
+    return bool(settings.get(common.ContaminationCheckSettings.KRAKEN_BATCH.value, False))
+
+def is_centrifuge_batch_mode() -> bool:
+    # the reads of all samples of all species are classified in one centrifuge run, so the index is loaded once
+    settings = common.get_processing_settings(common.RawReadsProcessingSteps.CONTAMINATION_CHECK)
+    return bool(settings.get(common.ContaminationCheckSettings.CENTRIFUGE_BATCH.value, False))
+
+def is_contamination_check_unmapped_reads_only(species: str) -> bool:
+    # only the reads that did not map to the reference genome are classified, so the check waits for the mapping
+    settings = common.get_processing_settings(common.RawReadsProcessingSteps.CONTAMINATION_CHECK, species)
+    return bool(settings.get(common.ContaminationCheckSettings.UNMAPPED_READS_ONLY.value, False))
+
+def get_contamination_check_reference_genome(species: str) -> tuple[str, str] | None:
+    """
+    Reference genome (id, path) whose unmapped reads are classified. The configured one,
+    otherwise the first reference genome of the species.
+    """
+    settings = common.get_processing_settings(common.RawReadsProcessingSteps.CONTAMINATION_CHECK, species)
+    ref_genome_id = settings.get(common.ContaminationCheckSettings.UNMAPPED_READS_REFERENCE_GENOME.value)
+
+    try:
+        ref_genome_list = get_reference_genome_file_list_for_species(species)
+    except Exception as e:
+        common.print_warning(f"Failed to get reference genome files for species {species}: {e}")
+        return None
+
+    if not ref_genome_id:
+        return ref_genome_list[0]
+
+    for ref_genome in ref_genome_list:
+        if ref_genome[0] == ref_genome_id:
+            return ref_genome
+
+    common.print_warning(f"Reference genome {ref_genome_id} for the contamination check of species {species} not found.")
+    return None
+
+def get_fastp_json_report_path(fastq_file_path: str) -> str:
+    """
+    Path of the fastp json report written together with a processed fastq file.
+    The report is next to the fastq file, with the file ending of the processing stage replaced.
+    """
+    for file_ending in (common.FILE_ENDING_ADAPTER_REMOVED_FASTQ_GZ, common.FILE_ENDING_QUALITY_FILTERED_FASTQ_GZ, common.FILE_ENDING_DUPLICATES_REMOVED_FASTQ_GZ):
+        if fastq_file_path.endswith(file_ending):
+            return fastq_file_path[:-len(file_ending)] + common.FILE_ENDING_FASTP_JSON_REPORT
+
+    raise ValueError(f"No fastp report for {fastq_file_path}")
+
+def load_fastp_json_report(json_report_path: str) -> dict:
+    with open(json_report_path, 'r') as f:
+        return json.load(f)
+
+def get_raw_read_count_from_fastp_json_report(json_report_path: str) -> int:
+    """
+    Number of reads in one raw read file, taken from the json report of the adapter removal.
+    For paired reads fastp counts the reads of both files, so the count is halved.
+    """
+    report = load_fastp_json_report(json_report_path)
+    total_reads = int(report['summary']['before_filtering']['total_reads'])
+
+    if 'read2_before_filtering' in report:
+        return total_reads // 2
+
+    return total_reads
+
+def get_read_count_from_fastp_json_report(json_report_path: str) -> int:
+    """
+    Number of reads written by fastp, taken from its json report.
+    If reads were merged, only the merged reads are written to the main output.
+    """
+    report = load_fastp_json_report(json_report_path)
+
+    merged_and_filtered = report.get('merged_and_filtered', report['summary'].get('merged_and_filtered'))
+    if merged_and_filtered is not None:
+        return int(merged_and_filtered['total_reads'])
+
+    return int(report['summary']['after_filtering']['total_reads'])
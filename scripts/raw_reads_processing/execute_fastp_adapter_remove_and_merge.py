@@ -1,10 +1,30 @@
 import os
 import subprocess
+from typing import Optional
 import raw_reads_processing.common_raw_reads_processing_helpers as common_rrp
+import raw_reads_processing.polish_fastp_quality_filter as polish_fastp_quality_filter
+import raw_reads_processing.polish_fastp_deduplication as polish_fastp_deduplication
 
 from common_aDNA_scripts import *
 
-def execute_fastp_paired_reads_remove_adapters_and_merge(input_file_path_r1: str, input_file_path_r2: str, output_file_path: str, adapter_sequence_r1:str, adapter_sequence_r2:str, threads:int = THREADS_DEFAULT):
+def get_fastp_adapter_removal_options() -> list:
+    # filter options applied together with the adapter removal, for single and paired reads
+    return [
+        # length filtering options
+        "--length_required" , "15",             #reads shorter than length_required will be discarded, default is 15. (int [=15])
+        
+        # poly
+        "--trim_poly_x", "5",
+
+        # quality filtering options
+        "--qualified_quality_phred", "5",       #the quality value that a base is qualified. Default 15 means phred quality >=Q15 is qualified. (int [=15])
+        "--unqualified_percent_limit", "40",    #how many percents of bases are allowed to be unqualified (0~100). Default 40 means 40% (int [=40])"
+        "--n_base_limit", "5"                  #if one read's number of N base is >n_base_limit, then this read/pair is discarded. Default is 5 (int [=5])
+    ]
+
+def execute_fastp_paired_reads_remove_adapters_and_merge(input_file_path_r1: str, input_file_path_r2: str, output_file_path: str, adapter_sequence_r1:str, adapter_sequence_r2:str, threads: int = None):
+    if threads is None:
+        threads = get_task_threads()
 
     print_info(f"Removing adapters from {input_file_path_r1} and {input_file_path_r2} ...")
 
@@ -25,47 +45,54 @@ def execute_fastp_paired_reads_remove_adapters_and_merge(input_file_path_r1: str
     filepath_merge_json_report = output_file_path.replace(FILE_ENDING_ADAPTER_REMOVED_FASTQ_GZ, FILE_ENDING_FASTP_JSON_REPORT)
     filepath_merge_html_report = output_file_path.replace(FILE_ENDING_ADAPTER_REMOVED_FASTQ_GZ, FILE_ENDING_FASTP_HTML_REPORT)
 
+    output_file_paths = [
+        output_file_path,
+        filepath_merge_failed_passed_r1,
+        filepath_merge_failed_passed_r2,
+        filepath_merge_failed_not_passed_r1,
+        filepath_merge_failed_not_passed_r2,
+        filepath_merge_json_report,
+        filepath_merge_html_report
+    ]
+
+    # all outputs are written to temporary files first and renamed once fastp succeeded
+    temp_output_file_path, temp_merge_failed_passed_r1, temp_merge_failed_passed_r2, \
+        temp_merge_failed_not_passed_r1, temp_merge_failed_not_passed_r2, \
+        temp_merge_json_report, temp_merge_html_report = [get_temp_file_path(path) for path in output_file_paths]
+
     #https://github.com/OpenGene/fastp/blob/59cc2f67414e74e99d42774e227b192a3d9bb63a/README.md#all-options
     command_fastp = [
         PROGRAM_PATH_FASTP,
         "--adapter_sequence", adapter_sequence_r1,  # Adapter for R1
         "--adapter_sequence_r2", adapter_sequence_r2,  # Adapter for R2
-        "--out1", filepath_merge_failed_passed_r1,
-        "--out2", filepath_merge_failed_passed_r2,
-        "--unpaired1", filepath_merge_failed_not_passed_r1,
-        "--unpaired2", filepath_merge_failed_not_passed_r2,
-        "--merged_out", output_file_path,  # Output file for R1
+        "--out1", temp_merge_failed_passed_r1,
+        "--out2", temp_merge_failed_passed_r2,
+        "--unpaired1", temp_merge_failed_not_passed_r1,
+        "--unpaired2", temp_merge_failed_not_passed_r2,
+        "--merged_out", temp_output_file_path,  # Output file for R1
         "--in1", input_file_path_r1,        # Input R1 file
         "--in2", input_file_path_r2,         # Input R2 file
-        "--json", filepath_merge_json_report,
-        "--html", filepath_merge_html_report,
+        "--json", temp_merge_json_report,
+        "--html", temp_merge_html_report,
         "--merge",
         "--thread", str(threads),               # Number of threads
-
-        # length filtering options
-        "--length_required" , "15",             #reads shorter than length_required will be discarded, default is 15. (int [=15])
-        
-        # poly
-        "--trim_poly_x", "5",
-
-        # quality filtering options
-        "--qualified_quality_phred", "5",       #the quality value that a base is qualified. Default 15 means phred quality >=Q15 is qualified. (int [=15])
-        "--unqualified_percent_limit", "40",    #how many percents of bases are allowed to be unqualified (0~100). Default 40 means 40% (int [=40])"
-        "--n_base_limit", "5"                  #if one read's number of N base is >n_base_limit, then this read/pair is discarded. Default is 5 (int [=5])
-       
+        *get_fastp_adapter_removal_options()
     ]
 
     print_debug(f"Executing command: {' '.join(command_fastp)}")
     
     try:
-        subprocess.run(command_fastp, check=True)
+        with atomic_output(*output_file_paths):
+            run_command(command_fastp)
         print_success(f"Adapters removed from {input_file_path_r1} and {input_file_path_r2}.")
     except subprocess.CalledProcessError as e:
         raise Exception(f"Removed adapters error for {input_file_path_r1} and {input_file_path_r2} : {e}")
 
 
-def execute_fastp_single_reads_remove_adapters(input_file_path: str, output_file_path: str, adapter_sequence: str, threads: int = THREADS_DEFAULT):
-    
+def execute_fastp_single_reads_remove_adapters(input_file_path: str, output_file_path: str, adapter_sequence: str, threads: int = None):
+    if threads is None:
+        threads = get_task_threads()
+
     print_info(f"Removing adapters from {input_file_path} ...")
     
     if not os.path.exists(input_file_path):
@@ -78,36 +105,160 @@ def execute_fastp_single_reads_remove_adapters(input_file_path: str, output_file
     filepath_json_report = output_file_path.replace(FILE_ENDING_ADAPTER_REMOVED_FASTQ_GZ, "_report.json")
     filepath_html_report = output_file_path.replace(FILE_ENDING_ADAPTER_REMOVED_FASTQ_GZ, "_report.html")
     
+    output_file_paths = [output_file_path, filepath_json_report, filepath_html_report]
+    temp_output_file_path, temp_json_report, temp_html_report = [get_temp_file_path(path) for path in output_file_paths]
+
     command_fastp = [
         PROGRAM_PATH_FASTP,
         "--adapter_sequence", adapter_sequence,  # Adapter sequence for single-end reads
         "-i", input_file_path,  # Input file
-        "-o", output_file_path,  # Output file
-        "--json", filepath_json_report,
-        "--html", filepath_html_report,
+        "-o", temp_output_file_path,  # Output file
+        "--json", temp_json_report,
+        "--html", temp_html_report,
         "--thread", str(threads),  # Number of threads
-
-        # length filtering options
-        "--length_required", "15",  # Reads shorter than this will be discarded
-
-        # poly
-        "--trim_poly_x", "5",
-
-        # quality filtering options
-        "--qualified_quality_phred", "5",  # Minimum quality threshold
-        "--unqualified_percent_limit", "40",  # Max percentage of unqualified bases
-        "--n_base_limit", "5"  # Max number of N bases allowed
+        *get_fastp_adapter_removal_options()
     ]
 
     print_debug(f"Executing command: {' '.join(command_fastp)}")
     
     try:
-        subprocess.run(command_fastp, check=True)
+        with atomic_output(*output_file_paths):
+            run_command(command_fastp)
         print_success(f"Adapters removed from {input_file_path}.")
     except subprocess.CalledProcessError as e:
         raise Exception(f"Adapter removal error for {input_file_path}: {e}")
 
 
+def execute_fastp_fused(species: str, input_file_path_r1: str, input_file_path_r2: Optional[str], adapter_removed_file_path: str, adapter_sequence_r1: str, adapter_sequence_r2: str, threads: int = None):
+    """
+    Adapter removal (and merging of paired reads), quality filtering and deduplication in one pass.
+    Three fastp processes are connected by pipes, so the adapter removed and quality filtered reads
+    are never written to disk. Only the duplicates removed reads are compressed and written.
+    The json and html reports of each stage are written to the same paths as in the separate steps,
+    so the read counts per stage are still available.
+    """
+    if threads is None:
+        threads = get_task_threads()
+
+    input_file_paths = [input_file_path_r1] if input_file_path_r2 is None else [input_file_path_r1, input_file_path_r2]
+
+    print_info(f"Removing adapters, quality filtering and removing duplicates of {', '.join(input_file_paths)} in one pass ...")
+
+    for input_file_path in input_file_paths:
+        if not os.path.exists(input_file_path):
+            raise Exception(f"Read file {input_file_path} does not exist!")
+
+    quality_filtered_file_path = common_rrp.get_quality_filtered_path_for_adapter_removed_reads(species, adapter_removed_file_path)
+    duplicates_removed_file_path = common_rrp.get_deduplication_path_for_quality_filtered_reads(species, quality_filtered_file_path)
+
+    if os.path.exists(duplicates_removed_file_path):
+        print_skipping(f"Output file {duplicates_removed_file_path} already exists!")
+        return
+
+    # the adapter removal does most of the work, the other stages get a quarter of the threads each
+    threads_per_polish_stage = max(1, threads // 4)
+    threads_adapter_removal = max(1, threads - 2 * threads_per_polish_stage)
+
+    # outputs of the adapter removal. The merged reads are passed on through the pipe
+    adapter_removal_json_report = common_rrp.get_fastp_json_report_path(adapter_removed_file_path)
+    adapter_removal_output_file_paths = [
+        adapter_removal_json_report,
+        adapter_removal_json_report.replace(FILE_ENDING_FASTP_JSON_REPORT, FILE_ENDING_FASTP_HTML_REPORT),
+    ]
+
+    if input_file_path_r2 is None:
+        command_adapter_removal = [
+            PROGRAM_PATH_FASTP,
+            "--adapter_sequence", adapter_sequence_r1,
+            "-i", input_file_path_r1,
+        ]
+    else:
+        merge_failed_file_paths = [
+            adapter_removed_file_path.replace(FILE_ENDING_ADAPTER_REMOVED_FASTQ_GZ, file_ending)
+            for file_ending in (FILE_ENDING_MERGE_FAILED_PASSED_R1_FASTQ_GZ, FILE_ENDING_MERGE_FAILED_PASSED_R2_FASTQ_GZ,
+                                FILE_ENDING_MERGE_FAILED_NOT_PASSED_R1_FASTQ_GZ, FILE_ENDING_MERGE_FAILED_NOT_PASSED_R2_FASTQ_GZ)
+        ]
+        adapter_removal_output_file_paths += merge_failed_file_paths
+
+        temp_merge_failed_passed_r1, temp_merge_failed_passed_r2, \
+            temp_merge_failed_not_passed_r1, temp_merge_failed_not_passed_r2 = [get_temp_file_path(path) for path in merge_failed_file_paths]
+
+        command_adapter_removal = [
+            PROGRAM_PATH_FASTP,
+            "--adapter_sequence", adapter_sequence_r1,
+            "--adapter_sequence_r2", adapter_sequence_r2,
+            "--in1", input_file_path_r1,
+            "--in2", input_file_path_r2,
+            "--out1", temp_merge_failed_passed_r1,
+            "--out2", temp_merge_failed_passed_r2,
+            "--unpaired1", temp_merge_failed_not_passed_r1,
+            "--unpaired2", temp_merge_failed_not_passed_r2,
+            "--merge",  # with --stdout, the merged reads are written to stdout
+        ]
+
+    command_adapter_removal += [
+        "--stdout",
+        "--json", get_temp_file_path(adapter_removal_output_file_paths[0]),
+        "--html", get_temp_file_path(adapter_removal_output_file_paths[1]),
+        "--thread", str(threads_adapter_removal),
+        *get_fastp_adapter_removal_options()
+    ]
+
+    # outputs of the quality filter. The filtered reads are passed on through the pipe
+    quality_filter_output_file_paths = [
+        quality_filtered_file_path.replace(FILE_ENDING_QUALITY_FILTERED_FASTQ_GZ, "_failed.fastq.gz"),
+        common_rrp.get_fastp_json_report_path(quality_filtered_file_path),
+        quality_filtered_file_path.replace(FILE_ENDING_QUALITY_FILTERED_FASTQ_GZ, FILE_ENDING_FASTP_HTML_REPORT),
+    ]
+    temp_quality_filter_failed_reads, temp_quality_filter_json_report, temp_quality_filter_html_report = [get_temp_file_path(path) for path in quality_filter_output_file_paths]
+
+    command_quality_filter = [
+        PROGRAM_PATH_FASTP,
+        "--stdin",
+        "--stdout",
+        "--thread", str(threads_per_polish_stage),
+        *polish_fastp_quality_filter.get_fastp_quality_filter_options(),
+        "--failed_out", temp_quality_filter_failed_reads,
+        "--json", temp_quality_filter_json_report,
+        "--html", temp_quality_filter_html_report
+    ]
+
+    # outputs of the deduplication
+    deduplication_output_file_paths = [
+        duplicates_removed_file_path,
+        duplicates_removed_file_path.replace(FILE_ENDING_DUPLICATES_REMOVED_FASTQ_GZ, "_failed.fastq.gz"),
+        common_rrp.get_fastp_json_report_path(duplicates_removed_file_path),
+        duplicates_removed_file_path.replace(FILE_ENDING_DUPLICATES_REMOVED_FASTQ_GZ, FILE_ENDING_FASTP_HTML_REPORT),
+    ]
+    temp_duplicates_removed_file_path, temp_deduplication_failed_reads, temp_deduplication_json_report, temp_deduplication_html_report = [get_temp_file_path(path) for path in deduplication_output_file_paths]
+
+    command_deduplication = [
+        PROGRAM_PATH_FASTP,
+        "--stdin",
+        *polish_fastp_deduplication.get_fastp_deduplication_options(),
+        "--thread", str(threads_per_polish_stage),
+        "--out1", temp_duplicates_removed_file_path,
+        "--failed_out", temp_deduplication_failed_reads,
+        "--json", temp_deduplication_json_report,
+        "--html", temp_deduplication_html_report
+    ]
+
+    # the folders of the stages are needed for the reports
+    get_folder_path_species_processed_quality_filtered(species)
+    get_folder_path_species_processed_duplicates_removed(species)
+
+    # the duplicates removed reads are listed first, so they appear last and only if all stages succeeded
+    output_file_paths = deduplication_output_file_paths + quality_filter_output_file_paths + adapter_removal_output_file_paths
+
+    try:
+        with atomic_output(*output_file_paths):
+            run_piped_commands(
+                [command_adapter_removal, command_quality_filter, command_deduplication],
+                description=f"fastp adapter removal | quality filter | deduplication for {', '.join(get_filename_from_path(path) for path in input_file_paths)}")
+        print_success(f"Adapters removed, quality filtered and duplicates removed for {', '.join(input_file_paths)}.")
+    except subprocess.CalledProcessError as e:
+        raise Exception(f"fastp fused processing error for {', '.join(input_file_paths)}: {e}")
+
 def all_species_fastp_adapter_remove_and_merge():
 
     print_execution("Running adaper removal and merge for all species")
@@ -117,31 +268,70 @@ def all_species_fastp_adapter_remove_and_merge():
 
     print_info("Adapter removal and merge for all species completed successfully.")
 
-def adapter_remove_for_species(species: str):
-    print_info(f"Running adapter removal for species {species}")
+def get_raw_read_pairs_for_species(species: str) -> list[tuple[str, Optional[str]]]:
+    """
+    Collects the raw reads of a species as (r1, r2) tuples.
+    Single-end reads are returned as (r1, None).
+    """
 
     # Get lists of R1 and R2 read files
     raw_reads_folder = get_folder_path_species_raw_reads(species)
     list_of_r1_read_files = get_files_in_folder_matching_pattern(raw_reads_folder, FILE_PATTERN_R1_FASTQ_GZ)
     list_of_r2_read_files = get_files_in_folder_matching_pattern(raw_reads_folder, FILE_PATTERN_R2_FASTQ_GZ)
 
-    if not list_of_r1_read_files and not list_of_r2_read_files:
-        print_warning(f"No raw reads found for species {species}.")
-        return
+    read_pairs = []
 
-    # Create a set of base filenames to identify paired reads
-    paired_reads = set()
-    single_reads = set(list_of_r1_read_files)  # Assume all R1 files are single initially
-
-    for r1 in list_of_r1_read_files:
+    for r1 in sorted(list_of_r1_read_files):
         r2 = r1.replace("_R1_", "_R2_")  # Generate expected R2 filename
         if r2 in list_of_r2_read_files:
-            paired_reads.add((r1, r2))
-            single_reads.discard(r1)  # Remove from single-end list if paired
+            read_pairs.append((r1, r2))
+        else:
+            read_pairs.append((r1, None))
+
+    return read_pairs
+
+def adapter_remove_for_read_pair(species: str, r1: str, r2: Optional[str] = None):
+    """
+    Runs adapter removal for a single raw read file (r2 is None) or a read pair.
+    """
 
     #get adapter sequence
     adapter_sequence_r1, adapter_sequence_r2 = get_adapter_sequence(species)
 
+    read_files = [r1] if r2 is None else [r1, r2]
+
+    adapter_removed_read_file = common_rrp.get_adapter_removed_path_for_paired_raw_reads(species, read_files)
+
+    individual = common_rrp.get_individual_from_file(r1)
+
+    is_ref_genome_read_file_exists = common_rrp.is_species_individual_reads_file_exists(
+        species, 
+        individual
+    )
+
+    if is_ref_genome_read_file_exists:
+        print_skipping(f"Individual {individual} already prepared for reference genome processing!")
+        return
+
+    if common_rrp.is_fastp_fused_mode(species):
+        execute_fastp_fused(species, r1, r2, adapter_removed_read_file, adapter_sequence_r1, adapter_sequence_r2)
+    elif r2 is None:
+        execute_fastp_single_reads_remove_adapters(r1, adapter_removed_read_file, adapter_sequence_r1)
+    else:
+        execute_fastp_paired_reads_remove_adapters_and_merge(r1, r2, adapter_removed_read_file, adapter_sequence_r1, adapter_sequence_r2)
+
+def adapter_remove_for_species(species: str):
+    print_info(f"Running adapter removal for species {species}")
+
+    read_pairs = get_raw_read_pairs_for_species(species)
+
+    if not read_pairs:
+        print_warning(f"No raw reads found for species {species}.")
+        return
+
+    paired_reads = [(r1, r2) for r1, r2 in read_pairs if r2 is not None]
+    single_reads = [r1 for r1, r2 in read_pairs if r2 is None]
+
     # Process paired reads
     if paired_reads:
 
@@ -159,20 +349,7 @@ def adapter_remove_for_species(species: str):
 
                 print_info(f"[{count_current}/{number_of_paired_reads}] Processing paired reads: {get_filename_from_path(r1)}, {get_filename_from_path(r2)}")  
 
-                adapter_removed_read_file = common_rrp.get_adapter_removed_path_for_paired_raw_reads(species, [r1, r2])
-                
-                individual = common_rrp.get_individual_from_file(r1)
-
-                is_ref_genome_read_file_exists = common_rrp.is_species_individual_reads_file_exists(
-                    species, 
-                    individual
-                )
-
-                if is_ref_genome_read_file_exists:
-                    print_skipping(f"Individual {individual} already prepared for reference genome processing!")
-                    continue
-                
-                execute_fastp_paired_reads_remove_adapters_and_merge(r1, r2, adapter_removed_read_file, adapter_sequence_r1, adapter_sequence_r2)
+                adapter_remove_for_read_pair(species, r1, r2)
        
         except Exception as e:
             print_error(f"Error processing paired-end reads for species {species}: {e}")
@@ -195,20 +372,7 @@ def adapter_remove_for_species(species: str):
 
                 print_info(f"[{count_current}/{number_of_single_reads}] Processing single read: {get_filename_from_path(read_file_path)}")
 
-                adapter_removed_read_file = common_rrp.get_adapter_removed_path_for_paired_raw_reads(species, [read_file_path])
-                
-                individual = common_rrp.get_individual_from_file(read_file_path)
-
-                is_ref_genome_read_file_exists = common_rrp.is_species_individual_reads_file_exists(
-                    species, 
-                    individual
-                )
-
-                if is_ref_genome_read_file_exists:
-                    print_skipping(f"Individual {individual} already prepared for reference genome processing!")
-                    continue
-                
-                execute_fastp_single_reads_remove_adapters(read_file_path, adapter_removed_read_file, adapter_sequence_r1)
+                adapter_remove_for_read_pair(species, read_file_path)
         except Exception as e:
             print_error(f"Error processing single-end reads for species {species}: {e}")
             return
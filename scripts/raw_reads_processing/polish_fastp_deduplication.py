@@ -3,7 +3,20 @@ from common_aDNA_scripts import *
 
 import raw_reads_processing.common_raw_reads_processing_helpers as common_rrp
 
-def execute_fastp_deduplication(input_file_path:str, output_file_path:str, threads:int = THREADS_DEFAULT):
+def get_fastp_deduplication_options() -> list:
+    # also used by the fused mode, which runs the deduplication on the output of the quality filter
+    #https://github.com/OpenGene/fastp/blob/59cc2f67414e74e99d42774e227b192a3d9bb63a/README.md#all-options
+    return [
+        "--dedup",                              #enable deduplication to drop the duplicated reads/pairs
+        "--disable_adapter_trimming",
+        "--disable_length_filtering",
+        "--disable_quality_filtering",
+    ]
+
+def execute_fastp_deduplication(input_file_path:str, output_file_path:str, threads: int = None):
+    if threads is None:
+        threads = get_task_threads()
+
     print_info(f"Filtering {input_file_path} ...")
 
     if not os.path.exists(input_file_path):
@@ -17,32 +30,56 @@ def execute_fastp_deduplication(input_file_path:str, output_file_path:str, threa
     filepath_json_report = output_file_path.replace(FILE_ENDING_DUPLICATES_REMOVED_FASTQ_GZ, FILE_ENDING_FASTP_JSON_REPORT)
     filepath_html_report = output_file_path.replace(FILE_ENDING_DUPLICATES_REMOVED_FASTQ_GZ, FILE_ENDING_FASTP_HTML_REPORT)
 
-    #https://github.com/OpenGene/fastp/blob/59cc2f67414e74e99d42774e227b192a3d9bb63a/README.md#all-options
+    output_file_paths = [output_file_path, filepath_reads_failed, filepath_json_report, filepath_html_report]
+    temp_output_file_path, temp_failed_reads, temp_json_report, temp_html_report = [get_temp_file_path(path) for path in output_file_paths]
+
     command_fastp = [
         PROGRAM_PATH_FASTP, 
-        "--dedup",                              #enable deduplication to drop the duplicated reads/pairs
-        "--disable_adapter_trimming",
-        "--disable_length_filtering",
-        "--disable_quality_filtering",
+        *get_fastp_deduplication_options(),
         "--thread", str(threads),                    # Number of threads
         "--in1", input_file_path,               # Input R1 file
-        "--out1", output_file_path,
-        "--failed_out", filepath_reads_failed,
-        "--json", filepath_json_report,
-        "--html", filepath_html_report
+        "--out1", temp_output_file_path,
+        "--failed_out", temp_failed_reads,
+        "--json", temp_json_report,
+        "--html", temp_html_report
     ]
 
     print_debug(f"Executing command: {' '.join(command_fastp)}")
     
     try:
-        subprocess.run(command_fastp, check=True)
+        with atomic_output(*output_file_paths):
+            run_command(command_fastp)
         print_success(f"fastp deduplication for {input_file_path} complete")
     except subprocess.CalledProcessError as e:
         print_error(f"Failed to run fastp deduplication for {input_file_path}: {e}")
 
 
+def fastp_deduplication_for_read_file(species: str, read_file_path: str):
+
+    if common_rrp.is_fastp_fused_mode(species):
+        print_skipping(f"fastp deduplication for {species} runs together with the adapter removal (fused mode).")
+        return
+
+    individual = common_rrp.get_individual_from_file(read_file_path)
+
+    is_ref_genome_read_file_exists = common_rrp.is_species_individual_reads_file_exists(
+        species, 
+        individual
+    )
+
+    if is_ref_genome_read_file_exists:
+        print_skipping(f"Individual {individual} already prepared for reference genome processing!")
+        return
+
+    output_file_path = common_rrp.get_deduplication_path_for_quality_filtered_reads(species, read_file_path)
+    execute_fastp_deduplication(read_file_path, output_file_path)
+
 def fastp_deduplication_for_species(species: str):
 
+    if common_rrp.is_fastp_fused_mode(species):
+        print_skipping(f"fastp deduplication for {species} runs together with the adapter removal (fused mode).")
+        return
+
     print_info(f"Running fastp deduplication for {species}")
 
     reads_folder = get_folder_path_species_processed_quality_filtered(species)
@@ -66,19 +103,7 @@ def fastp_deduplication_for_species(species: str):
 
         print_info(f"[{count_current}/{number_of_reads_files}] Processing read file: {get_filename_from_path(read_file_path)}")
         
-        individual = common_rrp.get_individual_from_file(read_file_path)
-
-        is_ref_genome_read_file_exists = common_rrp.is_species_individual_reads_file_exists(
-            species, 
-            individual
-        )
-
-        if is_ref_genome_read_file_exists:
-            print_skipping(f"Individual {individual} already prepared for reference genome processing!")
-            continue
-
-        output_file_path = common_rrp.get_deduplication_path_for_quality_filtered_reads(species, read_file_path)
-        execute_fastp_deduplication(read_file_path, output_file_path)
+        fastp_deduplication_for_read_file(species, read_file_path)
 
     print_info(f"fastp deduplication for {species} complete")
 
@@ -3,7 +3,21 @@ from common_aDNA_scripts import *
 
 import raw_reads_processing.common_raw_reads_processing_helpers as common_rrp
 
-def execute_fastp_quality_filter(input_file_path:str, output_file_path:str, threads:int = THREADS_DEFAULT):
+def get_fastp_quality_filter_options() -> list:
+    # also used by the fused mode, which runs the quality filter on the output of the adapter removal
+    #https://github.com/OpenGene/fastp/blob/59cc2f67414e74e99d42774e227b192a3d9bb63a/README.md#all-options
+    return [
+        "--disable_adapter_trimming",
+        "--qualified_quality_phred", "15",      #the quality value that a base is qualified. Default 15 means phred quality >=Q15 is qualified.
+        "--length_required" , "15",             #reads shorter than length_required will be discarded, default is 15. (int [=15])
+        "--unqualified_percent_limit","40",     #how many percents of bases are allowed to be unqualified (0~100). Default 40 means 40% 
+        "--n_base_limit", "5",                  #if one read's number of N base is >n_base_limit, then this read/pair is discarded. Default is 5 (int [=5])
+    ]
+
+def execute_fastp_quality_filter(input_file_path:str, output_file_path:str, threads: int = None):
+    if threads is None:
+        threads = get_task_threads()
+
     print_info(f"Filtering {input_file_path} ...")
 
     if not os.path.exists(input_file_path):
@@ -17,33 +31,56 @@ def execute_fastp_quality_filter(input_file_path:str, output_file_path:str, thre
     filepath_json_report = output_file_path.replace(FILE_ENDING_QUALITY_FILTERED_FASTQ_GZ, FILE_ENDING_FASTP_JSON_REPORT)
     filepath_html_report = output_file_path.replace(FILE_ENDING_QUALITY_FILTERED_FASTQ_GZ, FILE_ENDING_FASTP_HTML_REPORT)
 
-    #https://github.com/OpenGene/fastp/blob/59cc2f67414e74e99d42774e227b192a3d9bb63a/README.md#all-options
+    output_file_paths = [output_file_path, filepath_failed_reads, filepath_json_report, filepath_html_report]
+    temp_output_file_path, temp_failed_reads, temp_json_report, temp_html_report = [get_temp_file_path(path) for path in output_file_paths]
+
     command_fastp = [
         PROGRAM_PATH_FASTP, 
-        "--thread", str(THREADS_DEFAULT),                    # Number of threads
-        "--disable_adapter_trimming",
-        "--qualified_quality_phred", "15",      #the quality value that a base is qualified. Default 15 means phred quality >=Q15 is qualified.
-        "--length_required" , "15",             #reads shorter than length_required will be discarded, default is 15. (int [=15])
-        "--unqualified_percent_limit","40",     #how many percents of bases are allowed to be unqualified (0~100). Default 40 means 40% 
-        "--n_base_limit", "5",                  #if one read's number of N base is >n_base_limit, then this read/pair is discarded. Default is 5 (int [=5])
+        "--thread", str(threads),                    # Number of threads
+        *get_fastp_quality_filter_options(),
         "--in1", input_file_path,               # Input R1 file
-        "--out1", output_file_path,
-        "--failed_out", filepath_failed_reads,
-        "--json", filepath_json_report,
-        "--html", filepath_html_report
+        "--out1", temp_output_file_path,
+        "--failed_out", temp_failed_reads,
+        "--json", temp_json_report,
+        "--html", temp_html_report
     ]
 
     print_debug(f"Executing command: {' '.join(command_fastp)}")
     
     try:
-        subprocess.run(command_fastp, check=True)
+        with atomic_output(*output_file_paths):
+            run_command(command_fastp)
         print_success(f"fastp quality filter for {input_file_path} complete")
     except subprocess.CalledProcessError as e:
         print_error(f"Failed to run fastp_quality_filter for {input_file_path}: {e}")
 
 
+def fastp_quality_filter_for_read_file(species: str, read_file_path: str):
+
+    if common_rrp.is_fastp_fused_mode(species):
+        print_skipping(f"fastp quality filter for {species} runs together with the adapter removal (fused mode).")
+        return
+
+    individual = common_rrp.get_individual_from_file(read_file_path)
+
+    is_ref_genome_read_file_exists = common_rrp.is_species_individual_reads_file_exists(
+        species, 
+        individual
+    )
+
+    if is_ref_genome_read_file_exists:
+        print_skipping(f"Individual {individual} already prepared for reference genome processing!")
+        return
+
+    output_file_path = common_rrp.get_quality_filtered_path_for_adapter_removed_reads(species, read_file_path)
+    execute_fastp_quality_filter(read_file_path, output_file_path)
+
 def fastp_quality_filter_for_species(species: str):
 
+    if common_rrp.is_fastp_fused_mode(species):
+        print_skipping(f"fastp quality filter for {species} runs together with the adapter removal (fused mode).")
+        return
+
     print_info(f"Running fastp quality filter for {species}")
 
     reads_folder = get_folder_path_species_processed_adapter_removed(species)
@@ -67,19 +104,7 @@ def fastp_quality_filter_for_species(species: str):
 
         print_info(f"[{count_current}/{number_of_reads_files}] Processing read file: {get_filename_from_path(read_file_path)}")
 
-        individual = common_rrp.get_individual_from_file(read_file_path)
-
-        is_ref_genome_read_file_exists = common_rrp.is_species_individual_reads_file_exists(
-            species, 
-            individual
-        )
-
-        if is_ref_genome_read_file_exists:
-            print_skipping(f"Individual {individual} already prepared for reference genome processing!")
-            continue
-
-        output_file_path = common_rrp.get_quality_filtered_path_for_adapter_removed_reads(species, read_file_path)
-        execute_fastp_quality_filter(read_file_path, output_file_path)
+        fastp_quality_filter_for_read_file(species, read_file_path)
 
     print_info(f"fastp quality filter for {species} complete")
 
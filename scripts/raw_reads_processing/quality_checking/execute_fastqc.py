@@ -8,7 +8,8 @@ def get_threads_count_for_fastqc():
     if threads is None or not isinstance(threads, int) or threads <= 0:
         return 1  # Default to 1 thread if not specified or invalid
     
-    return threads
+    # never use more threads than assigned to the task
+    return min(threads, get_task_threads())
 
 def fastqc_for_species(species: str):
     # run fastqc for raw data
@@ -124,7 +125,7 @@ def execute_fastqc(species: str, reads_file_list: list, output_folder: str):
 
     command = f"{PROGRAM_PATH_FASTQC} -o {output_folder} -t {threads} {' '.join(reads_file_list)}"
     try:
-        subprocess.run(command, shell=True, check=True)
+        run_command(command)
         print_success(f"Fastqc for species {species} complete")
     except Exception as e:
         print_error(f"Failed to run fastqc for species {species}: {e}")
@@ -111,7 +111,7 @@ def run_multiqc(species: str, fastqc_results_folder: str, output_folder: str):
 
     command = f"{PROGRAM_PATH_MULTIQC} {fastqc_results_folder} -o {output_folder}"
     try:
-        subprocess.run(command, shell=True, check=True)
+        run_command(command)
     except Exception as e:
         print_error(f"Failed to run MultiQC for species {species}: {e}")
 
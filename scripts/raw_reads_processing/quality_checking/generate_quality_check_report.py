@@ -34,7 +34,7 @@ def species_generate_quality_check_report(species: str):
     report_file = f"quality_check_report_{species}.html"
 
     # create report as html file
-    with open(os.path.join(report_folder, report_file), "w") as report:
+    with atomic_output(os.path.join(report_folder, report_file)) as temp_report_file_path, open(temp_report_file_path, "w") as report:
         report.write(f"""
         <html>
             <head>
@@ -3,7 +3,7 @@ import subprocess
 import common_aDNA_scripts as common_adna
 import ref_genome_processing.common_ref_genome_processing_helpers as common_rgp
 
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool
 
 def execute_mapdamage(bam_file_path: str, ref_genome_path: str, output_folder: str):
 
@@ -34,7 +34,8 @@ def execute_mapdamage(bam_file_path: str, ref_genome_path: str, output_folder: s
     try:
         common_adna.run_command(
             command, 
-            description=f"[PID {pid}] Running mapDamage on {common_adna.get_filename_from_path(bam_file_path)}"
+            description=f"[PID {pid}] Running mapDamage on {common_adna.get_filename_from_path(bam_file_path)}",
+            capture_output=False
             )
     
     except subprocess.CalledProcessError as e:
@@ -42,47 +43,50 @@ def execute_mapdamage(bam_file_path: str, ref_genome_path: str, output_folder: s
         common_adna.print_error(f"[PID {pid}] mapDamage failed for {bam_file_path}")
         common_adna.print_error(f"[PID {pid}] {e.stderr.strip()}")
 
-def run_mapdamage_for_species(species: str):
-    common_adna.print_info(f"Running mapDamage for species {species} ...")
+def run_mapdamage_for_reference_genome(species: str, ref_genome_id: str, ref_genome_path: str):
+    common_adna.print_debug(f"Reference genome: {ref_genome_id}")
 
-    try:
-        ref_genome_list = common_rgp.get_reference_genome_file_list_for_species(species)
-    except Exception as e:
-        common_adna.print_error(f"Failed to get reference genome files for species {species}: {e}")
+    mapped_folder = common_adna.get_folder_path_species_processed_refgenome_mapped(species, ref_genome_id)
+    list_of_bam_files = common_adna.get_files_in_folder_matching_pattern(mapped_folder, f"*{common_adna.FILE_ENDING_SORTED_BAM}")
+
+    if len(list_of_bam_files) == 0:
+        common_adna.print_warning(f"No mapped BAM files found in {mapped_folder} for species {species}.")
         return
 
-    for ref_genome_id, ref_genome_path in ref_genome_list:
-        common_adna.print_debug(f"Reference genome: {ref_genome_id}")
+    common_adna.print_debug(f"Found {len(list_of_bam_files)} BAM files for species {species}")
+    common_adna.print_debug(f"BAM files: {list_of_bam_files}")
 
-        mapped_folder = common_adna.get_folder_path_species_processed_refgenome_mapped(species, ref_genome_id)
-        list_of_bam_files = common_adna.get_files_in_folder_matching_pattern(mapped_folder, f"*{common_adna.FILE_ENDING_SORTED_BAM}")
+    # Prepare parallel task list
+    tasks = []
+    for sorted_bam_file in list_of_bam_files:
+        if not os.path.exists(sorted_bam_file):
+            common_adna.print_warning(f"Sorted BAM file {sorted_bam_file} does not exist.")
+            continue
 
-        if len(list_of_bam_files) == 0:
-            common_adna.print_warning(f"No mapped BAM files found in {mapped_folder} for species {species}.")
-            return
+        individual_id = common_adna.get_filename_from_path(sorted_bam_file).split(".")[0]
+        output_folder = common_adna.get_folder_path_species_results_refgenome_damage_individual(
+            species, ref_genome_id, individual_id)
+        
+        tasks.append((sorted_bam_file, ref_genome_path, output_folder))
 
-        common_adna.print_debug(f"Found {len(list_of_bam_files)} BAM files for species {species}")
-        common_adna.print_debug(f"BAM files: {list_of_bam_files}")
+    if tasks:
+        num_processes = common_adna.get_pool_size(len(tasks))
+        common_adna.print_info(f"Running mapDamage with max {num_processes} threads ...")
 
-        # Prepare parallel task list
-        tasks = []
-        for sorted_bam_file in list_of_bam_files:
-            if not os.path.exists(sorted_bam_file):
-                common_adna.print_warning(f"Sorted BAM file {sorted_bam_file} does not exist.")
-                continue
+        with Pool(processes=num_processes, initializer=common_adna.set_task_threads, initargs=(common_adna.get_threads_per_worker(num_processes),)) as pool:
+            pool.starmap(execute_mapdamage, tasks)
 
-            individual_id = common_adna.get_filename_from_path(sorted_bam_file).split(".")[0]
-            output_folder = common_adna.get_folder_path_species_results_refgenome_damage_individual(
-                species, ref_genome_id, individual_id)
-            
-            tasks.append((sorted_bam_file, ref_genome_path, output_folder))
+def run_mapdamage_for_species(species: str):
+    common_adna.print_info(f"Running mapDamage for species {species} ...")
 
-        if tasks:
-            num_processes = min(common_adna.THREADS_DEFAULT, cpu_count(), len(tasks))
-            common_adna.print_info(f"Running mapDamage with max {num_processes} threads ...")
+    try:
+        ref_genome_list = common_rgp.get_reference_genome_file_list_for_species(species)
+    except Exception as e:
+        common_adna.print_error(f"Failed to get reference genome files for species {species}: {e}")
+        return
 
-            with Pool(processes=num_processes) as pool:
-                pool.starmap(execute_mapdamage, tasks)
+    for ref_genome_id, ref_genome_path in ref_genome_list:
+        run_mapdamage_for_reference_genome(species, ref_genome_id, ref_genome_path)
 
     common_adna.print_success(f"mapDamage analysis for species {species} complete")
 
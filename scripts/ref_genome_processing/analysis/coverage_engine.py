@@ -0,0 +1,303 @@
+import numpy as np
+import pysam
+from dataclasses import dataclass, field
+
+import ref_genome_processing.analysis.depth_store as depth_store
+
+# reads not counted for the depth, the default filter of samtools depth (UNMAP, SECONDARY, QCFAIL, DUP)
+EXCLUDED_READ_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+# depths for which the covered bases are counted in addition to depth > 0
+COVERAGE_DEPTH_THRESHOLDS = [2, 5, 10]
+
+# bases per shard. Larger contigs are split into windows of this size, smaller contigs are
+# grouped into one shard, so the shards of a BAM file take about the same time
+DEFAULT_SHARD_SIZE = 10_000_000
+
+# aligned blocks collected before they are added to the difference array of a region,
+# so the memory of a worker does not grow with the depth of the region
+BLOCK_BATCH_SIZE = 1_000_000
+
+# bases per bin of the binned coverage, read by the plots instead of the coverage per scaffold
+DEFAULT_BIN_SIZE = 100_000
+
+@dataclass
+class CoverageShard:
+    """
+    Regions (contig, start, end) of a BAM file whose coverage is computed by one worker.
+    With a depth store, the depth of each region is written to its offset in the work file of the store.
+    With a bin size, the coverage of the bins is computed from the offset of each region in the contigs
+    with reads, laid end to end.
+    """
+    bam_file: str
+    regions: list = field(default_factory=list)
+    depth_file: str = None
+    depth_offsets: list = field(default_factory=list)
+    bin_size: int = None
+    bin_offsets: list = field(default_factory=list)
+    # bases of the regions, counted as they are added
+    length: int = 0
+
+    def add_region(self, contig: str, start: int, end: int, bin_offset: int):
+        self.regions.append((contig, start, end))
+        self.bin_offsets.append(bin_offset)
+        self.length += end - start
+
+@dataclass
+class ScaffoldCoverage:
+    """
+    Depth and breadth of a scaffold, summed over its positions.
+    """
+    scaffold: str
+    total_bases: int = 0
+    # sum of the depth of all positions
+    depth_sum: int = 0
+    max_depth: int = 0
+    # positions with depth > 0
+    covered_bases: int = 0
+    # depth threshold -> positions with at least this depth
+    threshold_bases: dict = field(default_factory=dict)
+    # reads counted for the depth, a read overlapping several windows is counted in each
+    read_count: int = 0
+
+    @property
+    def avg_depth(self) -> float:
+        return self.depth_sum / self.total_bases if self.total_bases else 0.0
+
+    @property
+    def percent_covered(self) -> float:
+        return self.covered_bases / self.total_bases * 100 if self.total_bases else 0.0
+
+    def get_percent_covered_at(self, depth_threshold: int) -> float:
+        return self.threshold_bases.get(depth_threshold, 0) / self.total_bases * 100 if self.total_bases else 0.0
+
+    def add(self, other: "ScaffoldCoverage"):
+        # adds the coverage of another region of the same scaffold
+        self.total_bases += other.total_bases
+        self.depth_sum += other.depth_sum
+        self.max_depth = max(self.max_depth, other.max_depth)
+        self.covered_bases += other.covered_bases
+        for depth_threshold, bases in other.threshold_bases.items():
+            self.threshold_bases[depth_threshold] = self.threshold_bases.get(depth_threshold, 0) + bases
+        self.read_count += other.read_count
+
+    def to_record(self) -> dict:
+        # the columns of the coverage analysis
+        record = {
+            "scaffold": self.scaffold,
+            "avg_depth": self.avg_depth,
+            "max_depth": self.max_depth,
+            "covered_bases": self.covered_bases,
+            "total_bases": self.total_bases,
+            "percent_covered": self.percent_covered,
+        }
+
+        for depth_threshold in COVERAGE_DEPTH_THRESHOLDS:
+            record[get_percent_covered_column(depth_threshold)] = self.get_percent_covered_at(depth_threshold)
+
+        return record
+
+@dataclass
+class BinCoverage:
+    """
+    Depth and breadth of a bin of fixed size over the contigs with reads, laid end to end in the order
+    of the BAM header. Small scaffolds share a bin, so the number of bins of a fragmented reference
+    genome is about its length divided by the bin size and not its number of scaffolds.
+    """
+    bin: int
+    # scaffold and position (0-based) at the start of the bin
+    scaffold: str
+    start: int
+    coverage: ScaffoldCoverage
+    # scaffolds overlapping the bin
+    scaffolds: int = 1
+
+    def to_record(self) -> dict:
+        # the columns of the coverage analysis, the scaffold is the one at the start of the bin
+        return {"bin": self.bin, "start": self.start, "scaffolds": self.scaffolds, **self.coverage.to_record()}
+
+def get_percent_covered_column(depth_threshold: int) -> str:
+    return f"percent_covered_{depth_threshold}x"
+
+def compute_depth(bamfile: pysam.AlignmentFile, contig: str, start: int, end: int) -> tuple[np.ndarray, int]:
+    """
+    Depth of each position from start to end (0-based, end exclusive) of a contig and the number of reads counted.
+
+    The aligned blocks of the reads (M, = and X operations, no deletions or skipped regions) are
+    turned into the depth with a difference array: +1 at the start and -1 at the end of each block,
+    summed up with one cumulative sum. This gives the same depth as samtools depth.
+    The blocks are added to the difference array in batches of BLOCK_BATCH_SIZE.
+    """
+    length = end - start
+    differences = np.zeros(length + 1, dtype=np.int64)
+
+    block_starts = []
+    block_ends = []
+    read_count = 0
+
+    def add_blocks():
+        # blocks of reads overlapping the start or end of the region are clipped to it
+        differences[:] += np.bincount(np.clip(np.array(block_starts, dtype=np.int64) - start, 0, length), minlength=length + 1)
+        differences[:] -= np.bincount(np.clip(np.array(block_ends, dtype=np.int64) - start, 0, length), minlength=length + 1)
+        block_starts.clear()
+        block_ends.clear()
+
+    for read in bamfile.fetch(contig, start, end):
+        if read.flag & EXCLUDED_READ_FLAGS:
+            continue
+
+        read_count += 1
+
+        for block_start, block_end in read.get_blocks():
+            block_starts.append(block_start)
+            block_ends.append(block_end)
+
+        if len(block_starts) >= BLOCK_BATCH_SIZE:
+            add_blocks()
+
+    if block_starts:
+        add_blocks()
+
+    return np.cumsum(differences[:length]).astype(np.int32), read_count
+
+def summarize_depth(scaffold: str, depth: np.ndarray, read_count: int = 0) -> ScaffoldCoverage:
+    return ScaffoldCoverage(
+        scaffold=scaffold,
+        total_bases=len(depth),
+        depth_sum=int(depth.sum(dtype=np.int64)),
+        max_depth=int(depth.max()) if len(depth) else 0,
+        covered_bases=int(np.count_nonzero(depth)),
+        threshold_bases={depth_threshold: int(np.count_nonzero(depth >= depth_threshold)) for depth_threshold in COVERAGE_DEPTH_THRESHOLDS},
+        read_count=read_count)
+
+def get_bin_coverages(contig: str, start: int, offset: int, depth: np.ndarray, bin_size: int) -> list[BinCoverage]:
+    """
+    Coverage of the parts of the bins in the depth of a region from start of a contig.
+    offset is the position of the start of the region in the contigs with reads, laid end to end.
+    """
+    # positions in the region where a new bin starts, the region itself starts the first part
+    bin_starts = np.arange((-offset) % bin_size, len(depth), bin_size)
+    part_starts = bin_starts if len(bin_starts) and bin_starts[0] == 0 else np.concatenate(([0], bin_starts))
+
+    part_lengths = np.diff(np.append(part_starts, len(depth)))
+    depth_sums = np.add.reduceat(depth, part_starts, dtype=np.int64)
+    max_depths = np.maximum.reduceat(depth, part_starts)
+    covered_bases = np.add.reduceat((depth > 0).astype(np.int32), part_starts)
+    threshold_bases = {depth_threshold: np.add.reduceat((depth >= depth_threshold).astype(np.int32), part_starts) for depth_threshold in COVERAGE_DEPTH_THRESHOLDS}
+
+    bin_coverages = []
+    for part_index, part_start in enumerate(part_starts):
+        coverage = ScaffoldCoverage(
+            scaffold=contig,
+            total_bases=int(part_lengths[part_index]),
+            depth_sum=int(depth_sums[part_index]),
+            max_depth=int(max_depths[part_index]),
+            covered_bases=int(covered_bases[part_index]),
+            threshold_bases={depth_threshold: int(bases[part_index]) for depth_threshold, bases in threshold_bases.items()})
+
+        bin_coverages.append(BinCoverage((offset + int(part_start)) // bin_size, contig, start + int(part_start), coverage))
+
+    return bin_coverages
+
+def merge_bin_coverages(bin_coverages: list) -> list[BinCoverage]:
+    """
+    Merges the parts of each bin from the regions of the shards, in the order of the bins.
+    """
+    merged = {}
+
+    for bin_coverage in bin_coverages:
+        if bin_coverage.bin not in merged:
+            # a bin starting within a scaffold already overlaps it
+            merged[bin_coverage.bin] = BinCoverage(bin_coverage.bin, bin_coverage.scaffold, bin_coverage.start,
+                                                   ScaffoldCoverage(bin_coverage.scaffold), scaffolds=int(bin_coverage.start > 0))
+
+        merged_bin = merged[bin_coverage.bin]
+        merged_bin.coverage.add(bin_coverage.coverage)
+
+        # each part starting a scaffold adds it, a scaffold split into regions of several shards is counted once
+        if bin_coverage.start == 0:
+            merged_bin.scaffolds += 1
+
+    return [merged[bin_index] for bin_index in sorted(merged)]
+
+def get_coverage_shards(bam_file: str, shard_size: int = DEFAULT_SHARD_SIZE, bin_size: int = None) -> list[CoverageShard]:
+    """
+    Splits a sorted and indexed BAM file into shards of about shard_size bases, in the order of the contigs.
+    Contigs without reads in the index are left out. With a bin size, the shards compute the binned coverage too.
+    """
+    shards = []
+    current_shard = CoverageShard(bam_file, bin_size=bin_size)
+
+    # position of the contig in the contigs with reads, laid end to end
+    offset = 0
+
+    with pysam.AlignmentFile(bam_file, 'rb') as bamfile:
+        contigs_with_reads = {statistics.contig for statistics in bamfile.get_index_statistics() if statistics.mapped}
+
+        for contig, length in zip(bamfile.references, bamfile.lengths):
+            if contig not in contigs_with_reads:
+                continue
+
+            for start in range(0, length, shard_size):
+                current_shard.add_region(contig, start, min(start + shard_size, length), offset + start)
+
+                if current_shard.length >= shard_size:
+                    shards.append(current_shard)
+                    current_shard = CoverageShard(bam_file, bin_size=bin_size)
+
+            offset += length
+
+    if current_shard.regions:
+        shards.append(current_shard)
+
+    return shards
+
+def compute_shard_coverage(shard: CoverageShard, threads: int = 1) -> tuple[list[ScaffoldCoverage], list[BinCoverage]]:
+    # the coverage of each region of the shard and of the parts of its bins,
+    # the windows of a contig are merged by merge_coverages and the parts of a bin by merge_bin_coverages
+    coverages = []
+    bin_coverages = []
+
+    stored_depth = depth_store.open_work_file(shard.depth_file) if shard.depth_file else None
+
+    with pysam.AlignmentFile(shard.bam_file, 'rb', threads=threads) as bamfile:
+        for region_index, (contig, start, end) in enumerate(shard.regions):
+            depth, read_count = compute_depth(bamfile, contig, start, end)
+            coverages.append(summarize_depth(contig, depth, read_count))
+
+            if shard.bin_size:
+                bin_coverages += get_bin_coverages(contig, start, shard.bin_offsets[region_index], depth, shard.bin_size)
+
+            if stored_depth is not None:
+                offset = shard.depth_offsets[region_index]
+                stored_depth[offset:offset + len(depth)] = depth
+
+    if stored_depth is not None:
+        stored_depth.flush()
+
+    return coverages, bin_coverages
+
+def merge_coverages(coverages: list) -> list[ScaffoldCoverage]:
+    """
+    Merges the coverages of the windows of each scaffold, in the order of the scaffolds.
+    Like samtools depth -a, only scaffolds with reads are reported, with all of their positions.
+    """
+    merged = {}
+
+    for coverage in coverages:
+        merged.setdefault(coverage.scaffold, ScaffoldCoverage(coverage.scaffold)).add(coverage)
+
+    return [coverage for coverage in merged.values() if coverage.read_count]
+
+def compute_coverage(bam_file: str, threads: int = 1, shard_size: int = DEFAULT_SHARD_SIZE) -> list[ScaffoldCoverage]:
+    """
+    Depth and breadth per scaffold of a sorted and indexed BAM file, computed from the reads
+    without writing the depth of each position. The shards are computed one after the other,
+    see determine_coverage_depth_and_breadth for the computation on a pool of workers.
+    """
+    coverages = []
+
+    for shard in get_coverage_shards(bam_file, shard_size):
+        coverages += compute_shard_coverage(shard, threads)[0]
+
+    return merge_coverages(coverages)
@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+# the depth of a sample is stored with the smallest of these types that holds its maximum depth
+DEPTH_DTYPES = [np.uint16, np.uint32]
+
+# positions copied at once when the depth is converted to a smaller type
+COPY_BLOCK_SIZE = 64 * 1024 * 1024
+
+class DepthStore:
+    """
+    Depth of each position of a sample, stored as one array of all contigs with reads in a .npy file
+    and an index (JSON) with the offset and length of each contig.
+
+    The array is memory mapped, so a query only reads the positions of its region from disk.
+    Contigs of the reference genome without reads are not stored, their depth is 0.
+
+    Usage:
+        depth_store = DepthStore("Ind1_ref_depth_index.json")
+        depth = depth_store.get_depth("scaffold_1", 1000, 2000)
+    """
+
+    def __init__(self, index_file_path: str):
+        with open(index_file_path, "r") as f:
+            self.index = json.load(f)
+
+        data_file_path = os.path.join(os.path.dirname(os.path.abspath(index_file_path)), self.index["data_file"])
+        self.depth = np.load(data_file_path, mmap_mode="r")
+
+    @property
+    def contigs(self) -> dict:
+        # contig -> {"length": ..., "offset": ... or None if the contig has no reads}
+        return self.index["contigs"]
+
+    def get_depth(self, contig: str, start: int = 0, end: int = None) -> np.ndarray:
+        """
+        Depth from start to end (0-based, end exclusive) of a contig. The region is clipped to the contig.
+        """
+        if contig not in self.contigs:
+            raise KeyError(f"Contig {contig} is not part of the reference genome of the depth store.")
+
+        length = self.contigs[contig]["length"]
+        offset = self.contigs[contig]["offset"]
+
+        start = max(0, start)
+        end = length if end is None else min(end, length)
+
+        if end <= start:
+            return np.zeros(0, dtype=self.depth.dtype)
+
+        if offset is None:
+            return np.zeros(end - start, dtype=self.depth.dtype)
+
+        return np.array(self.depth[offset + start:offset + end])
+
+def parse_region(region: str) -> tuple[str, int, int | None]:
+    """
+    Parses a region like samtools, "contig:start-end" with 1-based inclusive positions, "contig:start"
+    or "contig". Returns the contig and the 0-based, end exclusive start and end (None for the end of the contig).
+    """
+    contig, separator, positions = region.rpartition(":")
+
+    if not separator or not positions.replace(",", "").replace("-", "").isdigit():
+        return region, 0, None
+
+    positions = positions.replace(",", "")
+    start, _, end = positions.partition("-")
+
+    return contig, int(start) - 1, int(end) if end else None
+
+def get_depth_dtype(max_depth: int):
+    for dtype in DEPTH_DTYPES:
+        if max_depth <= np.iinfo(dtype).max:
+            return dtype
+
+    raise ValueError(f"Depth {max_depth} exceeds the types of the depth store.")
+
+def get_work_file_path(data_file_path: str) -> str:
+    # the depth is written by the workers with the largest type first, the leading dot hides the file
+    folder_path, file_name = os.path.split(data_file_path)
+    return os.path.join(folder_path, f".work.{file_name}")
+
+def create_depth_store(work_file_path: str, contig_lengths: list, stored_contigs: list) -> dict:
+    """
+    Creates the work file of the depth of the stored contigs (all 0, on most file systems without
+    writing them) and returns the index with the offset of each stored contig.
+    contig_lengths is the list of (contig, length) of the reference genome.
+    """
+    lengths = dict(contig_lengths)
+    contigs = {contig: {"length": length, "offset": None} for contig, length in contig_lengths}
+
+    offset = 0
+    for contig in stored_contigs:
+        contigs[contig]["offset"] = offset
+        offset += lengths[contig]
+
+    depth = np.lib.format.open_memmap(work_file_path, mode="w+", dtype=DEPTH_DTYPES[-1], shape=(offset,))
+    del depth
+
+    return {"contigs": contigs}
+
+def open_work_file(work_file_path: str) -> np.memmap:
+    # opened by the workers, each writes the positions of its own regions
+    return np.load(work_file_path, mmap_mode="r+")
+
+def finish_depth_store(work_file_path: str, index: dict, max_depth: int, data_file_path: str, index_file_path: str, data_file_name: str):
+    """
+    Writes the depth with the smallest type that holds the maximum depth and the index.
+    data_file_name is the name of the data file the index refers to.
+    """
+    dtype = get_depth_dtype(max_depth)
+
+    if dtype == DEPTH_DTYPES[-1]:
+        os.replace(work_file_path, data_file_path)
+    else:
+        work_depth = np.load(work_file_path, mmap_mode="r")
+        depth = np.lib.format.open_memmap(data_file_path, mode="w+", dtype=dtype, shape=work_depth.shape)
+
+        for start in range(0, len(work_depth), COPY_BLOCK_SIZE):
+            depth[start:start + COPY_BLOCK_SIZE] = work_depth[start:start + COPY_BLOCK_SIZE]
+
+        depth.flush()
+        del depth, work_depth
+        os.remove(work_file_path)
+
+    with open(index_file_path, "w") as f:
+        json.dump({"data_file": data_file_name, "dtype": np.dtype(dtype).name, **index}, f)
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the depth of a sample over regions of the reference genome.")
+    parser.add_argument("index_file", help="Index of the depth store of the sample (_depth_index.json)")
+    parser.add_argument("regions", nargs="+", help="Regions as contig:start-end (1-based, inclusive), contig:start or contig")
+    parser.add_argument("--summary", action="store_true", help="Print the average and maximum depth and the covered bases per region instead of each position")
+    args = parser.parse_args()
+
+    depth_store = DepthStore(args.index_file)
+
+    for region in args.regions:
+        contig, start, end = parse_region(region)
+
+        try:
+            depth = depth_store.get_depth(contig, start, end)
+        except KeyError as e:
+            print(e.args[0], file=sys.stderr)
+            sys.exit(1)
+
+        if args.summary:
+            average_depth = depth.mean() if len(depth) else 0.0
+            max_depth = depth.max() if len(depth) else 0
+            print(f"{region}\t{len(depth)}\t{average_depth:.4f}\t{max_depth}\t{np.count_nonzero(depth)}")
+            continue
+
+        # the same columns as samtools depth
+        positions = np.arange(max(0, start) + 1, max(0, start) + len(depth) + 1)
+        sys.stdout.writelines(f"{contig}\t{position}\t{value}\n" for position, value in zip(positions, depth))
+
+if __name__ == "__main__":
+    main()
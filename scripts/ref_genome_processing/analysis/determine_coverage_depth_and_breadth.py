@@ -1,168 +1,139 @@
 import os
-import subprocess
-import collections
+import pysam
 import pandas as pd
 
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool
 
 from common_aDNA_scripts import *
 
 import ref_genome_processing.common_ref_genome_processing_helpers as common_rgp
+import ref_genome_processing.analysis.coverage_engine as coverage_engine
+import ref_genome_processing.analysis.depth_store as depth_store
 
-def execute_samtools_detpth(input_file: str, coverage_output_file: str):
+from common.common_result_store import ResultStore, RESULT_TABLE_COVERAGE_ANALYSIS, export_result_table, get_result_fingerprint
 
-    print_info(f"Executing samtools depth for {input_file}")
+# columns of the coverage analysis file of a sample, the combined detailed file adds the Filename
+COVERAGE_ANALYSIS_COLUMNS = ["scaffold", "avg_depth", "max_depth", "covered_bases", "total_bases", "percent_covered"] + \
+    [coverage_engine.get_percent_covered_column(depth_threshold) for depth_threshold in coverage_engine.COVERAGE_DEPTH_THRESHOLDS]
 
-    if not os.path.exists(input_file):
-        raise Exception(f"Input file {input_file} does not exist!")
+# columns of the binned coverage file of a sample, the scaffold and start are those at the start of the bin
+BINNED_COVERAGE_ANALYSIS_COLUMNS = ["bin", "scaffold", "start", "scaffolds"] + COVERAGE_ANALYSIS_COLUMNS[1:]
 
-    if os.path.exists(coverage_output_file):
-        print_skipping(f"Output file {coverage_output_file} already exists!")
-        return
+def get_analysis_file_path(bam_file: str, depth_breath_output_folder: str) -> str:
+    return os.path.join(depth_breath_output_folder, get_filename_from_path(bam_file).replace(FILE_ENDING_SORTED_BAM, FILE_ENDING_EXTENDED_COVERAGE_ANALYSIS_CSV))
 
-    command = f"{PROGRAM_PATH_SAMTOOLS} {PROGRAM_PATH_SAMTOOLS_DEPTH} -a {input_file} > {coverage_output_file}"
-    print_debug(f"Samtools depth command: {command}")
+def get_binned_analysis_file_path(bam_file: str, depth_breath_output_folder: str) -> str:
+    return os.path.join(depth_breath_output_folder, get_filename_from_path(bam_file).replace(FILE_ENDING_SORTED_BAM, FILE_ENDING_BINNED_COVERAGE_ANALYSIS_CSV))
 
-    try:
-        result = subprocess.run(command, shell=True,  check=True  )
-        print_success(f"Samtools depth complete for {input_file}")
-    except Exception as e:
-        print_error(f"Failed to execute samtools depth: {e}")
-
-def analyze_coverage_file(coverage_file, depth_breath_output_folder):
-
-    # The `analyze_coverage_file()` function was originally processing the entire coverage file 
-    # in-memory at once. However, this approach posed significant memory limitations when working 
-    # with large coverage files (common in bioinformatics tasks). Processing large files as a whole 
-    # would result in high memory usage and may cause the program to crash, particularly when 
-    # dealing with files that contain millions of lines (such as BAM depth files).
-
-    # ### Key Reasons for Switching to Chunked Processing:
-    # 1. **Memory Efficiency:**
-    #    - By processing the file in **chunks** rather than reading it all at once, we keep memory usage low. 
-    #      This allows the program to handle much larger files, even if the system’s memory is limited.
-    #    - The chunk size (set as `10^6` lines) can be adjusted based on system memory availability, offering flexibility.
-
-    # 2. **Avoiding Memory Overload:**
-    #    - If the entire file were read into memory at once (especially for large files), it could exhaust 
-    #      available system RAM, leading to slowdowns or crashes. By processing chunks sequentially, only a 
-    #      small portion of the file is in memory at any given time, reducing memory load.
-
-    # 3. **Improved Performance on Large Datasets:**
-    #    - Chunked processing allows us to process large datasets in manageable pieces. It helps avoid issues 
-    #      with memory leaks or excessive garbage collection time (as only small portions of the file are processed at once).
-    #    - It ensures that the program continues to run even for files that might otherwise exceed available memory.
-
-    # 4. **Progress Tracking and Monitoring:**
-    #    - When processing in chunks, progress can be tracked at meaningful intervals. 
-    #      In this case, the program reports progress every time a chunk is processed, providing 
-    #      real-time feedback on how much of the file has been completed.
-    #    - This is particularly helpful in bioinformatics tasks, where large files may take a significant 
-    #      amount of time to process.
-
-    pid = os.getpid()  # Get current process ID for logging
-
-    # Generate output file path based on input file name
-    coverage_file_base_name = get_filename_from_path(coverage_file)
-    analysis_file = coverage_file_base_name.replace(
-        FILE_ENDING_SAMTOOLS_DEPTH_TSV,
-        FILE_ENDING_EXTENDED_COVERAGE_ANALYSIS_CSV
-    )
-    analysis_file_path = os.path.join(depth_breath_output_folder, analysis_file)
-
-    print_info(f"Performing extended analysis for {coverage_file_base_name} with PID {pid}")
-
-    # Skip processing if output already exists
-    if os.path.exists(analysis_file_path):
-        print_skipping(f"[PID {pid}] Analysis file {analysis_file_path} already exists.")
-        return
+def get_result_key(bam_file: str, species: str, reference_genome_id: str) -> dict:
+    # the results of the sample are stored under the name of its bam file
+    return {
+        "species": species,
+        "reference_genome": reference_genome_id,
+        "Filename": get_filename_from_path(bam_file)
+    }
 
-    # Check that the input file exists
-    if not os.path.exists(coverage_file):
-        print_error(f"[PID {pid}] Coverage file {coverage_file} does not exist!")
-        return
+def get_shard_size(species: str) -> int:
+    settings = get_processing_settings(ReferenceGenomeProcessingSteps.DETERMINE_COVERAGE_DEPTH_AND_BREADTH, species)
+    return int(settings.get(CoverageSettings.SHARD_SIZE.value, coverage_engine.DEFAULT_SHARD_SIZE))
 
-    # Count total lines in the file to estimate processing progress
-    try:
-        with open(coverage_file, 'r') as f:
-            total_lines = sum(1 for _ in f)
-    except Exception as e:
-        print_error(f"[PID {pid}] Error counting lines in {coverage_file_base_name}: {e}")
-        return
-    
-    print_info(f"[PID {pid}] Total lines in {coverage_file_base_name} to analyze: {total_lines:,}")
+def get_bin_size(species: str) -> int:
+    settings = get_processing_settings(ReferenceGenomeProcessingSteps.DETERMINE_COVERAGE_DEPTH_AND_BREADTH, species)
+    return int(settings.get(CoverageSettings.BIN_SIZE.value, coverage_engine.DEFAULT_BIN_SIZE))
 
-    # Dictionary to hold aggregated stats per scaffold
-    summary_data = collections.defaultdict(lambda: {
-        "depth_sum": 0,         # Sum of all depth values (used to calculate avg_depth)
-        "max_depth": 0,         # Maximum depth seen
-        "covered_bases": 0,     # Number of positions with depth > 0
-        "total_bases": 0        # Total number of positions (regardless of depth)
-    })
+def get_input_fingerprint(bam_file: str, species: str) -> str:
+    # the coverage is computed again when the BAM file or the bins change, the shards do not change the result
+    return get_result_fingerprint([bam_file], bin_size=get_bin_size(species))
 
-    lines_processed = 0                 # Running total of how many lines have been read
-    chunk_size = 10**6                  # Number of rows per chunk (adjustable for tuning)
+def is_depth_store_enabled(species: str) -> bool:
+    # the depth of each position is kept in a depth store, e.g. to query the depth of genes or mtDNA regions
+    settings = get_processing_settings(ReferenceGenomeProcessingSteps.DETERMINE_COVERAGE_DEPTH_AND_BREADTH, species)
+    return bool(settings.get(CoverageSettings.DEPTH_STORE.value, False))
 
-    # Dictionary to track progress milestones. Once a milestone is reached, it is marked as True
-    # This prevents multiple printouts for the same milestone
-    milestones = {25: False, 50: False, 75: False}
+def get_depth_store_paths(bam_file: str, depth_store_folder: str) -> tuple[str, str]:
+    bam_file_base_name = get_filename_from_path(bam_file)
 
-    try:
-        # Process the file in chunks using pandas for memory efficiency
-        for chunk in pd.read_csv(coverage_file, sep="\t", header=None,
-                                 names=["scaffold", "position", "depth"],
-                                 chunksize=chunk_size):
-
-            # Group each chunk by scaffold and update cumulative statistics
-            grouped = chunk.groupby("scaffold")
-            for scaffold, group in grouped:
-                summary_data[scaffold]["depth_sum"] += group["depth"].sum()
-                summary_data[scaffold]["max_depth"] = max(
-                    summary_data[scaffold]["max_depth"],
-                    group["depth"].max()
-                )
-                summary_data[scaffold]["covered_bases"] += (group["depth"] > 0).sum()
-                summary_data[scaffold]["total_bases"] += len(group)
-
-            # Update line count and calculate percent progress
-            lines_processed += len(chunk)
-            percent_done = (lines_processed / total_lines) * 100
-
-            # Log specific progress milestones (only once each)
-            for milestone in milestones:
-                if not milestones[milestone] and percent_done >= milestone:
-                    print_info(f"[PID {pid}] Progress for {coverage_file_base_name}: {milestone}% completed")
-                    milestones[milestone] = True
-
-            # Regular progress printout (can be silenced if too verbose)
-            print_debug(f"[PID {pid}] Progress for {coverage_file_base_name}: {lines_processed:,}/{total_lines:,} lines ({percent_done:.1f}%) processed")
+    data_file_path = os.path.join(depth_store_folder, bam_file_base_name.replace(FILE_ENDING_SORTED_BAM, FILE_ENDING_DEPTH_STORE_NPY))
+    index_file_path = os.path.join(depth_store_folder, bam_file_base_name.replace(FILE_ENDING_SORTED_BAM, FILE_ENDING_DEPTH_STORE_INDEX_JSON))
+
+    return data_file_path, index_file_path
+
+def prepare_depth_store(bam_file: str, shards: list, depth_store_folder: str) -> dict:
+    """
+    Creates the work file of the depth store of a BAM file and assigns the offsets of their regions to the shards.
+    Returns the index of the depth store.
+    """
+    data_file_path, _ = get_depth_store_paths(bam_file, depth_store_folder)
+    work_file_path = depth_store.get_work_file_path(data_file_path)
+
+    with pysam.AlignmentFile(bam_file, 'rb') as bamfile:
+        contig_lengths = list(zip(bamfile.references, bamfile.lengths))
+
+    # the contigs with reads, in the order of the shards
+    stored_contigs = list(dict.fromkeys(contig for shard in shards for contig, _, _ in shard.regions))
+
+    index = depth_store.create_depth_store(work_file_path, contig_lengths, stored_contigs)
+
+    for shard in shards:
+        shard.depth_file = work_file_path
+        shard.depth_offsets = [index["contigs"][contig]["offset"] + start for contig, start, _ in shard.regions]
+
+    return index
+
+def write_depth_store(bam_file: str, index: dict, max_depth: int, depth_store_folder: str):
+    data_file_path, index_file_path = get_depth_store_paths(bam_file, depth_store_folder)
+
+    # the index is renamed last, its existence marks a complete depth store
+    with atomic_output(index_file_path, data_file_path) as (temp_index_file_path, temp_data_file_path):
+        depth_store.finish_depth_store(depth_store.get_work_file_path(data_file_path), index, max_depth,
+                                       temp_data_file_path, temp_index_file_path, get_filename_from_path(data_file_path))
 
+    print_info(f"Wrote depth store of {get_filename_from_path(bam_file)} to {index_file_path}")
+
+def compute_shard_coverage(shard: coverage_engine.CoverageShard) -> tuple | None:
+    """
+    Computes the coverage of the regions of a shard. This helper function is for use with multiprocessing,
+    a failed shard is reported and returns None, so the shards of the other BAM files are not lost.
+    """
+    try:
+        return coverage_engine.compute_shard_coverage(shard, threads=get_task_threads())
     except Exception as e:
-        print_error(f"[PID {pid}] Failed during processing of {coverage_file}: {e}")
-        return
+        print_error(f"[PID {os.getpid()}] Failed to compute the coverage of {shard.regions[0][0]} and following regions of {shard.bam_file}: {e}")
+        return None
+
+def write_coverage_analysis(bam_file: str, coverages: list, depth_breath_output_folder: str, species: str, reference_genome_id: str, fingerprint: str):
+    """
+    Writes the depth and breadth per scaffold of a BAM file to the result store and to CSV, read by the plots of the sample.
+    """
+    analysis_file_path = get_analysis_file_path(bam_file, depth_breath_output_folder)
+
+    summary = pd.DataFrame([coverage.to_record() for coverage in coverages], columns=COVERAGE_ANALYSIS_COLUMNS)
+
+    print_debug(f"Saving summary of {len(summary):,} scaffolds to {analysis_file_path} ...")
 
-    # Convert cumulative summary data into a pandas DataFrame
-    summary = pd.DataFrame.from_dict(summary_data, orient="index")
-    summary.index.name = "scaffold"  # Label index for clarity
+    with ResultStore() as result_store:
+        result_store.write_records(RESULT_TABLE_COVERAGE_ANALYSIS, get_result_key(bam_file, species, reference_genome_id), summary.to_dict("records"), fingerprint)
 
-    # Calculate final metrics
-    summary["avg_depth"] = summary["depth_sum"] / summary["total_bases"]
-    summary["percent_covered"] = (summary["covered_bases"] / summary["total_bases"]) * 100
+    export_result_table(summary, analysis_file_path, COVERAGE_ANALYSIS_COLUMNS)
 
-    # Reorder and filter columns to match expected output format
-    summary = summary[["avg_depth", "max_depth", "covered_bases", "total_bases", "percent_covered"]]
+    print_info(f"Extended analysis complete for {bam_file}")
 
-    # Save result to CSV
-    print_debug(f"[PID {pid}] Saving summary to {analysis_file_path} ...")
-    summary.to_csv(analysis_file_path)
+def write_binned_coverage_analysis(bam_file: str, bin_coverages: list, depth_breath_output_folder: str):
+    """
+    Writes the depth and breadth per bin of a BAM file to CSV, read by the plots instead of the coverage per scaffold.
+    """
+    binned_analysis_file_path = get_binned_analysis_file_path(bam_file, depth_breath_output_folder)
+
+    summary = pd.DataFrame([bin_coverage.to_record() for bin_coverage in bin_coverages], columns=BINNED_COVERAGE_ANALYSIS_COLUMNS)
 
-    print_info(f"[PID {pid}] Extended analysis complete for {coverage_file}")
+    print_debug(f"Saving summary of {len(summary):,} bins to {binned_analysis_file_path} ...")
 
+    export_result_table(summary, binned_analysis_file_path, BINNED_COVERAGE_ANALYSIS_COLUMNS)
 
 def determine_coverage_depth_and_breath(species: str):
     """
     Orchestrates the coverage depth and breadth analysis for a single species.
-    Executes samtools depth, performs extended analysis, and combines results.
+    Determines depth and breadth per scaffold of each BAM file and combines results.
     """
     print_info(f"Processing coverage depth and breadth for species: {species}")
 
@@ -178,24 +149,30 @@ def determine_coverage_depth_and_breath(species: str):
         ref_genome_id = ref_genome_tuple[0]
         #ref_genome_path = ref_genome_tuple[1]
 
-        print_info(f"Processing coverage depth and breadth for reference genome: {ref_genome_id}")
+        determine_coverage_depth_and_breath_for_reference_genome(species, ref_genome_id)
 
-        # Step 1: Execute samtools depth for each BAM file
-        execute_samtools_depth_for_species(species, ref_genome_id)
+    print_info(f"Coverage depth and breadth processing complete for species: {species}")
 
-        # Step 2: Perform extended analysis on each coverage file
-        perform_extended_analysis_for_species(species, ref_genome_id)
+def determine_coverage_depth_and_breath_for_reference_genome(species: str, reference_genome_id: str):
+    """
+    Runs the coverage depth and breadth analysis of a species for a single reference genome.
+    """
+    print_info(f"Processing coverage depth and breadth for reference genome: {reference_genome_id}")
 
-        # Step 3: Combine the individual analysis files
-        combine_analysis_files(species, ref_genome_id)
+    # Step 1: Determine depth and breadth per scaffold of each BAM file
+    perform_coverage_analysis_for_species(species, reference_genome_id)
 
-    print_info(f"Coverage depth and breadth processing complete for species: {species}")
+    # Step 2: Combine the individual analysis files
+    combine_analysis_files(species, reference_genome_id)
 
-def execute_samtools_depth_for_species(species: str, reference_genome_id: str):
+@track_resource_usage
+def perform_coverage_analysis_for_species(species: str, reference_genome_id: str):
     """
-    Finds all sorted BAM files for a species and executes samtools depth on each.
+    Finds all sorted BAM files for a species and determines the depth and breadth of each.
+    The BAM files are split into shards of contigs or windows of large contigs through their index,
+    so a single large BAM file is computed on all threads of the task.
     """
-    print_info(f"Executing samtools depth for all BAM files for species: {species}")
+    print_info(f"Performing extended analysis on BAM files for species: {species}")
 
     mapped_folder = get_folder_path_species_processed_refgenome_mapped(species, reference_genome_id)
     list_of_bam_files = get_files_in_folder_matching_pattern(mapped_folder, f"*{FILE_ENDING_SORTED_BAM}")
@@ -207,174 +184,172 @@ def execute_samtools_depth_for_species(species: str, reference_genome_id: str):
     print_debug(f"Found {len(list_of_bam_files)} BAM files for species {species}")
     print_debug(f"BAM files: {list_of_bam_files}")
 
-    depth_breath_output_folder = get_folder_path_species_processed_refgenome_coverage(species, reference_genome_id)
+    target_folder = get_folder_path_species_results_refgenome_coverage(species, reference_genome_id)
+    shard_size = get_shard_size(species)
+    bin_size = get_bin_size(species)
 
-    # Create a pool of worker processes to parallelize the execution.
-    # Using cpu_count() to get the number of available CPU cores
-    # use THREADS_DEFAULT to limit the number of processes as long as it is not higher than the number of cores
-    # If THREADS_DEFAULT is higher than the number of cores, use the number of cores instead
-    num_processes = min(THREADS_DEFAULT, cpu_count())
-    
-    with Pool(processes=num_processes) as pool:
-        # Create a list of tuples, where each tuple contains the arguments
-        # for the process_bam_file function.
-        tasks = [(bam_file, depth_breath_output_folder) for bam_file in list_of_bam_files]
-        # Use pool.starmap to apply the function to each set of arguments.
-        # starmap unpacks the tuples and passes the elements as separate arguments.
-        # process_bam_file is the function to be executed in parallel.
-        # Each task is a tuple of (mapped_bam_file, depth_breath_output_folder)
-        # The function will be called with the arguments from each tuple.
-        # This allows for parallel processing of the BAM files.
-        # starmap will block until all tasks are completed.
-        pool.starmap(process_bam_file, tasks)
-
-    print_info(f"Finished executing samtools depth for species {species}")
-
-def process_bam_file(mapped_bam_file, depth_breath_output_folder):
-    """
-    Executes samtools depth on a single BAM file.  This helper function is for use with multiprocessing.
-    """
+    depth_store_enabled = is_depth_store_enabled(species)
+    depth_store_folder = get_folder_path_species_processed_refgenome_coverage(species, reference_genome_id)
+    depth_store_indexes = {}
 
-    pid = os.getpid()
+    # shards of the coverage per BAM file, a BAM file without mapped reads has none
+    shards_per_bam_file = {}
+    fingerprints = {}
+    for bam_file in list_of_bam_files:
+        analysis_file_path = get_analysis_file_path(bam_file, target_folder)
+        fingerprints[bam_file] = get_input_fingerprint(bam_file, species)
 
-    mapped_bam_file_base_name = get_filename_from_path(mapped_bam_file)
+        # the result store has the analysis of the current BAM file, not only one of the same name
+        with ResultStore() as result_store:
+            analysis_stored = result_store.has_records(RESULT_TABLE_COVERAGE_ANALYSIS, fingerprint=fingerprints[bam_file], **get_result_key(bam_file, species, reference_genome_id))
 
-    print_info(f"[PID {pid}] Processing BAM file {mapped_bam_file} with PID {pid}")
+        # the coverage is computed again if the depth store was enabled after the analysis
+        depth_store_missing = depth_store_enabled and not os.path.exists(get_depth_store_paths(bam_file, depth_store_folder)[1])
 
-    coverage_file_name = mapped_bam_file_base_name.replace(FILE_ENDING_SORTED_BAM, FILE_ENDING_SAMTOOLS_DEPTH_TSV)
-    coverage_output_file = os.path.join(depth_breath_output_folder, coverage_file_name)
-    execute_samtools_detpth(mapped_bam_file, coverage_output_file)
-    
-    print_info(f"[PID {pid}] Finished samtools depth for {mapped_bam_file}") 
+        # the binned coverage of analyses of earlier versions is missing too
+        binned_analysis_missing = not os.path.exists(get_binned_analysis_file_path(bam_file, target_folder))
 
-def perform_extended_analysis_for_species(species: str, reference_genome_id: str):
-    """
-    Finds all samtools depth output files for a species and performs extended analysis on each.
-    """
-    print_info(f"Performing extended analysis on depth files for species: {species}")
+        # Skip processing if output already exists
+        if analysis_stored and os.path.exists(analysis_file_path) and not depth_store_missing and not binned_analysis_missing:
+            print_skipping(f"Analysis file {analysis_file_path} already exists.")
+            continue
 
-    samtools_depth_folder = get_folder_path_species_processed_refgenome_coverage(species, reference_genome_id)
-    list_of_coverage_files = get_files_in_folder_matching_pattern(samtools_depth_folder, f"*{FILE_ENDING_SAMTOOLS_DEPTH_TSV}")
+        try:
+            shards = coverage_engine.get_coverage_shards(bam_file, shard_size, bin_size)
 
-    if len(list_of_coverage_files) == 0:
-        print_warning(f"No samtools depth files found in {samtools_depth_folder} for species {species}.")
-        return
+            if depth_store_enabled:
+                depth_store_indexes[bam_file] = prepare_depth_store(bam_file, shards, depth_store_folder)
 
-    print_debug(f"Found {len(list_of_coverage_files)} coverage files for species {species}")
-    print_debug(f"Coverage files: {list_of_coverage_files}")
+            shards_per_bam_file[bam_file] = shards
+        except Exception as e:
+            print_error(f"Failed to split {bam_file} into shards: {e}")
 
-    target_folder = get_folder_path_species_results_refgenome_coverage(species, reference_genome_id)
+    if not shards_per_bam_file:
+        print_info(f"No BAM files to analyze for species {species}")
+        return
+
+    shards = [shard for bam_file_shards in shards_per_bam_file.values() for shard in bam_file_shards]
 
     # Create a pool of worker processes to parallelize the execution.
-    # Using cpu_count() to get the number of available CPU cores
-    # use THREADS_DEFAULT to limit the number of processes as long as it is not higher than the number of cores
-    # If THREADS_DEFAULT is higher than the number of cores, use the number of cores instead
-    num_processes = min(THREADS_DEFAULT, cpu_count())
-
-    with Pool(processes=num_processes) as pool:
-        # Create a list of tuples, where each tuple contains the arguments
-        # for the analyze_coverage_file function.
-        tasks = [(file, target_folder) for file in list_of_coverage_files]
-        # Use pool.starmap to apply the function to each set of arguments.
-        # starmap unpacks the tuples and passes the elements as separate arguments.
-        # analyze_coverage_file is the function to be executed in parallel.
-        # Each task is a tuple of (coverage_file, depth_breath_output_folder)
-        # The function will be called with the arguments from each tuple.
-        # This allows for parallel processing of the coverage files.
-        # starmap will block until all tasks are completed.
-        pool.starmap(analyze_coverage_file, tasks)
+    # The number of processes is limited by the threads assigned to this task
+    # and by the number of shards. Each worker gets its share of the threads.
+    num_processes = get_pool_size(len(shards))
+
+    print_info(f"Computing the coverage of {len(shards)} shards with {num_processes} processes")
+
+    with Pool(processes=num_processes, initializer=set_task_threads, initargs=(get_threads_per_worker(num_processes),)) as pool:
+        # the results are in the order of the shards, so the scaffolds keep the order of the BAM header
+        shard_coverages = pool.map(compute_shard_coverage, shards, chunksize=1)
+
+    coverages_per_bam_file = {bam_file: [] for bam_file in shards_per_bam_file}
+    for shard, coverages in zip(shards, shard_coverages):
+        coverages_per_bam_file[shard.bam_file].append(coverages)
+
+    for bam_file, coverages in coverages_per_bam_file.items():
+        if any(shard_coverage is None for shard_coverage in coverages):
+            print_error(f"Coverage of {bam_file} is incomplete, no analysis file is written.")
+
+            if bam_file in depth_store_indexes:
+                remove_file_if_exists(depth_store.get_work_file_path(get_depth_store_paths(bam_file, depth_store_folder)[0]))
+            continue
+
+        scaffold_coverages = coverage_engine.merge_coverages([coverage for shard_coverage in coverages for coverage in shard_coverage[0]])
+        bin_coverages = coverage_engine.merge_bin_coverages([bin_coverage for shard_coverage in coverages for bin_coverage in shard_coverage[1]])
+
+        if bam_file in depth_store_indexes:
+            try:
+                write_depth_store(bam_file, depth_store_indexes[bam_file], max((coverage.max_depth for coverage in scaffold_coverages), default=0), depth_store_folder)
+            except Exception as e:
+                print_error(f"Failed to write the depth store of {bam_file}: {e}")
+
+        write_binned_coverage_analysis(bam_file, bin_coverages, target_folder)
+
+        # the analysis file is written last, its existence marks a complete analysis
+        write_coverage_analysis(bam_file, scaffold_coverages, target_folder, species, reference_genome_id, fingerprints[bam_file])
 
     print_info(f"Finished performing extended analysis for species {species}")
 
+@track_resource_usage
 def combine_analysis_files(species: str, reference_genome_id: str):
     
     print_info(f"Combining extended analysis files for species: {species}")
 
     # Folder paths
-    individual_files_folder = get_folder_path_species_results_refgenome_coverage(species, reference_genome_id)
-    analysis_folder = individual_files_folder  # same as above
+    analysis_folder = get_folder_path_species_results_refgenome_coverage(species, reference_genome_id)
 
     # Output file paths
     combined_file_path = os.path.join(analysis_folder, f"{species}{FILE_ENDING_COMBINED_COVERAGE_ANALYSIS_CSV}")
     combined_detailed_file_path = os.path.join(analysis_folder, f"{species}{FILE_ENDING_COMBINED_COVERAGE_ANALYSIS_DETAILED_CSV}")
+    combined_binned_file_path = os.path.join(analysis_folder, f"{species}{FILE_ENDING_COMBINED_COVERAGE_ANALYSIS_BINNED_CSV}")
 
-    # Locate files
-    individual_analysis_files = get_files_in_folder_matching_pattern(
-        individual_files_folder,
-        f"*{FILE_ENDING_EXTENDED_COVERAGE_ANALYSIS_CSV}"
-    )
+    # Read the per-scaffold results of all samples with one query
+    with ResultStore() as result_store:
+        df_detailed = result_store.read_records(RESULT_TABLE_COVERAGE_ANALYSIS, species=species, reference_genome=reference_genome_id)
 
-    if not individual_analysis_files:
-        print_warning(f"No individual analysis files found to combine for species {species} in {analysis_folder}.")
+    if df_detailed.empty:
+        print_warning(f"No analysis results found to combine for species {species} and reference genome {reference_genome_id}.")
         return
 
-    print_debug(f"Found {len(individual_analysis_files)} analysis files to combine for species {species}")
-    print_debug(f"Analysis files: {individual_analysis_files}")
+    print_debug(f"Found analysis results of {df_detailed['Filename'].nunique()} samples to combine for species {species}")
 
-    combined_data = []       # For aggregated summary
-    detailed_rows = []       # For raw, detailed per-scaffold data
+    # --- Aggregated stats per sample ---
+    df_detailed["depth_sum"] = df_detailed["avg_depth"] * df_detailed["total_bases"]
+    grouped = df_detailed.groupby("Filename", sort=False).agg(
+        depth_sum=("depth_sum", "sum"),
+        OverallMaxDepth=("max_depth", "max"),
+        OverallCoveredBases=("covered_bases", "sum"),
+        OverallTotalBases=("total_bases", "sum"),
+    ).reset_index()
 
-    for analysis_file in individual_analysis_files:
-        try:
-            df_analysis = pd.read_csv(analysis_file)
-
-            if df_analysis.empty:
-                print_warning(f"Analysis file {analysis_file} is empty.")
-                continue
-
-            # Parse BAM filename from analysis filename
-            original_bam_base = get_filename_from_path(analysis_file).replace(FILE_ENDING_EXTENDED_COVERAGE_ANALYSIS_CSV, "")
-            original_bam_filename = original_bam_base + FILE_ENDING_SORTED_BAM
-
-            # --- Aggregated stats ---
-            total_bases_sum = df_analysis['total_bases'].sum()
-            overall_avg_depth = (df_analysis['avg_depth'] * df_analysis['total_bases']).sum() / total_bases_sum if total_bases_sum > 0 else 0
-            overall_max_depth = df_analysis['max_depth'].max()
-            overall_covered_bases = df_analysis['covered_bases'].sum()
-            overall_total_bases = total_bases_sum
-            overall_percent_covered = (overall_covered_bases / overall_total_bases) * 100 if overall_total_bases > 0 else 0
-
-            combined_data.append({
-                "Filename": original_bam_filename,
-                "OverallAvgDepth": overall_avg_depth,
-                "OverallMaxDepth": overall_max_depth,
-                "OverallCoveredBases": overall_covered_bases,
-                "OverallTotalBases": overall_total_bases,
-                "OverallPercentCovered": overall_percent_covered
-            })
-
-            # --- Append raw rows, tagged with filename ---
-            df_analysis['Filename'] = original_bam_filename
-            detailed_rows.append(df_analysis)
-
-        except FileNotFoundError:
-            print_error(f"Analysis file not found: {analysis_file}.")
-        except pd.errors.EmptyDataError:
-            print_warning(f"Analysis file is empty or malformed: {analysis_file}.")
-        except Exception as e:
-            print_error(f"An error occurred processing analysis file {analysis_file}: {e}")
+    has_bases = grouped["OverallTotalBases"] > 0
+    grouped["OverallAvgDepth"] = (grouped["depth_sum"] / grouped["OverallTotalBases"]).where(has_bases, 0)
+    grouped["OverallPercentCovered"] = (grouped["OverallCoveredBases"] / grouped["OverallTotalBases"] * 100).where(has_bases, 0)
+
+    # breadth at the depth thresholds, from the covered bases per scaffold
+    overall_threshold_columns = []
+    for depth_threshold in coverage_engine.COVERAGE_DEPTH_THRESHOLDS:
+        percent_covered_column = coverage_engine.get_percent_covered_column(depth_threshold)
+        threshold_bases = (df_detailed[percent_covered_column] * df_detailed["total_bases"] / 100).groupby(df_detailed["Filename"], sort=False).sum()
+
+        overall_column = f"OverallPercentCovered_{depth_threshold}x"
+        grouped[overall_column] = (grouped["Filename"].map(threshold_bases) / grouped["OverallTotalBases"] * 100).where(has_bases, 0)
+        overall_threshold_columns.append(overall_column)
 
     # --- Save aggregated summary ---
-    if combined_data:
-        df_combined = pd.DataFrame(combined_data)
-        try:
-            df_combined.to_csv(combined_file_path, index=False)
-            print_success(f"Successfully created combined coverage analysis file: {combined_file_path}")
-        except Exception as e:
-            print_error(f"Error writing combined file: {e}")
-    else:
-        print_warning(f"No valid aggregated data to write for species {species}.")
+    try:
+        export_result_table(grouped, combined_file_path, ["Filename", "OverallAvgDepth", "OverallMaxDepth", "OverallCoveredBases", "OverallTotalBases", "OverallPercentCovered"] + overall_threshold_columns)
+        print_success(f"Successfully created combined coverage analysis file: {combined_file_path}")
+    except Exception as e:
+        print_error(f"Error writing combined file: {e}")
 
     # --- Save detailed per-scaffold data ---
-    if detailed_rows:
-        try:
-            df_detailed_combined = pd.concat(detailed_rows, ignore_index=True)
-            df_detailed_combined.to_csv(combined_detailed_file_path, index=False)
-            print_success(f"Successfully created detailed coverage file: {combined_detailed_file_path}")
-        except Exception as e:
-            print_error(f"Error writing detailed combined file: {e}")
-    else:
-        print_warning(f"No detailed data available to write for species {species}.")
+    try:
+        export_result_table(df_detailed, combined_detailed_file_path, COVERAGE_ANALYSIS_COLUMNS + ["Filename"])
+        print_success(f"Successfully created detailed coverage file: {combined_detailed_file_path}")
+    except Exception as e:
+        print_error(f"Error writing detailed combined file: {e}")
+
+    # --- Save binned data, read by the plots of all samples ---
+    binned_analyses = []
+    for filename in df_detailed["Filename"].unique():
+        binned_analysis_file_path = get_binned_analysis_file_path(filename, analysis_folder)
+
+        if not os.path.exists(binned_analysis_file_path):
+            print_warning(f"Binned analysis file {binned_analysis_file_path} not found, {filename} is missing in the combined binned file.")
+            continue
+
+        df_binned = pd.read_csv(binned_analysis_file_path)
+        df_binned["Filename"] = filename
+        binned_analyses.append(df_binned)
+
+    if not binned_analyses:
+        return
+
+    try:
+        export_result_table(pd.concat(binned_analyses, ignore_index=True), combined_binned_file_path, BINNED_COVERAGE_ANALYSIS_COLUMNS + ["Filename"])
+        print_success(f"Successfully created binned coverage file: {combined_binned_file_path}")
+    except Exception as e:
+        print_error(f"Error writing binned combined file: {e}")
 
 
 def all_species_determine_coverage_depth_and_breath():
@@ -1,128 +1,150 @@
 import os
+import pysam
 from common_aDNA_scripts import *
 
 import ref_genome_processing.common_ref_genome_processing_helpers as common_rgp
 
-def execute_samtools_count_mapped_reads(bam_file: str, threads: int=THREADS_DEFAULT) -> int:
-    """Counts the number of mapped reads in a BAM file."""
-    try:
-        command = [PROGRAM_PATH_SAMTOOLS, PROGRAM_PATH_SAMTOOLS_VIEW, "-@", str(threads), "-c", "-F", "4", bam_file]
-        print_debug(f"Executing command: {' '.join(command)}")
-
-        result = subprocess.run(
-            command, 
-            capture_output=True, text=True, check=True
-        )
-        return int(result.stdout.strip())
-    except Exception as e:
-        print_error(f"Failed to count mapped reads in {bam_file}: {e}")
-    return 0
-def execute_samtools_count_total_reads(bam_file: str, threads: int=THREADS_DEFAULT) -> int:
-    """Counts the total number of reads in a BAM file (mapped and unmapped)."""
-    try:
-        command = [PROGRAM_PATH_SAMTOOLS, PROGRAM_PATH_SAMTOOLS_VIEW, "-@", str(threads), "-c", bam_file]
-        print_debug(f"Executing command: {' '.join(command)}")
-
-        result = subprocess.run(
-            command, 
-            capture_output=True, text=True, check=True
-        )
-        return int(result.stdout.strip())
-    except Exception as e:
-        print_error(f"Failed to count total reads in {bam_file}: {e}")
-    return 0
+from common.common_result_store import ResultStore, RESULT_TABLE_ENDOGENOUS_READS, export_result_table, get_result_fingerprint
+
+# columns of the endogenous reads file
+ENDOGENOUS_READS_COLUMNS = ["Filename", "MappedReads", "TotalReads", "Proportion"]
+
+# the mapped and unmapped reads are read from the BAM index
+COUNTING_MODE_INDEX = "index"
+# one pass over the reads, with the mapping quality and secondary/supplementary filters
+COUNTING_MODE_FILTERED = "filtered"
+
+def get_counting_mode(species: str) -> str:
+    settings = get_processing_settings(ReferenceGenomeProcessingSteps.DETERMINE_ENDOGENOUS_READS, species)
+    counting_mode = settings.get(EndogenousReadsSettings.COUNTING_MODE.value, COUNTING_MODE_INDEX)
+
+    if counting_mode not in (COUNTING_MODE_INDEX, COUNTING_MODE_FILTERED):
+        print_warning(f"Unknown counting mode {counting_mode} for endogenous reads of species {species}, using {COUNTING_MODE_INDEX}.")
+        return COUNTING_MODE_INDEX
+
+    return counting_mode
+
+def count_reads_from_index(bam_file: str) -> tuple[int, int]:
+    """
+    Counts the mapped and total reads of a sorted BAM file from its index, without reading the alignments.
+    Like samtools view -c -F 4 and samtools view -c, secondary and supplementary alignments are counted.
+    """
+    mapped_reads, unmapped_reads = common_rgp.execute_samtools_idxstats_read_counts(bam_file)
+    return mapped_reads, mapped_reads + unmapped_reads
+
+def count_reads_filtered(bam_file: str, min_mapping_quality: int = 0, exclude_secondary_supplementary: bool = True, threads: int = None) -> tuple[int, int]:
+    """
+    Counts the mapped and total reads of a BAM file in one pass over the alignments.
+    Mapped reads need at least the minimum mapping quality. Without secondary and
+    supplementary alignments, each read is counted once.
+    """
+    if threads is None:
+        threads = get_task_threads()
+
+    mapped_reads = 0
+    total_reads = 0
+
+    with pysam.AlignmentFile(bam_file, 'rb', threads=threads) as bamfile:
+        for read in bamfile.fetch(until_eof=True):
+            if exclude_secondary_supplementary and (read.is_secondary or read.is_supplementary):
+                continue
+
+            total_reads += 1
+
+            if not read.is_unmapped and read.mapping_quality >= min_mapping_quality:
+                mapped_reads += 1
+
+    return mapped_reads, total_reads
+
+def get_filter_settings(species: str) -> tuple[int, bool]:
+    settings = get_processing_settings(ReferenceGenomeProcessingSteps.DETERMINE_ENDOGENOUS_READS, species)
+    min_mapping_quality = int(settings.get(EndogenousReadsSettings.MIN_MAPPING_QUALITY.value, 0))
+    exclude_secondary_supplementary = bool(settings.get(EndogenousReadsSettings.EXCLUDE_SECONDARY_SUPPLEMENTARY.value, True))
+    return min_mapping_quality, exclude_secondary_supplementary
+
+def get_input_fingerprint(bam_file: str, species: str) -> str:
+    # the reads are counted again when the BAM file or the counting settings change
+    counting_mode = get_counting_mode(species)
+    filter_settings = get_filter_settings(species) if counting_mode == COUNTING_MODE_FILTERED else None
+    return get_result_fingerprint([bam_file], counting_mode=counting_mode, filter_settings=filter_settings)
 
+def count_reads(bam_file: str, species: str) -> tuple[int, int]:
+    """Counts the mapped and total reads of a BAM file with the counting mode of the species."""
+    if get_counting_mode(species) == COUNTING_MODE_INDEX:
+        return count_reads_from_index(bam_file)
 
-def determine_endogenous_reads_for_bam_file(bam_file: str, processed_folder: str):
-    """Calculates endogenous reads for a single BAM file and saves to a separate file."""
+    min_mapping_quality, exclude_secondary_supplementary = get_filter_settings(species)
+
+    print_debug(f"Counting reads with mapping quality >= {min_mapping_quality}, secondary and supplementary alignments {'excluded' if exclude_secondary_supplementary else 'included'}")
+
+    return count_reads_filtered(bam_file, min_mapping_quality, exclude_secondary_supplementary)
+
+
+@track_resource_usage
+def determine_endogenous_reads_for_bam_file(bam_file: str, species: str, ref_genome_id: str):
+    """Calculates endogenous reads for a single BAM file and saves them to the result store."""
     bam_filename = get_filename_from_path_without_extension(bam_file)
 
-    output_filename = f"{bam_filename}{FILE_ENDING_ENDOGENOUS_READS_CSV}"
-    target_file_path = os.path.join(processed_folder, output_filename)
+    result_key = {"species": species, "reference_genome": ref_genome_id, "Filename": bam_filename}
+    fingerprint = get_input_fingerprint(bam_file, species)
 
-    if os.path.exists(target_file_path):
-        print_skipping(f"Result file already exists for {bam_filename}.")
-        return
+    with ResultStore() as result_store:
+        if result_store.has_records(RESULT_TABLE_ENDOGENOUS_READS, fingerprint=fingerprint, **result_key):
+            print_skipping(f"Result already exists for {bam_filename}.")
+            return
 
     print_info(f"Determining endogenous reads for {bam_filename} ...")
 
     proportion = 0.0
 
-    print_debug(f"Counting mapped reads in {bam_filename} ...")
-    mapped_reads = execute_samtools_count_mapped_reads(bam_file)
-
-    print_debug(f"Counting total reads in {bam_filename} ...")
-    total_reads = execute_samtools_count_total_reads(bam_file)
+    print_debug(f"Counting mapped and total reads in {bam_filename} ...")
+    try:
+        mapped_reads, total_reads = count_reads(bam_file, species)
+    except Exception as e:
+        print_error(f"Failed to count reads in {bam_filename}: {e}")
+        return
 
     if total_reads != 0:
         proportion = mapped_reads / total_reads
 
     print_info(f"Endogenous reads for {bam_filename}: {mapped_reads}/{total_reads} -> {proportion:.4f}")
 
-    print_debug(f"Writing results for {bam_filename} to {target_file_path}")
+    print_debug(f"Writing results for {bam_filename} to the result store")
     try:
-        with open(target_file_path, "w") as result_file:
-            
-            result_file.write("Filename,MappedReads,TotalReads,Proportion\n")
-            result_file.write(f"{bam_filename},{mapped_reads},{total_reads},{proportion}\n")
+        with ResultStore() as result_store:
+            result_store.write_records(RESULT_TABLE_ENDOGENOUS_READS, result_key, [{"MappedReads": mapped_reads, "TotalReads": total_reads, "Proportion": proportion}], fingerprint)
         
-        print_debug(f"Wrote results for {bam_filename} to {target_file_path}")
-    except IOError as e:
-        print_error(f"Failed to write result file for {bam_filename} at {target_file_path}: {e}")
+        print_debug(f"Wrote results for {bam_filename} to the result store")
+    except Exception as e:
+        print_error(f"Failed to write result for {bam_filename} to the result store: {e}")
 
 
+@track_resource_usage
 def combine_endogenous_reads_files(species: str, ref_genome_id: str):
-    """Combines individual endogenous read files for a species into a single summary file."""
+    """Exports the endogenous reads of all BAM files of a species into a single summary file."""
     
     print_info(f"Combining endogenous reads files for species: {species}")
     
-    processed_folder = get_folder_path_species_processed_refgenome_endogenous_reads(species, ref_genome_id)
     result_folder = get_folder_path_species_results_refgenome_endogenous_reads(species, ref_genome_id)
     
     combined_file_path = os.path.join(result_folder, f"{species}{FILE_ENDING_ENDOGENOUS_READS_CSV}")
 
-    # Check if there are any individual files to combine
-    individual_files = get_files_in_folder_matching_pattern(processed_folder, f"*{FILE_ENDING_ENDOGENOUS_READS_CSV}")
+    try:
+        with ResultStore() as result_store:
+            combined_df = result_store.read_records(RESULT_TABLE_ENDOGENOUS_READS, species=species, reference_genome=ref_genome_id)
 
-    if not individual_files:
-        print_warning(f"No individual endogenous read files found to combine for species {species}.")
-        return
+        # Check if there are any results to combine
+        if combined_df.empty:
+            print_warning(f"No endogenous reads results found to combine for species {species}.")
+            return
 
-    print_debug(f"Found {len(individual_files)} individual endogenous read files to combine.")
-    print_debug(f"Individual endogenous read files: {individual_files}")
+        print_debug(f"Found endogenous reads results of {len(combined_df)} BAM files to combine.")
 
-    try:
         print_debug(f"Writing combined results to {combined_file_path}")
-        with open(combined_file_path, "w") as combined_file:
-            # Write header for the combined file
-            combined_file.write("Filename,MappedReads,TotalReads,Proportion\n")
-
-            # Sort files alphabetically for consistent output order
-            individual_files.sort()
-
-            for individual_file in individual_files:
-                try:
-
-                    print_debug(f"Reading individual file {individual_file}")
-                    with open(individual_file, "r") as f_in:
-                        # The individual file has a header. Skip it
-                        header = f_in.readline()
-
-                        # Write the rest of the file
-                        data_line = f_in.readline().strip()
-                        
-                        # Simple check to avoid writing empty lines if files were corrupted/empty
-                        if data_line:
-                            combined_file.write(data_line + "\n")
-                except IOError as e:
-                     print_error(f"Could not read individual file {individual_file}: {e}")
-                except Exception as e:
-                    print_error(f"An unexpected error occurred reading {individual_file}: {e}")
+        export_result_table(combined_df, combined_file_path, ENDOGENOUS_READS_COLUMNS)
 
         print_success(f"Successfully created combined endogenous reads file: {combined_file_path}")
 
-    except IOError as e:
-        print_error(f"Failed to write combined result file at {combined_file_path}: {e}")
     except Exception as e:
         print_error(f"An unexpected error occurred during combining files for {species}: {e}")
 
@@ -132,7 +154,6 @@ def determine_endogenous_reads_for_species(species: str, ref_genome_id: str):
     print_info(f"Processing BAM files to determine endogenous reads for species: {species}")
 
     mapped_folder = get_folder_path_species_processed_refgenome_mapped(species, ref_genome_id)
-    processed_folder = get_folder_path_species_processed_refgenome_endogenous_reads(species, ref_genome_id)
 
     bam_files = get_files_in_folder_matching_pattern(mapped_folder, f"*{FILE_ENDING_SORTED_BAM}")
 
@@ -143,10 +164,19 @@ def determine_endogenous_reads_for_species(species: str, ref_genome_id: str):
     print_debug(f"Found {len(bam_files)} BAM files for species {species}: {bam_files}")
 
     for bam_file in bam_files:
-        determine_endogenous_reads_for_bam_file(bam_file, processed_folder)
+        determine_endogenous_reads_for_bam_file(bam_file, species, ref_genome_id)
 
     print_info(f"Finished processing individual BAM files for species {species}.")
 
+def determine_endogenous_reads_for_reference_genome(species: str, ref_genome_id: str):
+
+    print_info(f"Determining endogenous reads for species {species} and reference genome {ref_genome_id}")
+
+    # First, process each individual BAM file for the species
+    determine_endogenous_reads_for_species(species, ref_genome_id)
+    # Then, combine the individual results for this species
+    combine_endogenous_reads_files(species, ref_genome_id)
+
 def all_species_determine_endogenous_reads():
 
     print_execution("Determining endogenous reads for all species")
@@ -166,12 +196,7 @@ def all_species_determine_endogenous_reads():
             ref_genome_id = ref_genome_tuple[0]
             #ref_genome_path = ref_genome_tuple[1]
 
-            print_info(f"Determining endogenous reads for species {species} and reference genome {ref_genome_id}")
-
-            # First, process each individual BAM file for the species
-            determine_endogenous_reads_for_species(species, ref_genome_id)
-            # Then, combine the individual results for this species
-            combine_endogenous_reads_files(species, ref_genome_id)
+            determine_endogenous_reads_for_reference_genome(species, ref_genome_id)
 
     print_success("Endogenous reads determination completed for all species.")
 
@@ -21,8 +21,11 @@ def write_fasta_entry(special_reads_file_content: str, scaffold: str, start: int
         special_reads_file_content.write(f"{sequence}\n")
         print_info(f"Outputted sequence for scaffold {scaffold} from {start} to {end} (Avg Depth: {avg_depth}, Max Depth: {max_depth})")
 
-def execute_extract_special_sequences(bam_file_path:str, output_folder:str, depth_threshold: int = DEPTH_THRESHOLD, minimum_sequence_length: int = MINIMUM_SEQUENCE_LENGTH, threads: int = THREADS_DEFAULT):
-    
+@track_resource_usage
+def execute_extract_special_sequences(bam_file_path:str, output_folder:str, depth_threshold: int = DEPTH_THRESHOLD, minimum_sequence_length: int = MINIMUM_SEQUENCE_LENGTH, threads: int = None):
+    if threads is None:
+        threads = get_task_threads()
+
     output_filename = os.path.join(output_folder, os.path.basename(bam_file_path).replace(FILE_ENDING_BAM, f"_special_reads_depth_gt_{DEPTH_THRESHOLD}.fasta"))
     
     print_info(f"Processing BAM file: {bam_file_path} with depth threshold: {depth_threshold}. Outputting to: {output_filename}")
@@ -33,7 +36,7 @@ def execute_extract_special_sequences(bam_file_path:str, output_folder:str, dept
         print_skipping(f"Output file {output_file_path} already exists!")
         return
 
-    with pysam.AlignmentFile(bam_file_path, 'rb', threads=threads) as bamfile, open(output_file_path, 'w') as special_reads_file_content:
+    with pysam.AlignmentFile(bam_file_path, 'rb', threads=threads) as bamfile, atomic_output(output_file_path) as temp_output_file_path, open(temp_output_file_path, 'w') as special_reads_file_content:
 
         current_sequence = ""
         current_start_position = None
@@ -88,8 +91,12 @@ def write_unmapped_region(txtfile, scaffold: str, start: int, end: int, minimum_
         txtfile.write(f"{scaffold}:{start}-{end}\n")
         print_info(f"Unmapped region found in {scaffold}: {start}-{end}")
 
-def execute_extract_unmapped_regions(bam_file_path: str, output_folder: str, minimum_sequence_length: int = MINIMUM_SEQUENCE_LENGTH, maximum_sequence_length: int = MAXIMUM_SEQUENCE_LENGTH, threads: int = THREADS_DEFAULT):
+@track_resource_usage
+def execute_extract_unmapped_regions(bam_file_path: str, output_folder: str, minimum_sequence_length: int = MINIMUM_SEQUENCE_LENGTH, maximum_sequence_length: int = MAXIMUM_SEQUENCE_LENGTH, threads: int = None):
     """Extracts regions of the reference genome with no coverage (depth = 0) from a BAM file."""
+    if threads is None:
+        threads = get_task_threads()
+
     output_filename = os.path.join(output_folder, os.path.basename(bam_file_path).replace(FILE_ENDING_BAM, "_unmapped_regions.txt"))
     
     if os.path.exists(output_filename):
@@ -98,7 +105,7 @@ def execute_extract_unmapped_regions(bam_file_path: str, output_folder: str, min
 
     print_info(f"Extracting unmapped regions from {bam_file_path}. Output: {output_filename}")
 
-    with pysam.AlignmentFile(bam_file_path, 'rb', threads=threads) as bamfile, open(output_filename, 'w') as txtfile:
+    with pysam.AlignmentFile(bam_file_path, 'rb', threads=threads) as bamfile, atomic_output(output_filename) as temp_output_filename, open(temp_output_filename, 'w') as txtfile:
         total_regions = 0
         
         # Iterate over all reference scaffolds
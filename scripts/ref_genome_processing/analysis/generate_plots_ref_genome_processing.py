@@ -8,10 +8,11 @@ def plot_depth_analysis(species: str, reference_genome_id: str):
     analysis_folder = get_folder_path_species_results_refgenome_coverage(species, reference_genome_id)
 
     print_debug(f"Analysis folder: {analysis_folder}")
-    print_debug(f"looking for files with pattern *{FILE_ENDING_COMBINED_COVERAGE_ANALYSIS_CSV}")
+    print_debug(f"looking for files with pattern *{FILE_ENDING_BINNED_COVERAGE_ANALYSIS_CSV}")
 
+    # the plots read the coverage per bin, its size does not grow with the number of scaffolds
     # gives a list with the path and file names
-    analysis_files = get_files_in_folder_matching_pattern(analysis_folder, f"*{FILE_ENDING_EXTENDED_COVERAGE_ANALYSIS_CSV}")
+    analysis_files = get_files_in_folder_matching_pattern(analysis_folder, f"*{FILE_ENDING_BINNED_COVERAGE_ANALYSIS_CSV}")
 
     # here have multiple files, one for each sample, hence the list
     if len(analysis_files) == 0:
@@ -27,7 +28,7 @@ def plot_depth_analysis(species: str, reference_genome_id: str):
 
     for analysis_file in analysis_files:
 
-        sample = get_filename_from_path(analysis_file).replace(FILE_ENDING_EXTENDED_COVERAGE_ANALYSIS_CSV, "")
+        sample = get_filename_from_path(analysis_file).replace(FILE_ENDING_BINNED_COVERAGE_ANALYSIS_CSV, "")
 
         output_folder_path = get_folder_path_species_results_refgenome_plots_depth_sample(species, reference_genome_id, sample)
 
@@ -39,7 +40,7 @@ def plot_depth_analysis(species: str, reference_genome_id: str):
     # plot individuals together
     r_script_individuals = get_r_script(R_SCRIPT_PLOT_DEPTH_COMPARE_INDIVIDUALS, FOLDER_REF_GENOME_PROCESSING)
     output_folder_path_individuals = get_folder_path_species_results_refgenome_plots_depth(species, reference_genome_id)
-    combined_results_file = os.path.join(analysis_folder, f"{species}{FILE_ENDING_COMBINED_COVERAGE_ANALYSIS_DETAILED_CSV}")
+    combined_results_file = os.path.join(analysis_folder, f"{species}{FILE_ENDING_COMBINED_COVERAGE_ANALYSIS_BINNED_CSV}")
 
     print_info(f"Plotting depth analysis for all individuals in {combined_results_file} together to {output_folder_path_individuals}")
     call_r_script(r_script_individuals, species, combined_results_file, output_folder_path_individuals)
@@ -52,9 +53,9 @@ def plot_breadth_analysis(species: str, reference_genome_id: str):
     analysis_folder = get_folder_path_species_results_refgenome_coverage(species, reference_genome_id)
 
     print_debug(f"Analysis folder: {analysis_folder}")
-    print_debug(f"looking for files with pattern *{FILE_ENDING_EXTENDED_COVERAGE_ANALYSIS_CSV}")
+    print_debug(f"looking for files with pattern *{FILE_ENDING_BINNED_COVERAGE_ANALYSIS_CSV}")
 
-    analysis_files = get_files_in_folder_matching_pattern(analysis_folder, f"*{FILE_ENDING_EXTENDED_COVERAGE_ANALYSIS_CSV}")
+    analysis_files = get_files_in_folder_matching_pattern(analysis_folder, f"*{FILE_ENDING_BINNED_COVERAGE_ANALYSIS_CSV}")
 
     if len(analysis_files) == 0:
         print_warning(f"No breadth analysis files found for species {species}.")
@@ -69,7 +70,7 @@ def plot_breadth_analysis(species: str, reference_genome_id: str):
 
     for analysis_file in analysis_files:
 
-        sample = get_filename_from_path(analysis_file).replace(FILE_ENDING_EXTENDED_COVERAGE_ANALYSIS_CSV, "")
+        sample = get_filename_from_path(analysis_file).replace(FILE_ENDING_BINNED_COVERAGE_ANALYSIS_CSV, "")
 
         output_folder_path = get_folder_path_species_results_refgenome_plots_breadth_sample(species, reference_genome_id, sample)
 
@@ -81,7 +82,7 @@ def plot_breadth_analysis(species: str, reference_genome_id: str):
     r_script_individuals = get_r_script(R_SCRIPT_PLOT_BREADTH_COMPARE_INDIVIDUALS, FOLDER_REF_GENOME_PROCESSING)
     output_folder_path_individuals = get_folder_path_species_results_refgenome_plots_breadth(species, reference_genome_id)
 
-    combined_results_file = os.path.join(analysis_folder, f"{species}{FILE_ENDING_COMBINED_COVERAGE_ANALYSIS_DETAILED_CSV}")
+    combined_results_file = os.path.join(analysis_folder, f"{species}{FILE_ENDING_COMBINED_COVERAGE_ANALYSIS_BINNED_CSV}")
 
     print_info(f"Plotting breadth analysis for all individuals in {combined_results_file} together to {output_folder_path_individuals}")
     call_r_script(r_script_individuals, species, combined_results_file, output_folder_path_individuals)
@@ -117,6 +118,13 @@ def plot_endogenous_reads(species: str, reference_genome_id: str):
 
     print_info(f"Finished plotting endogenous reads for species {species} and reference genome {reference_genome_id}")
 
+def generate_plots_for_reference_genome(species: str, reference_genome_id: str):
+    print_info(f"Generating plots for reference genome {reference_genome_id}")
+
+    plot_depth_analysis(species, reference_genome_id)
+    plot_breadth_analysis(species, reference_genome_id)
+    plot_endogenous_reads(species, reference_genome_id)
+
 def species_generate_plots(species: str):
     print_info(f"Generating reference genome plots for species {species}")
 
@@ -132,11 +140,7 @@ def species_generate_plots(species: str):
         ref_genome_id = ref_genome_tuple[0]
         #ref_genome_path = ref_genome_tuple[1]
 
-        print_info(f"Generating plots for reference genome {ref_genome_id}")
-
-        plot_depth_analysis(species, ref_genome_id)
-        plot_breadth_analysis(species, ref_genome_id)
-        plot_endogenous_reads(species, ref_genome_id)
+        generate_plots_for_reference_genome(species, ref_genome_id)
 
     print_info(f"Finished generating reference genome plots for species {species}")
 
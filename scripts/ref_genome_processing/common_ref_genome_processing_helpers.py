@@ -87,4 +87,34 @@ def get_reference_genome_file_list_for_species(species: str) -> list[tuple[str,
     # return as tuple of (filename without extension, filepath)
     reference_genome_files_with_filename = [(os.path.splitext(os.path.basename(f))[0], f) for f in reference_genome_files]
 
-    return reference_genome_files_with_filename
\ No newline at end of file
+    return reference_genome_files_with_filename
+
+def get_sorted_bam_file_path_for_individual(species: str, individual: str, ref_genome_id: str) -> str:
+    # the sorted BAM file created by the mapping of the merged reads of the individual
+    read_file_path = create_species_individual_combined_read_filepath(species, individual)
+    sam_file_path = get_sam_file_path_for_read_file_and_ref_genome(species, read_file_path, ref_genome_id)
+    bam_file_path = get_bam_file_path_for_sam_file(species, ref_genome_id, sam_file_path)
+    return get_sorted_bam_file_path_for_bam_file(species, ref_genome_id, bam_file_path)
+
+def execute_samtools_idxstats_read_counts(bam_file: str) -> tuple[int, int]:
+    """
+    Number of mapped and unmapped reads of an indexed BAM file, taken from the index (samtools idxstats),
+    so the alignments are not read. Secondary and supplementary alignments count as mapped reads.
+    """
+    output = common.run_command([common.PROGRAM_PATH_SAMTOOLS, common.PROGRAM_PATH_SAMTOOLS_IDXSTATS, bam_file], capture_output=True)
+
+    mapped_reads = 0
+    unmapped_reads = 0
+
+    # columns: reference sequence, length, mapped reads, unmapped reads
+    for line in output.splitlines():
+        columns = line.split("\t")
+
+        if len(columns) < 4:
+            continue
+
+        mapped_reads += int(columns[2])
+        unmapped_reads += int(columns[3])
+
+    return mapped_reads, unmapped_reads
+
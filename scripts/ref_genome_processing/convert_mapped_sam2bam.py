@@ -1,10 +1,11 @@
 import os
-import subprocess
 
 from common_aDNA_scripts import *
 import ref_genome_processing.common_ref_genome_processing_helpers as common_rgp
 
-def execute_convert_sam_to_bam(sam_file: str, bam_file: str, sorted_bam: str, threads: int=THREADS_DEFAULT, delete_sam: bool=True, detlete_unsorted_bam: bool=True):
+def execute_convert_sam_to_bam(sam_file: str, bam_file: str, sorted_bam: str, threads: int = None, delete_sam: bool=True, detlete_unsorted_bam: bool=True):
+    if threads is None:
+        threads = get_task_threads()
 
     if not os.path.exists(sorted_bam):
 
@@ -16,9 +17,10 @@ def execute_convert_sam_to_bam(sam_file: str, bam_file: str, sorted_bam: str, th
                 return
 
             try:
-                command_sam_to_bam = f"{PROGRAM_PATH_SAMTOOLS} {PROGRAM_PATH_SAMTOOLS_VIEW} -@ {threads} -bS {sam_file} -o {bam_file}"
-                print_debug(f"Executing command: {command_sam_to_bam}")
-                subprocess.run(command_sam_to_bam, shell=True, check=True)
+                with atomic_output(bam_file) as temp_bam_file:
+                    command_sam_to_bam = f"{PROGRAM_PATH_SAMTOOLS} {PROGRAM_PATH_SAMTOOLS_VIEW} -@ {threads} -bS {sam_file} -o {temp_bam_file}"
+                    print_debug(f"Executing command: {command_sam_to_bam}")
+                    run_command(command_sam_to_bam)
 
                 if delete_sam and os.path.exists(sam_file):
                     print_info(f"Removing SAM file {sam_file}...")
@@ -35,9 +37,10 @@ def execute_convert_sam_to_bam(sam_file: str, bam_file: str, sorted_bam: str, th
         print_info(f"Sorting {bam_file}...")
         
         try:
-            command_sort = f"{PROGRAM_PATH_SAMTOOLS} {PROGRAM_PATH_SAMTOOLS_SORT} -@ {threads} {bam_file} -o {sorted_bam}"
-            print_debug(f"Executing command: {command_sort}")
-            subprocess.run(command_sort, shell=True, check=True)
+            with atomic_output(sorted_bam) as temp_sorted_bam:
+                command_sort = f"{PROGRAM_PATH_SAMTOOLS} {PROGRAM_PATH_SAMTOOLS_SORT} -@ {threads} {bam_file} -o {temp_sorted_bam}"
+                print_debug(f"Executing command: {command_sort}")
+                run_command(command_sort)
 
             print_success(f"Conversion and sorting of {sam_file} completed successfully.")
             
@@ -53,23 +56,36 @@ def execute_convert_sam_to_bam(sam_file: str, bam_file: str, sorted_bam: str, th
         print_info(f"Sort for {bam_file} already exists. Skipping.")
     
     # Index the sorted BAM file
+    if not execute_index_bam(sorted_bam, threads):
+        return
+    
+    print_success(f"Conversion and indexing of {sam_file} completed successfully.")
+
+def index_bam(sorted_bam: str, indexed_bam: str, threads: int):
+    command_index = f"{PROGRAM_PATH_SAMTOOLS} {PROGRAM_PATH_SAMTOOLS_INDEX} -@ {threads} {sorted_bam} {indexed_bam}"
+    print_debug(f"Executing command: {command_index}")
+    run_command(command_index)
+
+def execute_index_bam(sorted_bam: str, threads: int = None) -> bool:
+    if threads is None:
+        threads = get_task_threads()
+
     indexed_bam = sorted_bam + FILE_ENDING_BAI
 
     if not os.path.exists(indexed_bam):
         print_info(f"Indexing {sorted_bam}...")
         
         try:
-            command_index = f"{PROGRAM_PATH_SAMTOOLS} {PROGRAM_PATH_SAMTOOLS_INDEX} -@ {threads} {sorted_bam} {indexed_bam}" 
-            print_debug(f"Executing command: {command_index}")
-            subprocess.run(command_index, shell=True, check=True)
+            with atomic_output(indexed_bam) as temp_indexed_bam:
+                index_bam(sorted_bam, temp_indexed_bam, threads)
             print_success(f"Indexing of {sorted_bam} completed successfully.")
         except Exception as e:
             print_error(f"Failed to index {sorted_bam}: {e}")
-            return
+            return False
     else:
         print_info(f"Index for {sorted_bam} already exists. Skipping.")
-    
-    print_success(f"Conversion and indexing of {sam_file} completed successfully.")
+
+    return True
 
 
 def convert_ref_genome_mapped_sam_to_bam_for_species(species):
@@ -1,12 +1,18 @@
 import os
-import subprocess
+import glob
+import math
 from common_aDNA_scripts import *
 
 import ref_genome_processing.common_ref_genome_processing_helpers as common_rgp
 import ref_genome_processing.convert_mapped_sam2bam as convert_sam2bam
 
-def execute_bwa_map_aDNA_to_refgenome(input_file_path:str, ref_genome_path:str, output_file_path:str, threads:int = THREADS_DEFAULT):
-    
+# samtools sort default, memory per sort thread before temporary files are written
+DEFAULT_SORT_MEMORY_PER_THREAD = "768M"
+
+def execute_bwa_map_aDNA_to_refgenome(input_file_path:str, ref_genome_path:str, output_file_path:str, threads: int = None):
+    if threads is None:
+        threads = get_task_threads()
+
     print_info(f"Mapping {input_file_path} to reference genome ...")
 
     if not os.path.exists(input_file_path):
@@ -19,15 +25,143 @@ def execute_bwa_map_aDNA_to_refgenome(input_file_path:str, ref_genome_path:str,
         print_skipping(f"Output file {output_file_path} already exists!")
         return
     
-    command_bwa = f"{PROGRAM_PATH_BWA} {PROGRAM_PATH_BWA_MEM} -t {str(threads)} {ref_genome_path} {input_file_path} > {output_file_path}"
-    print_debug(f"BWA command: {command_bwa}")
-
     try:
-        subprocess.run(command_bwa, shell=True, check=True)
+        with atomic_output(output_file_path) as temp_output_file_path:
+            command_bwa = f"{PROGRAM_PATH_BWA} {PROGRAM_PATH_BWA_MEM} -t {str(threads)} {ref_genome_path} {input_file_path} > {temp_output_file_path}"
+            print_debug(f"BWA command: {command_bwa}")
+
+            run_command(command_bwa)
         print_success(f"Mapping {input_file_path} to reference genome complete")
     except Exception as e:
         print_error(f"Failed to run bwa for {input_file_path}: {e}")
 
+def is_streaming_mapping_mode(species: str) -> bool:
+    # bwa mem output is sorted directly, without sam and unsorted bam files
+    settings = get_processing_settings(ReferenceGenomeProcessingSteps.MAP_READS_TO_REFERENCE_GENOME, species)
+    return bool(settings.get(MappingSettings.STREAMING.value, False))
+
+def get_sort_temp_file_prefix(species: str, sorted_bam_file_path: str) -> str:
+    """
+    Prefix of the temporary files of samtools sort. By default they are written next to the sorted bam file,
+    a scratch folder can be configured with sort_temp_dir.
+    """
+    settings = get_processing_settings(ReferenceGenomeProcessingSteps.MAP_READS_TO_REFERENCE_GENOME, species)
+    temp_dir = settings.get(MappingSettings.SORT_TEMP_DIR.value) or os.path.dirname(sorted_bam_file_path)
+
+    os.makedirs(temp_dir, exist_ok=True)
+
+    # the leading dot hides the temporary files from the glob patterns used to find the bam files
+    return os.path.join(temp_dir, f".{get_filename_from_path(sorted_bam_file_path)}.sort")
+
+def get_sort_memory_per_thread(species: str) -> str:
+    settings = get_processing_settings(ReferenceGenomeProcessingSteps.MAP_READS_TO_REFERENCE_GENOME, species)
+    return str(settings.get(MappingSettings.SORT_MEMORY_PER_THREAD.value, DEFAULT_SORT_MEMORY_PER_THREAD))
+
+def get_sort_threads(threads: int) -> int:
+    # bwa does the work while the reads are mapped, samtools sort compresses its temporary files in the meantime
+    return max(1, threads // 4)
+
+def get_sort_memory_mb(species: str, threads: int) -> int:
+    """
+    Memory of samtools sort next to bwa mem in streaming mode, the memory per thread (e.g. 768M, 2G) times its threads.
+    """
+    sort_memory_per_thread = get_sort_memory_per_thread(species).strip().upper()
+    units_mb = {"K": 1 / 1024, "M": 1, "G": 1024}
+
+    if sort_memory_per_thread[-1:] in units_mb:
+        memory_per_thread_mb = float(sort_memory_per_thread[:-1]) * units_mb[sort_memory_per_thread[-1]]
+    else:
+        # samtools reads a number without unit as bytes
+        memory_per_thread_mb = float(sort_memory_per_thread) / (1024 * 1024)
+
+    return math.ceil(get_sort_threads(threads) * memory_per_thread_mb)
+
+def execute_bwa_map_and_sort_aDNA_to_refgenome(species: str, input_file_path: str, ref_genome_path: str, sorted_bam_file_path: str, threads: int = None):
+    """
+    Maps the reads with bwa mem and pipes the alignments directly into samtools sort.
+    Only the sorted bam file and its index are written, no sam or unsorted bam file.
+    The threads of the task are split between bwa and samtools sort.
+    """
+    if threads is None:
+        threads = get_task_threads()
+
+    print_info(f"Mapping {input_file_path} to reference genome and sorting the alignments ...")
+
+    if not os.path.exists(input_file_path):
+        raise Exception(f"Read file {input_file_path} does not exist!")
+    
+    if not os.path.exists(ref_genome_path):
+        raise Exception(f"Reference genome file {ref_genome_path} does not exist!")
+
+    if os.path.exists(sorted_bam_file_path):
+        print_skipping(f"Output file {sorted_bam_file_path} already exists!")
+        convert_sam2bam.execute_index_bam(sorted_bam_file_path, threads)
+        return
+
+    sort_memory_per_thread = get_sort_memory_per_thread(species)
+    sort_temp_file_prefix = get_sort_temp_file_prefix(species, sorted_bam_file_path)
+
+    # temporary files of a killed sort are not removed by samtools
+    for temp_file_path in glob.glob(f"{glob.escape(sort_temp_file_prefix)}.*"):
+        remove_file_if_exists(temp_file_path)
+
+    sort_threads = get_sort_threads(threads)
+    bwa_threads = max(1, threads - sort_threads)
+
+    try:
+        # the index is written together with the bam file, so a failed indexing leaves neither of them
+        with atomic_output(sorted_bam_file_path, sorted_bam_file_path + FILE_ENDING_BAI) as (temp_sorted_bam_file_path, temp_indexed_bam_file_path):
+            command_bwa = [PROGRAM_PATH_BWA, PROGRAM_PATH_BWA_MEM, "-t", str(bwa_threads), ref_genome_path, input_file_path]
+            command_sort = [
+                PROGRAM_PATH_SAMTOOLS, PROGRAM_PATH_SAMTOOLS_SORT,
+                "-@", str(sort_threads),
+                "-m", sort_memory_per_thread,
+                "-T", sort_temp_file_prefix,
+                "-o", temp_sorted_bam_file_path,
+                "-"
+            ]
+
+            run_piped_commands([command_bwa, command_sort], description=f"bwa mem | samtools sort for {get_filename_from_path(input_file_path)}")
+
+            convert_sam2bam.index_bam(temp_sorted_bam_file_path, temp_indexed_bam_file_path, threads)
+        print_success(f"Mapping, sorting and indexing of {input_file_path} complete")
+    except Exception as e:
+        print_error(f"Failed to map, sort and index {input_file_path}: {e}")
+
+def map_read_file_to_refgenome(species: str, read_file_path: str, ref_genome_id: str, ref_genome_path: str):
+
+    sam_file_path = common_rgp.get_sam_file_path_for_read_file_and_ref_genome(species, read_file_path, ref_genome_id)
+
+    print_debug(f"Output file: {sam_file_path}")
+    
+    # we only need to map if the sorted bam file does not exist
+    bam_file_path = common_rgp.get_bam_file_path_for_sam_file(species, ref_genome_id, sam_file_path)
+    sorted_bam_file_path = common_rgp.get_sorted_bam_file_path_for_bam_file(species, ref_genome_id, bam_file_path)
+
+    print_debug(f"Sorted BAM file path: {sorted_bam_file_path}")
+
+    if os.path.exists(sorted_bam_file_path):
+        print_skipping(f"Sorted BAM file {sorted_bam_file_path} already exists!")
+        # the indexing of an earlier run may have failed
+        convert_sam2bam.execute_index_bam(sorted_bam_file_path)
+        return
+
+    # a sam file of an earlier run is converted, otherwise the sorted bam file is written directly
+    if is_streaming_mapping_mode(species) and not os.path.exists(sam_file_path):
+        execute_bwa_map_and_sort_aDNA_to_refgenome(species, read_file_path, ref_genome_path, sorted_bam_file_path)
+        return
+
+    if os.path.exists(sam_file_path):
+        print_skipping(f"SAM file {sam_file_path} already exists!")
+    else:
+        execute_bwa_map_aDNA_to_refgenome(read_file_path, ref_genome_path, sam_file_path)
+
+    # Convert SAM to BAM and sort
+    # Add this here so the SAM to BAM conversion is done directly after mapping
+    # This will help to reduce the space used by the SAM files as they can be very large and are not needed after conversion
+    # if this step will be called later, we will require more space as first all SAM files will be created and then converted to BAM files
+    convert_sam2bam.execute_convert_sam_to_bam(sam_file_path, bam_file_path, sorted_bam_file_path)
+
 def map_aDNA_to_refgenome_for_species(species: str):
     print_info(f"Mapping aDNA to reference genome for species {species} ...")
 
@@ -68,30 +202,7 @@ def map_aDNA_to_refgenome_for_species(species: str):
 
             print_info(f"[{count_current}/{number_of_entries}] Mapping {read_file_path} to reference genome {ref_genome_path} ...")
 
-            sam_file_path = common_rgp.get_sam_file_path_for_read_file_and_ref_genome(species, read_file_path, ref_genome_id)
-
-            print_debug(f"Output file: {sam_file_path}")
-            
-            # we only need to map if the sorted bam file does not exist
-            bam_file_path = common_rgp.get_bam_file_path_for_sam_file(species, ref_genome_id, sam_file_path)
-            sorted_bam_file_path = common_rgp.get_sorted_bam_file_path_for_bam_file(species, ref_genome_id, bam_file_path)
-
-            print_debug(f"Sorted BAM file path: {sorted_bam_file_path}")
-
-            if os.path.exists(sorted_bam_file_path):
-                print_skipping(f"Sorted BAM file {sorted_bam_file_path} already exists!")
-                continue
-
-            if os.path.exists(sam_file_path):
-                print_skipping(f"SAM file {sam_file_path} already exists!")
-            else:
-                execute_bwa_map_aDNA_to_refgenome(read_file_path, ref_genome_path, sam_file_path, THREADS_DEFAULT)
-
-            # Convert SAM to BAM and sort
-            # Add this here so the SAM to BAM conversion is done directly after mapping
-            # This will help to reduce the space used by the SAM files as they can be very large and are not needed after conversion
-            # if this step will be called later, we will require more space as first all SAM files will be created and then converted to BAM files
-            convert_sam2bam.execute_convert_sam_to_bam(sam_file_path, bam_file_path, sorted_bam_file_path)
+            map_read_file_to_refgenome(species, read_file_path, ref_genome_id, ref_genome_path)
 
 
     print_success(f"Mapping aDNA to reference genome for species {species} complete")
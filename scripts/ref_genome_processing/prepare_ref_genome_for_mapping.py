@@ -51,11 +51,17 @@ def execute_bwa_index_reference_genome(reference_genome_path: str):
         print_skipping(f"Index file {index_file} already exists.")
         return 
 
-    command_bwa = f"{PROGRAM_PATH_BWA} {PROGRAM_PATH_BWA_INDEX} {reference_genome_path}"
+    # the index is written with a temporary prefix and renamed once complete.
+    # the .bwt file is renamed last, as its existence marks the index as done.
+    index_files = [index_file] + [f"{reference_genome_path}{file_ending}" for file_ending in FILE_ENDINGS_BWA_INDEX if file_ending != ".bwt"]
+    temp_index_prefix = get_temp_file_path(reference_genome_path)
+
+    command_bwa = f"{PROGRAM_PATH_BWA} {PROGRAM_PATH_BWA_INDEX} -p {temp_index_prefix} {reference_genome_path}"
     print_debug(f"Command: {command_bwa}")
 
     try:
-        subprocess.run(command_bwa, shell=True, check=True)
+        with atomic_output(*index_files):
+            run_command(command_bwa)
         print_info(f"Finished indexing reference genome {reference_genome_path}")
     except Exception as e:
         print_error(f"Failed to index reference genome {reference_genome_path}: {e}")
\ No newline at end of file
@@ -46,10 +46,11 @@ def merge_all_fastq_files(species: str):
     try:
         print_info(f"Concatenating {len(fastq_files_filtered)} FASTQ.GZ files (excluding 'LB' and 'EB') for pattern *{FILE_ENDING_DUPLICATES_REMOVED_FASTQ_GZ}")
        
-        cat_command = f"cat {' '.join(fastq_files_filtered)} > {output_file_path}"
-        print_debug(f"cat command: {cat_command}")
-        
-        subprocess.run(cat_command, shell=True, check=True)
+        with atomic_output(output_file_path) as temp_output_file_path:
+            cat_command = f"cat {' '.join(fastq_files_filtered)} > {temp_output_file_path}"
+            print_debug(f"cat command: {cat_command}")
+
+            run_command(cat_command)
         print_success(f"Concatenation to {output_file_path} complete")
     except Exception as e:
         print_error(f"Failed to concatenate all FASTQ.GZ files for species {species}: {e}")
@@ -98,9 +99,10 @@ def merge_fastq_by_individual(species: str):
         # call cat via subprocess
         try:
             print_info(f"Concatenating {len(individual_fastq_files_per_pattern)} FASTQ.GZ files for pattern {pattern}")
-            cat_command = f"cat {input_pattern_path} > {output_file_path}"
-            print_debug(f"cat command: {cat_command}")
-            subprocess.run(cat_command, shell=True, check=True)
+            with atomic_output(output_file_path) as temp_output_file_path:
+                cat_command = f"cat {input_pattern_path} > {temp_output_file_path}"
+                print_debug(f"cat command: {cat_command}")
+                run_command(cat_command)
             print_success(f"Concatenation for pattern {pattern} complete")
         except Exception as e:
             print_error(f"Failed to concatenate FASTQ.GZ files for pattern {pattern}: {e}")